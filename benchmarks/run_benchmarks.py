@@ -0,0 +1,205 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from benchmarks.synthetic_fastq import generate_fastq
+from src.pipeline.instrumentation import peak_rss_mb
+
+# Every benchmark runs in a fresh (spawned) process so that its peak RSS is its own
+# (peak_rss_mb reads VmHWM, which unlike ru_maxrss is reset by exec).
+# A result slower than REGRESSION_RATIO times the baseline is reported as a regression.
+REGRESSION_RATIO = 1.10
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BARCODE_LENGTH = 6
+
+
+def bench_parse_fastq(path, work_dir):
+    from src.parsing.parsing_fastq import FastqParser
+    FastqParser(path).parse_fastq()
+
+
+def _stat(path):
+    from src.statistic.statistic import FastqStat
+    return FastqStat(path)
+
+
+def bench_stat_read_fastq(path, work_dir):
+    _stat(path).read_fastq()
+
+
+def bench_stat_sequence(path, work_dir):
+    _stat(path).sequence()
+
+
+def bench_stat_sequence_lengths(path, work_dir):
+    _stat(path).calculate_sequence_lengths()
+
+
+def bench_stat_gc_content(path, work_dir):
+    _stat(path).calculate_gc_content_per_sequence()
+
+
+def bench_stat_mean_quality(path, work_dir):
+    _stat(path).calculate_mean_quality_scores()
+
+
+def bench_stat_barcode_distribution(path, work_dir):
+    _stat(path).calculate_barcode_distribution(BARCODE_LENGTH)
+
+
+def bench_stat_calculate_metrics(path, work_dir):
+    _stat(path).calculate_metrics(BARCODE_LENGTH)
+
+
+def bench_stat_streaming_stats(path, work_dir):
+    _stat(path).calculate_streaming_stats(BARCODE_LENGTH, csv_path=os.path.join(work_dir, 'metrics.csv'))
+
+
+def bench_filter_fastq(path, work_dir):
+    from src.filter.filter import filter_fastq
+    filter_fastq(path, os.path.join(work_dir, 'filtered.fastq'))
+
+
+def bench_main(path, work_dir):
+    import main
+    sys.argv = ['main.py', '-i', path, '-o', os.path.join(work_dir, 'main_output'), '--no-cache']
+    # The log is still written to processing.log in the output directory
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        main.main()
+
+
+# The start-up benchmarks run a new interpreter, as the benchmark process has already
+# imported numpy; their peak RSS is the one of the benchmark process
+def bench_import_main(path, work_dir):
+    subprocess.run([sys.executable, '-c', 'import main'], cwd=REPO_DIR, check=True)
+
+
+def bench_main_help(path, work_dir):
+    subprocess.run([sys.executable, 'main.py', '--help'], cwd=REPO_DIR, check=True, stdout=subprocess.DEVNULL)
+
+
+BENCHMARKS = {
+    'import_main': bench_import_main,
+    'main_help': bench_main_help,
+    'parse_fastq': bench_parse_fastq,
+    'stat_read_fastq': bench_stat_read_fastq,
+    'stat_sequence': bench_stat_sequence,
+    'stat_sequence_lengths': bench_stat_sequence_lengths,
+    'stat_gc_content': bench_stat_gc_content,
+    'stat_mean_quality': bench_stat_mean_quality,
+    'stat_barcode_distribution': bench_stat_barcode_distribution,
+    'stat_calculate_metrics': bench_stat_calculate_metrics,
+    'stat_streaming_stats': bench_stat_streaming_stats,
+    'filter_fastq': bench_filter_fastq,
+    'main': bench_main,
+}
+
+
+def _run_in_child(name, path, work_dir, results):
+    try:
+        rss_before = peak_rss_mb()
+        start = time.perf_counter()
+        BENCHMARKS[name](path, work_dir)
+        wall = time.perf_counter() - start
+        results.put({'wall_s': wall, 'peak_rss_mb': peak_rss_mb(), 'rss_before_mb': rss_before})
+    except BaseException as e:
+        results.put({'error': f"{type(e).__name__}: {e}"})
+
+
+def run_benchmark(name, dataset, work_dir, repeat=1):
+    """Run one benchmark repeat times in fresh processes and keep the fastest run."""
+    context = multiprocessing.get_context('spawn')
+    best = None
+    for _ in range(repeat):
+        results = context.Queue()
+        process = context.Process(target=_run_in_child, args=(name, dataset['path'], work_dir, results))
+        process.start()
+        result = results.get()
+        process.join()
+        if 'error' in result:
+            return result
+        if best is None or result['wall_s'] < best['wall_s']:
+            best = result
+    best['reads_per_s'] = dataset['reads'] / best['wall_s'] if best['wall_s'] else 0
+    best['bases_per_s'] = dataset['bases'] / best['wall_s'] if best['wall_s'] else 0
+    return best
+
+
+def compare(results, baseline, ratio=REGRESSION_RATIO):
+    """Return (name, baseline wall, wall, slowdown) for every benchmark slower than ratio times the baseline."""
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        old = baseline.get('benchmarks', {}).get(name)
+        if not old or 'wall_s' not in old or 'wall_s' not in result:
+            continue
+        slowdown = result['wall_s'] / old['wall_s'] if old['wall_s'] else 0
+        if slowdown > ratio:
+            regressions.append((name, old['wall_s'], result['wall_s'], slowdown))
+    return regressions
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark the FASTQ parsing, statistics and filtering steps')
+    parser.add_argument('-n', '--reads', type=int, default=20000, help='Reads in the synthetic input. Default is 20000')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic input. Default is 0')
+    parser.add_argument('--mean_length', type=float, default=3000, help='Mean read length. Default is 3000')
+    parser.add_argument('--gzip', action='store_true', default=False, help='Benchmark a gzipped input')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per benchmark; the fastest is kept. Default is 1')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='Run only these benchmarks')
+    parser.add_argument('-o', '--output', default='benchmark_results.json', help='JSON file for the results')
+    parser.add_argument('--compare', metavar='BASELINE_JSON', help='Report regressions against an earlier results file')
+    parser.add_argument('--work_dir', help='Directory for the input and outputs (a temporary directory by default)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='filterfastq_bench_')
+    os.makedirs(work_dir, exist_ok=True)
+    input_path = os.path.join(work_dir, 'synthetic.fastq' + ('.gz' if args.gzip else ''))
+
+    print(f"Generating {args.reads} reads (seed {args.seed}) in {input_path}")
+    dataset = generate_fastq(input_path, reads=args.reads, seed=args.seed, mean_length=args.mean_length)
+    dataset['gzip'] = args.gzip
+
+    results = {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'dataset': dataset,
+        'benchmarks': {},
+    }
+    print(f"{'Benchmark':<28} {'Wall (s)':>10} {'Reads/s':>12} {'Mb/s':>10} {'Peak RSS (MB)':>14}")
+    for name in args.only or BENCHMARKS:
+        result = run_benchmark(name, dataset, work_dir, args.repeat)
+        results['benchmarks'][name] = result
+        if 'error' in result:
+            print(f"{name:<28} failed: {result['error']}")
+            continue
+        print(f"{name:<28} {result['wall_s']:>10.3f} {result['reads_per_s']:>12.0f} "
+              f"{result['bases_per_s'] / 1e6:>10.2f} {result['peak_rss_mb']:>14.1f}")
+
+    with open(args.output, 'w') as handle:
+        json.dump(results, handle, indent=2)
+    print(f"Results are saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as handle:
+            regressions = compare(results, json.load(handle))
+        for name, old, new, slowdown in regressions:
+            print(f"Regression in {name}: {old:.3f}s -> {new:.3f}s ({slowdown:.2f}x)")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+import argparse
+import gzip
+import numpy as np
+
+# Seeded generator of ONT-like FASTQ files for the benchmarks. The same seed
+# and parameters always give the same file.
+_BASES = np.frombuffer(b'ACGT', dtype=np.uint8)  # A/T and C/G pairs are picked below
+_N = ord('N')
+GENERATE_BATCH = 2000
+
+
+def make_barcodes(count, length, rng):
+    """Return count distinct random barcode sequences of the given length."""
+    barcodes = set()
+    while len(barcodes) < count:
+        barcodes.add(bytes(_BASES[rng.integers(0, 4, length)]))
+    return sorted(barcodes)
+
+
+def read_lengths(rng, reads, mean_length, length_sigma, min_length, max_length):
+    # Log-normal lengths (ONT-like long right tail) with the requested mean
+    mu = np.log(mean_length) - length_sigma ** 2 / 2
+    lengths = rng.lognormal(mu, length_sigma, reads)
+    return np.clip(np.rint(lengths), min_length, max_length).astype(np.int64)
+
+
+def generate_fastq(path, reads=10000, seed=0, mean_length=3000, length_sigma=0.9, min_length=1,
+                   max_length=200000, mean_quality=14.0, quality_sd=4.0, quality_decay=4.0,
+                   gc_mean=50.0, gc_sd=8.0, n_fraction=0.001, barcodes=None, n_barcodes=12,
+                   barcode_length=6, tag_fraction=0.9):
+    """Write a synthetic FASTQ file (gzip if path ends with .gz) and return a summary dict.
+
+    Every read has a log-normal length, a GC fraction drawn around gc_mean and
+    a mean quality drawn around mean_quality that falls by quality_decay along
+    the read. Reads start with one of the barcodes, and a tag_fraction of them
+    carry the matching 'barcode=barcodeNN' tag in their header.
+    """
+    rng = np.random.default_rng(seed)
+    barcodes = [barcode.encode() if isinstance(barcode, str) else barcode for barcode in barcodes] \
+        if barcodes else make_barcodes(n_barcodes, barcode_length, rng)
+    # Uneven barcode abundance, as in real runs
+    weights = rng.dirichlet(np.full(len(barcodes), 2.0))
+
+    lengths = read_lengths(rng, reads, mean_length, length_sigma, min_length, max_length)
+    bases_total = 0
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wb') as handle:
+        for first in range(0, reads, GENERATE_BATCH):
+            batch_lengths = lengths[first:first + GENERATE_BATCH]
+            handle.write(_generate_batch(
+                rng, first, batch_lengths, barcodes, weights, mean_quality, quality_sd,
+                quality_decay, gc_mean, gc_sd, n_fraction, tag_fraction
+            ))
+            bases_total += int(batch_lengths.sum())
+
+    return {
+        'path': path,
+        'reads': reads,
+        'bases': bases_total,
+        'seed': seed,
+        'mean_length': mean_length,
+        'barcodes': [barcode.decode() for barcode in barcodes],
+    }
+
+
+def _generate_batch(rng, first, lengths, barcodes, weights, mean_quality, quality_sd,
+                    quality_decay, gc_mean, gc_sd, n_fraction, tag_fraction):
+    count = len(lengths)
+    total = int(lengths.sum())
+    starts = np.zeros(count, dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    position = np.arange(total) - np.repeat(starts, lengths)
+
+    # Bases: G/C with the GC fraction of the read, otherwise A/T, and a few N
+    gc = np.clip(rng.normal(gc_mean, gc_sd, count), 0, 100) / 100
+    is_gc = rng.random(total) < np.repeat(gc, lengths)
+    pick = rng.integers(0, 2, total)
+    seq = np.where(is_gc, _BASES[1 + pick], _BASES[3 * pick])
+    seq[rng.random(total) < n_fraction] = _N
+
+    # Qualities: a mean per read, decreasing along the read, with per-base noise
+    read_quality = np.repeat(rng.normal(mean_quality, quality_sd, count), lengths)
+    relative = position / np.repeat(np.maximum(lengths, 1), lengths)
+    quality = read_quality + quality_decay * (0.5 - relative) + rng.normal(0, 3, total)
+    qual = (np.clip(np.rint(quality), 0, 60) + 33).astype(np.uint8)
+
+    groups = rng.choice(len(barcodes), count, p=weights)
+    tagged = rng.random(count) < tag_fraction
+    channels = rng.integers(1, 513, count)
+    seq_bytes = seq.astype(np.uint8).tobytes()
+    qual_bytes = qual.tobytes()
+
+    out = []
+    for number in range(count):
+        start, length = int(starts[number]), int(lengths[number])
+        barcode = barcodes[groups[number]]
+        read_seq = seq_bytes[start:start + length]
+        if length >= len(barcode):
+            read_seq = barcode + read_seq[len(barcode):]
+        header = f"@read{first + number:09d} runid=synthetic read={first + number} ch={channels[number]}"
+        if tagged[number]:
+            header += f" barcode=barcode{groups[number] + 1:02d}"
+        out.append(header.encode() + b'\n' + read_seq + b'\n+\n' + qual_bytes[start:start + length] + b'\n')
+    return b''.join(out)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Generate a seeded synthetic ONT-like FASTQ file')
+    parser.add_argument('output', help='Output FASTQ path (.gz for gzip)')
+    parser.add_argument('-n', '--reads', type=int, default=10000, help='Number of reads. Default is 10000')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed. Default is 0')
+    parser.add_argument('--mean_length', type=float, default=3000, help='Mean read length. Default is 3000')
+    parser.add_argument('--length_sigma', type=float, default=0.9, help='Sigma of the log-normal read lengths. Default is 0.9')
+    parser.add_argument('--mean_quality', type=float, default=14.0, help='Mean Phred quality. Default is 14')
+    parser.add_argument('--gc_mean', type=float, default=50.0, help='Mean GC content (%%). Default is 50')
+    parser.add_argument('--gc_sd', type=float, default=8.0, help='Spread of the GC content (%%). Default is 8')
+    parser.add_argument('--n_barcodes', type=int, default=12, help='Number of barcodes. Default is 12')
+    parser.add_argument('--barcode_length', type=int, default=6, help='Barcode length. Default is 6')
+    parser.add_argument('--tag_fraction', type=float, default=0.9,
+                        help='Fraction of reads with a barcode= header tag. Default is 0.9')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    summary = generate_fastq(
+        args.output, reads=args.reads, seed=args.seed, mean_length=args.mean_length,
+        length_sigma=args.length_sigma, mean_quality=args.mean_quality, gc_mean=args.gc_mean,
+        gc_sd=args.gc_sd, n_barcodes=args.n_barcodes, barcode_length=args.barcode_length,
+        tag_fraction=args.tag_fraction
+    )
+    print(f"Wrote {summary['reads']} reads ({summary['bases']} bases) to {summary['path']}")
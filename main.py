@@ -1,12 +1,32 @@
 import argparse
+import json
 import logging
 import os
+import shutil
 import sys
-import pandas as pd
-import matplotlib.pyplot as plt
-from src.parsing.parsing_fastq import FastqParser
-from src.statistic.statistic import FastqStat
-from src.filter.filter  import filter_fastq
+import subprocess
+from src.parsing.fastq_reader import NATIVE, READERS
+from src.parsing.compressed_io import COMPRESSIONS, output_path
+from src.parsing.barcodes import BarcodeWhitelist, DEFAULT_MAX_MISMATCHES, assignment_counts
+from src.statistic.report_data import REPORT_DATA_FILE, TOP_BARCODES, top_barcodes, write_report_data, load_report_data
+from src.pipeline.instrumentation import RunReport, profiled, REPORT_FILE, PROFILE_FILE, PROFILE_TEXT_FILE
+# The modules above do not import numpy; the pipeline modules are imported
+# once the arguments are parsed, so --help and argument errors return quickly
+from src.constants import (
+    DEFAULT_WINDOW_SIZE, PAIR_POLICIES, BOTH, DUPLICATE_METHODS, DEFAULT_MEMORY_MB, EXACT, METRICS_FORMATS, CSV,
+    QUALITY_PROFILE_FILE, QUALITY_HEATMAP_FILE, STATES, CHECKPOINT_FILE, POLL_INTERVAL, IDLE_TIMEOUT,
+    SAMPLE_FILE, CONFIDENCE, PER_FILE_SUMMARY, DEFAULT_CACHE_DIR,
+)
+
+# Options of the single-end outputs and run modes, which paired-end mode does not support
+PAIRED_UNSUPPORTED = (
+    'duplicates', 'remove_duplicates', 'duplicate_prefix', 'duplicate_memory', 'duplicate_fp_rate', 'expected_reads',
+    'barcode_length', 'header_barcode', 'barcode_whitelist', 'barcode_mismatches', 'demux', 'demux_gzip',
+    'max_open_files', 'threads', 'pipelined', 'top_barcodes', 'background_plots', 'quality_profile',
+    'quality_heatmap', 'report_only', 'metrics_format', 'per_file_summary', 'follow', 'poll_interval',
+    'idle_timeout', 'sample', 'sample_fraction', 'sample_tolerance', 'confidence', 'seed', 'index',
+    'cache_dir', 'cache_size',
+)
 
 #Set up logging
 def setup_logging(output_dir: str) -> None:
@@ -29,11 +49,25 @@ def parse_arguments():
     
     parser.add_argument(
                         '-i', '--input', 
-                        required =True , 
+                        required =False , 
                         metavar= 'INPUT_PATH',
-                        help =' Please choose path to  your input FASTQ file'
+                        help =' Please choose path to  your input FASTQ file, or a directory or quoted glob pattern of FASTQ files'
                         )
     
+    parser.add_argument(
+                        '-i2', '--input2',
+                        metavar= 'INPUT2_PATH',
+                        default=None,
+                        help='R2 FASTQ file of a paired-end library; --input is R1. The mates are filtered in lockstep into filtered_R1 and filtered_R2. The filter, trimming, --reader, --compress and --profile options apply; the other options are rejected'
+                        )
+
+    parser.add_argument(
+                        '--pair_policy',
+                        choices=PAIR_POLICIES,
+                        default=BOTH,
+                        help=f'With --input2, keep a pair when both mates or either mate pass the criteria. Default is {BOTH}'
+                        )
+
     parser.add_argument( 
                         '-o', '--output_dir',
                         required=True,
@@ -71,6 +105,121 @@ def parse_arguments():
                         help = 'The maximum GC content percentage to retain a sequence. Default is 60.0'
                       )
 
+    parser.add_argument(
+                        '--max_length',
+                        type=int,
+                        default=None,
+                        help='The maximum sequence length to retain. Not checked by default'
+                        )
+
+    parser.add_argument(
+                        '--max_n_fraction',
+                        type=float,
+                        default=None,
+                        help='The maximum fraction of N bases (0 to 1) to retain a sequence. Not checked by default'
+                        )
+
+    parser.add_argument(
+                        '--max_expected_errors',
+                        type=float,
+                        default=None,
+                        help='The maximum expected number of errors (sum of 10^(-Q/10)) to retain a sequence. Not checked by default'
+                        )
+
+    parser.add_argument(
+                        '--min_window_quality',
+                        type=float,
+                        default=None,
+                        help='The minimum mean quality of every sliding window of WINDOW_SIZE bases. Not checked by default'
+                        )
+
+    parser.add_argument(
+                        '--window_size',
+                        type=int,
+                        default=DEFAULT_WINDOW_SIZE,
+                        help=f'The length of the sliding window of --min_window_quality and --trim_window_quality. Default is {DEFAULT_WINDOW_SIZE}'
+                        )
+
+    parser.add_argument(
+                        '--trim_window_quality',
+                        type=float,
+                        default=None,
+                        help='Before filtering, cut every read after its last window of WINDOW_SIZE bases with at least this mean quality. Not trimmed by default'
+                        )
+
+    parser.add_argument(
+                        '--trim_quality',
+                        type=float,
+                        default=None,
+                        help='Before filtering, trim the 3\' end of every read where the sum of (TRIM_QUALITY - Q) is largest (like BWA -q). Not trimmed by default'
+                        )
+
+    parser.add_argument(
+                        '--adapter',
+                        metavar='SEQUENCE',
+                        default=None,
+                        help='Before filtering, clip this adapter from the start of the reads that start with it. Not clipped by default'
+                        )
+
+    parser.add_argument(
+                        '--adapter_mismatches',
+                        type=int,
+                        default=None,
+                        help='Mismatches allowed when matching --adapter. Default is one per 10 adapter bases'
+                        )
+
+    parser.add_argument(
+                        '--adaptive_filter',
+                        action='store_true',
+                        default=False,
+                        help='Reorder the filter criteria during the run so the ones rejecting the most reads per cost run first. Saves work with --max_expected_errors or --min_window_quality'
+                        )
+
+    parser.add_argument(
+                        '--duplicates',
+                        choices=DUPLICATE_METHODS,
+                        default=None,
+                        help='Count duplicate reads among the reads passing the filter, with an exact hash set or a Bloom filter. Not checked by default'
+                        )
+
+    parser.add_argument(
+                        '--remove_duplicates',
+                        action='store_true',
+                        default=False,
+                        help=f'Leave the duplicates out of the filtered outputs (first copy kept); uses --duplicates {EXACT} unless given'
+                        )
+
+    parser.add_argument(
+                        '--duplicate_prefix',
+                        metavar='LENGTH',
+                        type=int,
+                        default=0,
+                        help='Compare the barcode and the first LENGTH bases instead of the whole sequence. Default is 0 (whole sequence)'
+                        )
+
+    parser.add_argument(
+                        '--duplicate_memory',
+                        metavar='MEGABYTES',
+                        type=int,
+                        default=DEFAULT_MEMORY_MB,
+                        help=f'Size of the Bloom filter, and the most the exact hash set may use before it becomes one. Default is {DEFAULT_MEMORY_MB}'
+                        )
+
+    parser.add_argument(
+                        '--duplicate_fp_rate',
+                        metavar='RATE',
+                        type=float,
+                        default=None,
+                        help='Size the Bloom filter for this false positive rate at --expected_reads instead of --duplicate_memory'
+                        )
+
+    parser.add_argument(
+                        '--expected_reads',
+                        type=int,
+                        default=None,
+                        help='Number of reads the Bloom filter is sized for. Default is estimated from the input'
+                        )
+
     parser.add_argument (
                         '-bc_l' , '--barcode_length',
                         metavar= 'LENGTH_OF_BARCODE_SEQUENCE',
@@ -85,10 +234,243 @@ def parse_arguments():
                         default =False,
                         help =' Enable this function to Identify  group of barcode at header sequence'
                         )
-    return parser.parse_args()                    
+
+    parser.add_argument(
+                        '--barcode_whitelist',
+                        metavar='WHITELIST_FILE',
+                        default=None,
+                        help="File with one 'barcode' or 'name barcode' per line. Read barcodes are assigned to the closest whitelist barcode"
+                        )
+
+    parser.add_argument(
+                        '--barcode_mismatches',
+                        type=int,
+                        default=DEFAULT_MAX_MISMATCHES,
+                        help=f'The maximum number of mismatches when assigning a barcode to the whitelist. Default is {DEFAULT_MAX_MISMATCHES}'
+                        )
+
+    parser.add_argument(
+                        '--reader',
+                        choices=READERS,
+                        default=NATIVE,
+                        help='FASTQ reader to use: the fast byte-level native reader or Bio.SeqIO. Default is native'
+                        )
+
+    parser.add_argument(
+                        '--demux',
+                        action='store_true',
+                        default=False,
+                        help='Write every read to a FASTQ file per barcode group (header barcode=) in OUTPUT_PATH/demux'
+                        )
+
+    parser.add_argument(
+                        '--demux_gzip',
+                        action='store_true',
+                        default=False,
+                        help='Compress the demultiplexed FASTQ files with gzip'
+                        )
+
+    parser.add_argument(
+                        '--max_open_files',
+                        type=int,
+                        default=64,
+                        help='The maximum number of demultiplexed files kept open at the same time. Default is 64'
+                        )
+
+    parser.add_argument(
+                        '-t', '--threads',
+                        metavar='NUMBER_OF_PROCESSES',
+                        type=int,
+                        default=1,
+                        help='Number of processes used to filter and analyse record chunks in parallel. Default is 1'
+                        )
+
+    parser.add_argument(
+                        '--pipelined',
+                        action='store_true',
+                        default=False,
+                        help='With one process, parse on a reader thread and write on a writer thread around the filtering and statistics'
+                        )
+
+    parser.add_argument(
+                        '--top_barcodes',
+                        metavar='K',
+                        type=int,
+                        default=TOP_BARCODES,
+                        help=f'Pie charts show the K largest barcodes and an "other" slice; 0 shows every barcode. Default is {TOP_BARCODES}'
+                        )
+
+    parser.add_argument(
+                        '--no-plots', '--no_plots',
+                        dest='no_plots',
+                        action='store_true',
+                        default=False,
+                        help=f'Do not render the pie charts; they can be rendered later from {REPORT_DATA_FILE} with --report-only'
+                        )
+
+    parser.add_argument(
+                        '--background_plots',
+                        action='store_true',
+                        default=False,
+                        help='Render the pie charts in a background process and return as soon as the processing is done'
+                        )
+
+    parser.add_argument(
+                        '--quality_profile',
+                        action='store_true',
+                        default=False,
+                        help=f'Save per-position (from the 5\' and the 3\' end) and length-binned quality histograms, overall and per barcode, to {QUALITY_PROFILE_FILE}. With trimming, of the trimmed reads'
+                        )
+
+    parser.add_argument(
+                        '--quality_heatmap',
+                        action='store_true',
+                        default=False,
+                        help='Also render the per-position quality profile as a heatmap (implies --quality_profile)'
+                        )
+
+    parser.add_argument(
+                        '--report-only', '--report_only',
+                        dest='report_only',
+                        action='store_true',
+                        default=False,
+                        help=f'Only render the pie charts from the {REPORT_DATA_FILE} of an earlier run in OUTPUT_PATH (no input needed)'
+                        )
+
+    parser.add_argument(
+                        '--metrics_format',
+                        choices=METRICS_FORMATS,
+                        default=CSV,
+                        help='Format of the per-read statistics: CSV, Parquet (needs pyarrow, otherwise npy) or a directory of memory-mappable .npy columns. Default is csv'
+                        )
+
+    parser.add_argument(
+                        '--per_file_summary',
+                        action='store_true',
+                        default=False,
+                        help=f'With a directory or glob input, also write {PER_FILE_SUMMARY} with the counts and statistics of every file'
+                        )
+
+    parser.add_argument(
+                        '--follow',
+                        action='store_true',
+                        default=False,
+                        help=f'Tail a FASTQ file that is still being written and process the appended records; resumes from OUTPUT_PATH/{CHECKPOINT_FILE}'
+                        )
+
+    parser.add_argument(
+                        '--poll_interval',
+                        metavar='SECONDS',
+                        type=float,
+                        default=POLL_INTERVAL,
+                        help=f'Seconds between two checks for new records in follow mode. Default is {POLL_INTERVAL}'
+                        )
+
+    parser.add_argument(
+                        '--idle_timeout',
+                        metavar='SECONDS',
+                        type=float,
+                        default=IDLE_TIMEOUT,
+                        help=f'Stop follow mode when the input has not grown for this many seconds. Default is {IDLE_TIMEOUT}'
+                        )
+
+    sample = parser.add_mutually_exclusive_group()
+    sample.add_argument(
+                        '--sample',
+                        metavar='N',
+                        type=int,
+                        default=None,
+                        help=f'Preview: estimate the statistics and the pass rate from a uniform sample of N reads and save them to {SAMPLE_FILE}; no other outputs are written'
+                        )
+
+    sample.add_argument(
+                        '--sample-fraction', '--sample_fraction',
+                        dest='sample_fraction',
+                        metavar='FRACTION',
+                        type=float,
+                        default=None,
+                        help='Preview like --sample, from a uniform sample of this fraction of the reads'
+                        )
+
+    parser.add_argument(
+                        '--sample_tolerance',
+                        metavar='PERCENT',
+                        type=float,
+                        default=None,
+                        help='Stop sampling early once every mean is known within PERCENT %% and every percentage within PERCENT points (plain or indexed input)'
+                        )
+
+    parser.add_argument(
+                        '--confidence',
+                        type=float,
+                        default=CONFIDENCE,
+                        help=f'Confidence level of the sample intervals. Default is {CONFIDENCE}'
+                        )
+
+    parser.add_argument(
+                        '--seed',
+                        type=int,
+                        default=None,
+                        help='Random seed of the sample'
+                        )
+
+    parser.add_argument(
+                        '--index',
+                        action='store_true',
+                        default=False,
+                        help='Build (or reuse) the INPUT.fqi offset index and let the parallel processes read their own chunks (plain or BGZF input; gzip input is not indexed)'
+                        )
+
+    parser.add_argument(
+                        '--compress',
+                        choices=COMPRESSIONS,
+                        default=None,
+                        help='Write the filtered FASTQ as filtered.fastq.gz, compressed with gzip or BGZF on several threads'
+                        )
+
+    parser.add_argument(
+                        '--profile',
+                        action='store_true',
+                        default=False,
+                        help=f'Profile the single pass with cProfile and save {PROFILE_FILE} and {PROFILE_TEXT_FILE} in OUTPUT_PATH'
+                        )
+
+    parser.add_argument(
+                        '--no-cache', '--no_cache',
+                        dest='no_cache',
+                        action='store_true',
+                        default=False,
+                        help='Do not reuse or store the per-read metrics in the result cache. A cache hit skips measuring the reads and the original statistics; the input is still read to write the filtered FASTQ'
+                        )
+
+    parser.add_argument(
+                        '--cache_dir',
+                        default=DEFAULT_CACHE_DIR,
+                        help=f'Directory of the result cache. An entry takes about 32 bytes per read plus a copy of original_statistics.csv. Default is {DEFAULT_CACHE_DIR}'
+                        )
+
+    parser.add_argument(
+                        '--cache_size',
+                        metavar='MEGABYTES',
+                        type=float,
+                        default=2048,
+                        help='Maximum size of the result cache in MB (fractions allowed); least recently used entries are removed. Default is 2048'
+                        )
+    args = parser.parse_args()
+    if args.input is None and not args.report_only:
+        parser.error("the following arguments are required: -i/--input")
+    if args.input2:
+        unsupported = [option for option in PAIRED_UNSUPPORTED if getattr(args, option) != parser.get_default(option)]
+        if unsupported:
+            parser.error(f"paired-end mode (--input2) does not support --{', --'.join(unsupported)}")
+    return args
 
 # Pie chart
-def pie_chart (distribution, title, output):   #distribution = dis 
+def pie_chart (distribution, title, output, top_k=TOP_BARCODES):   #distribution = dis 
+    # pyplot takes most of the start-up time, so it is only imported to draw
+    import matplotlib.pyplot as plt
+
+    distribution = top_barcodes(distribution, top_k)
     labels = list(distribution.keys())
     sizes = list(distribution.values())
 
@@ -108,117 +490,502 @@ def pie_chart (distribution, title, output):   #distribution = dis
     plt.close()
     logging.info(f"Pie chart is saved to {output}")
 
+# Heatmap of the share of bases per Phred score at every position, from the 5' start and the 3' end
+def quality_heatmap(profile_path, output, state=STATES[0]):
+    import matplotlib.pyplot as plt
+    import numpy as np
+    from src.statistic.quality_profile import load_quality_profile, mean_phred
+
+    profile = load_quality_profile(profile_path)
+    edges = profile['position_edges']
+    index = STATES.index(state)
+    figure, axes = plt.subplots(1, 2, figsize=(14, 6), sharey=True)
+    for axis, name, label in ((axes[0], 'from_start', "Position from the 5' start"),
+                              (axes[1], 'from_end', "Position from the 3' end")):
+        counts = profile[name][:, index].sum(axis=0)
+        used = np.flatnonzero(counts.sum(axis=1))
+        positions = used[-1] + 1 if used.size else 1
+        phred = max(int(np.flatnonzero(counts.sum(axis=0))[-1]) + 2 if used.size else 2, 2)
+        counts = counts[:positions, :phred]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            share = np.where(counts.sum(axis=1, keepdims=True) > 0, counts / counts.sum(axis=1, keepdims=True), 0)
+        # Positions are shown on a log scale (+1 so the first base is at 1)
+        x = np.append(edges[:positions], edges[positions] if positions < len(edges) else edges[-1] * 2) + 1
+        mesh = axis.pcolormesh(x, np.arange(phred + 1), share.T, cmap='viridis', shading='flat')
+        axis.plot((x[:-1] + x[1:]) / 2, mean_phred(counts), color='white', linewidth=1, label='Mean quality')
+        axis.set_xscale('log')
+        axis.set_xlabel(f"{label} (bases)")
+        if name == 'from_end':
+            axis.invert_xaxis()
+    axes[0].set_ylabel('Phred quality score')
+    axes[0].legend(loc='lower left')
+    figure.colorbar(mesh, ax=axes, label='Share of the bases at the position')
+    figure.suptitle(f"Per-position quality ({state} reads)")
+    plt.savefig(output)
+    plt.close(figure)
+    logging.info(f"Quality heatmap is saved to {output}")
+
+# Render both pie charts (and the quality heatmap) from the report data of an earlier run
+def render_report(output_dir, top_k=TOP_BARCODES, heatmap=False):
+    from src.statistic.statistic import FastqStat
+
+    data = load_report_data(os.path.join(output_dir, REPORT_DATA_FILE))
+    pie_chart(
+        distribution= FastqStat.barcode_distribution(data['original']['barcodes']),
+        title       = 'Original Barcode Distribution',
+        output      = os.path.join(output_dir, 'original_barcode_distribtion_piechart.png'),
+        top_k       = top_k
+    )
+    pie_chart(
+        distribution= FastqStat.barcode_distribution(data['filtered']['barcodes']),
+        title       = 'Filtered Barcode Distribution',
+        output      = os.path.join(output_dir, 'filtered_barcode_distribution_piechart.png'),
+        top_k       = top_k
+    )
+    if heatmap:
+        quality_heatmap(
+            os.path.join(output_dir, QUALITY_PROFILE_FILE), os.path.join(output_dir, QUALITY_HEATMAP_FILE)
+        )
+
+# Summary of the streaming statistics
+def log_summary(label, stats):
+    summary = stats.summary()
+    logging.info(
+        f"{label} summary: {summary['reads']} reads, {summary['bases']} bases, "
+        f"mean length {summary['mean_length']:.2f}, N50 {summary['n50']:.0f}, "
+        f"mean GC content {summary['mean_gc_content']:.2f}%, mean quality score {summary['mean_quality_score']:.2f}"
+    )
+    if summary['trimmed_reads']:
+        logging.info(f"{label} reads trimmed: {summary['trimmed_reads']} reads, {summary['trimmed_bases']} bases")
+
+# Paired-end mode: only the synchronized filtered FASTQ files and the run report are written
+def run_paired(args, report, run_report, trimmer=None):
+    from src.pipeline.multi_file import is_multi_input
+    from src.filter.paired import filter_paired_fastq, MATES
+
+    report.info['input2'] = args.input2
+    filtered_fastqs = [
+        output_path(os.path.join(args.output_dir, f"filtered_{mate}.fastq"), args.compress) for mate in MATES
+    ]
+    try:
+        if is_multi_input(args.input) or is_multi_input(args.input2):
+            raise ValueError("Paired-end mode needs one R1 and one R2 FASTQ file")
+        logging.info(f"Beginning paired-end filtering of {args.input} and {args.input2}")
+        logging.info("Statistics, pie charts and the other single-end outputs are not written in paired-end mode")
+        with profiled(args.profile, os.path.join(args.output_dir, PROFILE_FILE),
+                      os.path.join(args.output_dir, PROFILE_TEXT_FILE)):
+            total_pairs, passed_pairs = filter_paired_fastq(
+                args.input, args.input2, *filtered_fastqs,
+                quality_threshold= args.quality_threshold,
+                min_length= args.min_length,
+                gc_min= args.gc_minimum,
+                gc_max= args.gc_maximum,
+                policy= args.pair_policy,
+                reader= args.reader,
+                compress= args.compress,
+                report= report,
+                max_length= args.max_length,
+                max_n_fraction= args.max_n_fraction,
+                max_expected_errors= args.max_expected_errors,
+                window_quality= args.min_window_quality,
+                window_size= args.window_size,
+                adaptive= args.adaptive_filter,
+                trimmer= trimmer
+            )
+    except Exception as e:
+        logging.error(f"Error during paired-end filtering : {e}")
+        write_run_report(report, run_report, "failed", e)
+        sys.exit(1)
+
+    passed_percentage = passed_pairs/total_pairs *100 if total_pairs else 0
+    logging.info(f'Number of pairs in the original FASTQ files: {total_pairs}(100.00%)')
+    logging.info(f'Number of pairs after filtering: {passed_pairs}({passed_percentage:.2f}%)')
+    logging.info(f'Number of pairs failed filtering: {total_pairs - passed_pairs}')
+    counters = report.counters
+    logging.info(
+        f"Pairs with both mates passing: {counters['both_mates_passed']}, only R1: {counters['only_r1_passed']}, "
+        f"only R2: {counters['only_r2_passed']}"
+    )
+    for reason, count in report.rejections.items():
+        logging.info(f'Rejected ({reason}): {count}')
+    if trimmer is not None:
+        log_trimmed(report.counters)
+    for mate, path in zip(MATES, filtered_fastqs):
+        logging.info(f"Filtered {mate} reads are saved to {path}")
+    write_run_report(report, run_report, "completed")
+    logging.info("Processing Completed Successfully.")
+
+def log_quality_profile(summary):
+    for state in STATES:
+        values = summary['overall'][state]
+        logging.info(
+            f"Mean quality score of the {state} reads: {values['mean_quality_first_100']:.2f} in the first 100 bases, "
+            f"{values['mean_quality_last_100']:.2f} in the last 100 bases"
+        )
+        for length_bin in values['length_bins']:
+            upper = length_bin['max_length'] if length_bin['max_length'] is not None else ''
+            logging.info(
+                f"{state.capitalize()} reads of {length_bin['min_length']}-{upper} bases: {length_bin['reads']} reads, "
+                f"mean GC content {length_bin['mean_gc_content']:.2f}%, "
+                f"mean quality score {length_bin['mean_quality_score']:.2f}"
+            )
+
+def log_trimming(trimmer):
+    if trimmer.adapter:
+        logging.info(f"Adapter {trimmer.adapter} is clipped with up to {trimmer.max_mismatches} mismatches")
+    if trimmer.window_quality is not None:
+        logging.info(f"3' ends are trimmed after the last {trimmer.window_size} base window of mean quality {trimmer.window_quality}")
+    if trimmer.mott_quality is not None:
+        logging.info(f"3' ends are trimmed at quality {trimmer.mott_quality} (Mott)")
+
+def log_trimmed(counters):
+    logging.info(
+        f"Adapter clipped from {counters['adapter_clipped_reads']} reads ({counters['adapter_clipped_bases']} bases), "
+        f"3' ends trimmed from {counters['quality_trimmed_reads']} reads ({counters['quality_trimmed_bases']} bases)"
+    )
+
+def log_duplicates(summary):
+    logging.info(
+        f"Duplicates ({summary['method']}, {summary['memory_bytes'] / 1024 ** 2:.1f} MB, "
+        f"false positive rate {summary['false_positive_rate']:.2e}): {summary['duplicates']} of "
+        f"{summary['reads_checked']} reads passing the criteria ({summary['duplication_rate_percent']:.2f}%)"
+    )
+    for group, counts in summary['per_barcode'].items():
+        logging.info(
+            f"Duplicates of barcode {group}: {counts['duplicates']} of {counts['reads']} "
+            f"({counts['duplication_rate_percent']:.2f}%)"
+        )
+
+def log_sample_estimates(estimates):
+    def interval(values, unit=''):
+        return f"{values['estimate']:.2f}{unit} [{values['low']:.2f}, {values['high']:.2f}]"
+
+    total = estimates['total_reads']
+    total = f"~{interval(total)}" if isinstance(total, dict) else total
+    logging.info(
+        f"Sampled {estimates['sampled_reads']} reads ({estimates['method']}) of {total} reads, "
+        f"{estimates['confidence'] * 100:g}% confidence intervals"
+        + (", stopped early" if estimates['stopped_early'] else "")
+    )
+    logging.info(f"Estimated mean length: {interval(estimates['mean_length'])}")
+    logging.info(f"Estimated mean GC content: {interval(estimates['mean_gc_content'], '%')}")
+    logging.info(f"Estimated mean quality score: {interval(estimates['mean_quality_score'])}")
+    logging.info(f"Estimated pass rate: {interval(estimates['pass_rate_percent'], '%')}")
+    for reason, values in estimates['failing_percent'].items():
+        logging.info(f"Estimated failing ({reason}): {interval(values, '%')}")
+    for barcode, values in estimates['barcode_percent'].items():
+        logging.info(f"Estimated barcode {barcode}: {interval(values, '%')}")
+
+# Machine-readable report next to processing.log
+def write_run_report(report, path, status, error=None):
+    report.info['status'] = status
+    if error is not None:
+        report.info['error'] = str(error)
+    try:
+        report.write(path)
+        logging.info(f"Run report is saved to {path}")
+    except Exception as e:
+        logging.error(f"Error during writing the run report : {e}")
+
 #Set up main
 
 def main():
 
     args = parse_arguments()
+    from src.pipeline.fused import FusedPipeline
+    from src.pipeline.result_cache import ResultCache, ORIGINAL_CHART
+    from src.pipeline.multi_file import MultiFileRunner, expand_inputs, is_multi_input, PARTS_DIR
+    from src.pipeline.follow import FollowRunner
+    from src.pipeline.sampling import SamplePreview
+    from src.statistic.columnar_writer import resolve_format, metrics_path
+    from src.filter.trimming import Trimmer
+    from src.filter.duplicates import DuplicateDetector, DUPLICATE_REASON, estimate_reads
 
     # Checking existed output directory
     os.makedirs(args.output_dir ,exist_ok =True)
 
     setup_logging(args.output_dir)
 
+    if args.report_only:
+        try:
+            render_report(args.output_dir, args.top_barcodes, args.quality_heatmap)
+        except Exception as e:
+            logging.error(f"Error during rendering the report : {e}")
+            sys.exit(1)
+        logging.info("Report rendering Completed Successfully.")
+        return
+
     logging.info(f"Beginning processing with FASTQ file : {args.input}")
 
     # Output file paths
     stat_ori_csv = os.path.join(args.output_dir,'original_statistics.csv')
     stat_fil_csv = os.path.join(args.output_dir,'filtered_statistics.csv')
+    # Columnar statistics are written instead of the CSV files
+    metrics_format = resolve_format(args.metrics_format)
+    stat_ori_columns = stat_fil_columns = None
+    if metrics_format != CSV:
+        stat_ori_csv = stat_ori_columns = metrics_path(args.output_dir, 'original_statistics', metrics_format)
+        stat_fil_csv = stat_fil_columns = metrics_path(args.output_dir, 'filtered_statistics', metrics_format)
     piechart_ori = os.path.join(args.output_dir, 'original_barcode_distribtion_piechart.png')
     piechart_fil = os.path.join(args.output_dir,'filtered_barcode_distribution_piechart.png')
-    filtered_fastq = os.path.join(args.output_dir,f"filtered.fastq")
-
-    # Step 1: Parsing and Calculating Statistical of Original FASTQ File.
-    try:
-        logging.info("Beginning FASTQ parsing (Original Data)....")
-        parser = FastqParser(args.input)
-        parser.parse_fastq()
-    
-        grouped_sequences = parser.get_grouped_sequences()
-        logging.info(f"Parsed {len(grouped_sequences)} groups from the original FASTQ file.")
-
-        logging.info("Generating statistics for Original Data....")
-        stat_cal_original = FastqStat(args.input) # args.input = Original FASTq file.
-        metrics_original = stat_cal_original.calculate_metrics(
-                           barcode_length = args.barcode_length,
-                           header_barcode =args.header_barcode
+    filtered_fastq = output_path(os.path.join(args.output_dir,f"filtered.fastq"), args.compress)
+    demux_dir = os.path.join(args.output_dir, 'demux')
+    run_report = os.path.join(args.output_dir, REPORT_FILE)
+
+    report = RunReport()
+    report.info['input'] = args.input
+    report.info['arguments'] = vars(args)
+
+    # The input of follow mode is still growing, so it is never cached
+    cache = None if args.no_cache or args.follow else ResultCache(args.cache_dir, int(args.cache_size * 1024 * 1024))
+
+    whitelist = None
+    if args.barcode_whitelist:
+        try:
+            whitelist = BarcodeWhitelist.load(args.barcode_whitelist, args.barcode_mismatches)
+        except Exception as e:
+            logging.error(f"Error during loading the barcode whitelist : {e}")
+            write_run_report(report, run_report, "failed", e)
+            sys.exit(1)
+        logging.info(
+            f"Loaded {len(whitelist)} whitelist barcodes of length {whitelist.barcode_length} "
+            f"({whitelist.ambiguous_sequences()} ambiguous sequences within {args.barcode_mismatches} mismatches)"
         )
-        # Tranform data to CSV file by using pandas
-        df_ori = pd.DataFrame(metrics_original)
-        df_ori.to_csv(stat_ori_csv, index =False)
-        logging.info (f"Original statistics is saved to {stat_ori_csv}.")
 
-        # Create pie chart for orignal barcode distribution
-        barcode_dist_original = stat_cal_original.calculate_barcode_distribution(
-                                barcode_length= args.barcode_length,
-                                header_barcode =args.header_barcode
-        )
-        pie_chart(
-            distribution= barcode_dist_original,
-            title       = 'Original Barcode Distribution',
-            output      = piechart_ori
-        )
-        
-    except Exception as e:
-        logging.error(f"Error during parsing or calculating statistics (Original Data) : {e}")
-        sys.exit(1)
-
-#Step 2: Filtering
+    trimmer = None
+    if args.trim_window_quality is not None or args.trim_quality is not None or args.adapter:
+        try:
+            trimmer = Trimmer(
+                args.trim_window_quality, args.window_size, args.trim_quality, args.adapter, args.adapter_mismatches
+            )
+        except Exception as e:
+            logging.error(f"Error during setting up the trimming : {e}")
+            write_run_report(report, run_report, "failed", e)
+            sys.exit(1)
+        log_trimming(trimmer)
+
+    if args.input2:
+        run_paired(args, report, run_report, trimmer)
+        return
+
+    duplicates = None
+    if args.duplicates or args.remove_duplicates:
+        try:
+            expected_reads = args.expected_reads or estimate_reads(expand_inputs(args.input))
+            duplicates = DuplicateDetector(
+                args.duplicates or EXACT, args.duplicate_memory * 1024 * 1024, expected_reads,
+                args.duplicate_fp_rate, args.duplicate_prefix, args.remove_duplicates
+            )
+        except Exception as e:
+            logging.error(f"Error during setting up the duplicate detection : {e}")
+            write_run_report(report, run_report, "failed", e)
+            sys.exit(1)
+
+    # Step 1: Parsing, Calculating Statistical and Filtering in a single pass over the FASTQ File.
     try:
-        logging.info("Beginning FASTQ filtering....")
-        total_sequences, passed_sequences = filter_fastq(
+        logging.info("Beginning single-pass FASTQ parsing, statistics and filtering....")
+        pipeline = FusedPipeline(
             input_file= args.input,
             output_file= filtered_fastq,
+            barcode_length= args.barcode_length,
+            header_barcode= args.header_barcode,
             quality_threshold= args.quality_threshold,
             min_length= args.min_length,
             gc_min = args.gc_minimum,
-            gc_max= args.gc_maximum
+            gc_max= args.gc_maximum,
+            reader= args.reader,
+            threads= args.threads,
+            original_csv= stat_ori_csv if metrics_format == CSV else None,
+            filtered_csv= stat_fil_csv if metrics_format == CSV else None,
+            original_columns= stat_ori_columns,
+            filtered_columns= stat_fil_columns,
+            columns_format= metrics_format if metrics_format != CSV else None,
+            demux_dir= demux_dir if args.demux else None,
+            demux_compress= args.demux_gzip,
+            max_open_files= args.max_open_files,
+            use_index= args.index,
+            cache= cache,
+            compress= args.compress,
+            report= report,
+            whitelist= whitelist,
+            max_length= args.max_length,
+            max_n_fraction= args.max_n_fraction,
+            max_expected_errors= args.max_expected_errors,
+            window_quality= args.min_window_quality,
+            window_size= args.window_size,
+            adaptive_filter= args.adaptive_filter,
+            pipelined= args.pipelined,
+            duplicates= duplicates,
+            quality_profile= args.quality_profile or args.quality_heatmap,
+            trimmer= trimmer
         )
-        failed_sequences = total_sequences - passed_sequences 
-        passed_percentage = passed_sequences/total_sequences *100 if total_sequences else 0
-        failed_percentage = failed_sequences/total_sequences *100 if total_sequences else 0
-        logging.info(f'Number of sequences in original FASTQ: {total_sequences}(100.00%)')
-        logging.info(f'Number of sequences after filtering: {passed_sequences}({passed_percentage:.2f}%)')
-        logging.info(f'Number of sequences failed filtering: {failed_sequences} ({failed_percentage:.2f}%)')
-
-    except Exception as e: 
-        logging.error(f" Error during filtering: {e}")
+        profile_stats = os.path.join(args.output_dir, PROFILE_FILE)
+        if args.sample is not None or args.sample_fraction is not None:
+            # Preview mode: only the estimates are written
+            preview = SamplePreview(
+                pipeline, args.sample, args.sample_fraction, args.sample_tolerance, args.confidence, args.seed
+            )
+            estimates = preview.run()
+            sample_file = os.path.join(args.output_dir, SAMPLE_FILE)
+            with open(sample_file, 'w') as handle:
+                json.dump(estimates, handle, indent=2)
+            log_sample_estimates(estimates)
+            logging.info(f"Sample estimates are saved to {sample_file}")
+            report.info['sample'] = estimates
+            write_run_report(report, run_report, "completed")
+            return
+        with profiled(args.profile, profile_stats, os.path.join(args.output_dir, PROFILE_TEXT_FILE)):
+            if is_multi_input(args.input):
+                if args.follow:
+                    raise ValueError("--follow needs a single input file")
+                runner = MultiFileRunner(
+                    pipeline, expand_inputs(args.input), args.threads, os.path.join(args.output_dir, PARTS_DIR),
+                    os.path.join(args.output_dir, PER_FILE_SUMMARY) if args.per_file_summary else None
+                )
+                report.info['inputs'] = runner.inputs
+                total_sequences, passed_sequences = runner.run()
+            elif args.follow:
+                follower = FollowRunner(
+                    pipeline, os.path.join(args.output_dir, CHECKPOINT_FILE), args.poll_interval, args.idle_timeout
+                )
+                total_sequences, passed_sequences = follower.run()
+            else:
+                total_sequences, passed_sequences = pipeline.run()
+        if args.profile:
+            logging.info(f"Profile is saved to {profile_stats}")
+    except Exception as e:
+        logging.error(f"Error during parsing, calculating statistics or filtering : {e}")
+        write_run_report(report, run_report, "failed", e)
         sys.exit(1)
 
-    # Step 3 :Parsing and Calculating Statistical of Filtered FASTQ File.
+    # Compact summary data for rendering the pie charts later or in the background
+    plots = not (args.no_plots or args.background_plots)
     try:
-        logging.info("Beginning FASTQ parsing (Filtereed Data)....")
-        parser_filtered = FastqParser(filtered_fastq)
-        parser_filtered.parse_fastq()
-        grouped_sequences_filtered = parser_filtered.get_grouped_sequences()
-        logging.info( f"Parsed {len(grouped_sequences_filtered)} groups from the filtered FASTQ file.")
-
-        logging.info("Generating statistics for Filtered Data....")
-        stat_cal_filtered = FastqStat(filtered_fastq)
-        metrics_filtered = stat_cal_filtered.calculate_metrics(
-                            barcode_length= args.barcode_length,
-                            header_barcode = args.header_barcode
+        write_report_data(
+            os.path.join(args.output_dir, REPORT_DATA_FILE), pipeline.original_stats, pipeline.filtered_stats,
+            {'input': args.input, 'total': total_sequences, 'passed': passed_sequences}
         )
+    except Exception as e:
+        logging.error(f"Error during writing the report data : {e}")
+        write_run_report(report, run_report, "failed", e)
+        sys.exit(1)
+    if pipeline.quality_profile is not None:
+        try:
+            profile_file = os.path.join(args.output_dir, QUALITY_PROFILE_FILE)
+            pipeline.quality_profile.write(profile_file)
+            profile_summary = pipeline.quality_profile.summary()
+            report.info['quality_profile'] = profile_summary
+            log_quality_profile(profile_summary)
+            logging.info(f"Quality profile is saved to {profile_file}")
+        except Exception as e:
+            logging.error(f"Error during writing the quality profile : {e}")
+            write_run_report(report, run_report, "failed", e)
+            sys.exit(1)
+    if args.background_plots:
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--report-only', '-o', args.output_dir,
+             '--top_barcodes', str(args.top_barcodes)] + (['--quality_heatmap'] if args.quality_heatmap else []),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True
+        )
+        logging.info("Pie charts are rendered in a background process")
+    elif args.no_plots:
+        logging.info(f"Pie charts are skipped; render them with --report-only -o {args.output_dir}")
+
+    # Step 2: Statistical output of Original FASTQ File.
+    try:
+        grouped_sequences = pipeline.original_parser.get_grouped_sequences()
+        logging.info(f"Parsed {len(grouped_sequences)} groups from the original FASTQ file.")
+        if whitelist is not None:
+            if args.header_barcode:
+                # The statistics use the header barcodes; the whitelist applies to the parsed groups
+                counts = {}
+                for data in grouped_sequences.values():
+                    counts[data['barcode_seq']] = counts.get(data['barcode_seq'], 0) + data['count']
+            else:
+                counts = pipeline.original_stats.barcodes
+            assignment = assignment_counts(counts)
+            report.info['barcode_assignment'] = assignment
+            logging.info(
+                f"Barcode assignment: {assignment['assigned']} assigned, "
+                f"{assignment['ambiguous']} ambiguous, {assignment['unassigned']} unassigned"
+            )
+        if pipeline.demux is not None:
+            for group, count in pipeline.demux.counts.items():
+                logging.info(f"Demultiplexed {count} reads of group {group} to {pipeline.demux.group_path(group)}")
+
+        # Per-read metrics were streamed to the CSV file (or the columns) during the pass
+        logging.info (f"Original statistics is saved to {stat_ori_csv}.")
+        log_summary('Original', pipeline.original_stats)
+
+        # Create pie chart for orignal barcode distribution, or copy it from the result cache
+        entry = pipeline.cache_entry
+        cached_chart = ORIGINAL_CHART.format(top_k=args.top_barcodes)
+        if not plots:
+            pass
+        elif entry is not None and os.path.isfile(entry.file(cached_chart)):
+            shutil.copyfile(entry.file(cached_chart), piechart_ori)
+            logging.info(f"Pie chart is copied from the cache to {piechart_ori}")
+        else:
+            with report.stage("plot"):
+                pie_chart(
+                    distribution= pipeline.get_original_distribution(),
+                    title       = 'Original Barcode Distribution',
+                    output      = piechart_ori,
+                    top_k       = args.top_barcodes
+                )
+            if entry is not None:
+                entry.add_file(cached_chart, piechart_ori)
+        
+    except Exception as e:
+        logging.error(f"Error during writing statistics (Original Data) : {e}")
+        write_run_report(report, run_report, "failed", e)
+        sys.exit(1)
 
-        # Tranform data to CSV file by using pandas
-        df_filtered = pd.DataFrame(metrics_filtered)
-        df_filtered.to_csv(stat_fil_csv, index= False)
+    # Step 3: Filtering summary
+    failed_sequences = total_sequences - passed_sequences 
+    passed_percentage = passed_sequences/total_sequences *100 if total_sequences else 0
+    failed_percentage = failed_sequences/total_sequences *100 if total_sequences else 0
+    logging.info(f'Number of sequences in original FASTQ: {total_sequences}(100.00%)')
+    logging.info(f'Number of sequences after filtering: {passed_sequences}({passed_percentage:.2f}%)')
+    logging.info(f'Number of sequences failed filtering: {failed_sequences} ({failed_percentage:.2f}%)')
+    for reason in pipeline.engine.reasons:
+        logging.info(f'Rejected ({reason}): {report.rejections[reason]}')
+    if trimmer is not None:
+        log_trimmed(report.counters)
+    if duplicates is not None:
+        log_duplicates(duplicates.summary())
+        report.info['duplicates'] = duplicates.summary()
+        if duplicates.remove:
+            logging.info(f'Rejected ({DUPLICATE_REASON}): {report.rejections[DUPLICATE_REASON]}')
+
+    # Step 4: Statistical output of Filtered FASTQ File.
+    try:
+        grouped_sequences_filtered = pipeline.filtered_parser.get_grouped_sequences()
+        logging.info( f"Parsed {len(grouped_sequences_filtered)} groups from the filtered FASTQ file.")
+
+        # Per-read metrics were streamed to the CSV file (or the columns) during the pass
         logging.info(f"Filtered statistics saved to {stat_fil_csv}.")
+        log_summary('Filtered', pipeline.filtered_stats)
 
         # Filtered barcode distribution pie chart
-        barcode_dist_filtered = stat_cal_filtered.calculate_barcode_distribution(
-                                barcode_length=args.barcode_length,
-                                header_barcode=args.header_barcode
-        )
-        pie_chart(
-                distribution= barcode_dist_filtered,
-                title ='Filtered Barcode Distribution',
-                output = piechart_fil
-        )
+        if plots:
+            with report.stage("plot"):
+                pie_chart(
+                        distribution= pipeline.get_filtered_distribution(),
+                        title ='Filtered Barcode Distribution',
+                        output = piechart_fil,
+                        top_k = args.top_barcodes
+                )
+                if args.quality_heatmap:
+                    quality_heatmap(profile_file, os.path.join(args.output_dir, QUALITY_HEATMAP_FILE))
     except Exception as e:
-        logging.error ( f" Error during parsing or calculating statistics (Filtered Data) : {e}")
+        logging.error ( f" Error during writing statistics (Filtered Data) : {e}")
+        write_run_report(report, run_report, "failed", e)
         sys.exit(1)
 
+    report.info['original'] = pipeline.original_stats.summary()
+    report.info['filtered'] = pipeline.filtered_stats.summary()
+    write_run_report(report, run_report, "completed")
     logging.info("Processing Completed Successfully.")
 
 if __name__ == "__main__":
@@ -0,0 +1,45 @@
+import os
+
+# Choices, defaults and output names that the argument parser of main.py needs.
+# They are kept here, free of numpy, so parsing the arguments (and --help) does
+# not import the pipeline; the modules they belong to import them from here.
+
+# src.filter.predicates: bases in the sliding window of the window quality criterion
+DEFAULT_WINDOW_SIZE = 10
+
+# src.filter.paired: keep a pair when both or either of its mates pass
+BOTH = "both"
+EITHER = "either"
+PAIR_POLICIES = (BOTH, EITHER)
+
+# src.filter.duplicates
+EXACT = "exact"
+BLOOM = "bloom"
+DUPLICATE_METHODS = (EXACT, BLOOM)
+DEFAULT_MEMORY_MB = 256
+
+# src.statistic.columnar_writer
+CSV = "csv"
+PARQUET = "parquet"
+NPY = "npy"
+METRICS_FORMATS = (CSV, PARQUET, NPY)
+
+# src.statistic.quality_profile: original reads and the reads that passed the filter
+QUALITY_PROFILE_FILE = "quality_profile.npz"
+QUALITY_HEATMAP_FILE = "quality_heatmap.png"
+STATES = ("original", "filtered")
+
+# src.pipeline.follow
+CHECKPOINT_FILE = "follow_checkpoint.json"
+POLL_INTERVAL = 5.0
+IDLE_TIMEOUT = 600.0
+
+# src.pipeline.sampling
+SAMPLE_FILE = "sample_estimates.json"
+CONFIDENCE = 0.95
+
+# src.pipeline.multi_file
+PER_FILE_SUMMARY = "per_file_summary.csv"
+
+# src.pipeline.result_cache
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "filterfastq")
@@ -0,0 +1,284 @@
+from collections import Counter
+import logging
+import math
+import os
+import zlib
+import numpy as np
+from src.parsing.demux import UNCLASSIFIED
+from src.constants import EXACT, BLOOM, DUPLICATE_METHODS, DEFAULT_MEMORY_MB
+
+# Duplicate reads (e.g. PCR duplicates) are found by a 64-bit fingerprint of
+# their sequence, or of their barcode and the first prefix_length bases. The
+# fingerprints are kept in an open-addressing hash set (exact up to 64-bit
+# collisions, 16 bytes per distinct read) or a Bloom filter of a fixed size
+# (false positives, no false negatives). The hash set turns into a Bloom
+# filter of the memory budget when it would outgrow it.
+DUPLICATE_REASON = "duplicate"
+MAX_LOAD = 0.5
+MAX_HASHES = 16
+# Bases hashed at a time, bounding the temporary arrays of a batch
+HASH_BLOCK = 1 << 20
+# Bytes of the input looked at to estimate its number of reads
+ESTIMATE_SIZE = 1024 * 1024
+
+_EMPTY = np.uint64(0)
+_GOLDEN = np.uint64(0x9e3779b97f4a7c15)
+_MIX1 = np.uint64(0xbf58476d1ce4e5b9)
+_MIX2 = np.uint64(0x94d049bb133111eb)
+
+
+def splitmix64(values):
+    """Mix an array of uint64 into well-distributed 64-bit hashes (wrapping arithmetic)."""
+    values = values.astype(np.uint64) + _GOLDEN
+    values = (values ^ (values >> np.uint64(30))) * _MIX1
+    values = (values ^ (values >> np.uint64(27))) * _MIX2
+    return values ^ (values >> np.uint64(31))
+
+
+def sequence_fingerprints(batch, prefix_length=0, barcodes=None):
+    """64-bit fingerprints of the sequences of a RecordBatch (never 0).
+
+    Every (position, base) pair is hashed and the hashes of a read are added
+    up, which is a random function of the sequence. With prefix_length only
+    the first prefix_length bases count, and the barcodes (one str or None
+    per read) are mixed in. The bases are hashed in blocks of HASH_BLOCK.
+    """
+    lengths = np.minimum(batch.lengths, prefix_length) if prefix_length else batch.lengths
+    # Running sums of the base hashes are only kept at the start and end of every read
+    bounds = np.concatenate([batch.starts, batch.starts + lengths])
+    prefix = np.zeros(len(bounds), dtype=np.uint64)
+    carry = _EMPTY
+    for start in range(0, batch.bases.size, HASH_BLOCK):
+        stop = min(start + HASH_BLOCK, batch.bases.size)
+        offsets = np.arange(start, stop, dtype=np.int64)
+        positions = offsets - batch.starts[np.searchsorted(batch.starts, offsets, side='right') - 1]
+        sums = np.cumsum(splitmix64((positions.astype(np.uint64) << np.uint64(8)) | batch.bases[start:stop]))
+        sums += carry
+        inside = (bounds > start) & (bounds <= stop)
+        prefix[inside] = sums[bounds[inside] - start - 1]
+        carry = sums[-1]
+    count = len(batch.starts)
+    fingerprints = splitmix64((prefix[count:] - prefix[:count]) ^ splitmix64(lengths))
+    if barcodes is not None:
+        table = {barcode: zlib.crc32(str(barcode).encode()) for barcode in set(barcodes)}
+        fingerprints ^= splitmix64(np.array([table[barcode] for barcode in barcodes], dtype=np.uint64))
+    fingerprints[fingerprints == _EMPTY] = 1
+    return fingerprints
+
+
+class FingerprintSet:
+    """Open-addressing hash set of non-zero uint64 fingerprints with linear probing."""
+
+    def __init__(self, capacity=1024):
+        self.capacity = 1 << max(int(capacity) - 1, 1).bit_length()
+        self.table = np.zeros(self.capacity, dtype=np.uint64)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def memory_bytes(self):
+        return self.table.nbytes
+
+    def capacity_for(self, count):
+        capacity = self.capacity
+        while count > MAX_LOAD * capacity:
+            capacity *= 2
+        return capacity
+
+    def grow(self, capacity):
+        keys = self.table[self.table != _EMPTY]
+        self.capacity = capacity
+        self.table = np.zeros(capacity, dtype=np.uint64)
+        self.count = 0
+        self.add_many(keys)
+
+    def add_many(self, keys):
+        """Add distinct fingerprints; returns which of them were already in the set."""
+        if self.count + len(keys) > MAX_LOAD * self.capacity:
+            self.grow(self.capacity_for(self.count + len(keys)))
+        seen = np.zeros(len(keys), dtype=bool)
+        mask = np.uint64(self.capacity - 1)
+        pending = np.arange(len(keys))
+        positions = (keys & mask).astype(np.int64)
+        while pending.size:
+            slots = self.table[positions]
+            found = slots == keys[pending]
+            seen[pending[found]] = True
+            empty = slots == _EMPTY
+            # Keys probing the same empty slot: the last write wins, the others probe on
+            claimed = positions[empty]
+            self.table[claimed] = keys[pending[empty]]
+            won = self.table[claimed] == keys[pending[empty]]
+            self.count += int(won.sum())
+            retry = ~found
+            retry[empty] = ~won
+            pending = pending[retry]
+            positions = (positions[retry] + 1) & (self.capacity - 1)
+        return seen
+
+    def false_positive_rate(self):
+        # Chance that a new read collides with one of the stored 64-bit fingerprints
+        return self.count / 2.0 ** 64
+
+
+class BloomFilter:
+    """Bloom filter of uint64 fingerprints with double hashing."""
+
+    def __init__(self, bits, hashes):
+        self.bits = max(8, int(bits)) // 8 * 8
+        self.hashes = max(1, min(int(hashes), MAX_HASHES))
+        self.array = np.zeros(self.bits // 8, dtype=np.uint8)
+        self.count = 0
+
+    @classmethod
+    def for_memory(cls, memory_bytes, expected_items):
+        bits = memory_bytes * 8
+        return cls(bits, round(bits / max(expected_items, 1) * math.log(2)))
+
+    @classmethod
+    def for_false_positive_rate(cls, expected_items, rate):
+        bits = math.ceil(-max(expected_items, 1) * math.log(rate) / math.log(2) ** 2)
+        return cls(bits, round(-math.log2(rate)))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def memory_bytes(self):
+        return self.array.nbytes
+
+    def positions(self, keys):
+        step = splitmix64(keys) | np.uint64(1)
+        size = np.uint64(self.bits)
+        for number in range(self.hashes):
+            yield ((keys + np.uint64(number) * step) % size).astype(np.int64)
+
+    def add_many(self, keys):
+        """Add distinct fingerprints; returns which of them were (probably) already added."""
+        seen = np.ones(len(keys), dtype=bool)
+        for position in self.positions(keys):
+            seen &= (self.array[position >> 3] >> (position & 7).astype(np.uint8)) & 1 == 1
+        for position in self.positions(keys[~seen]):
+            np.bitwise_or.at(self.array, position >> 3, np.left_shift(1, position & 7).astype(np.uint8))
+        self.count += int((~seen).sum())
+        return seen
+
+    def false_positive_rate(self, count=None):
+        """Chance that a new read is taken for a duplicate after count reads were added."""
+        count = self.count if count is None else count
+        return (1 - math.exp(-self.hashes * count / self.bits)) ** self.hashes
+
+
+def estimate_reads(file_paths):
+    """Rough number of reads of FASTQ files (plain, gzip or BGZF) from the size of their first records."""
+    total = 0
+    for path in file_paths:
+        size = os.path.getsize(path)
+        with open(path, 'rb') as handle:
+            head = handle.read(ESTIMATE_SIZE)
+        data = head
+        if head[:2] == b'\x1f\x8b':
+            # Inflate the gzip members in the head; the ratio scales the file size
+            data, rest = b'', head
+            while rest[:2] == b'\x1f\x8b':
+                inflater = zlib.decompressobj(wbits=31)
+                data += inflater.decompress(rest)
+                rest = inflater.unused_data
+            size = size * len(data) // max(len(head) - len(rest), 1)
+        records = data.count(b'\n') // 4
+        total += size * records // max(len(data), 1) if records else size // 1000
+    return max(total, 1)
+
+
+class DuplicateDetector:
+    """Mark reads whose fingerprint was seen before, counting them per barcode.
+
+    The first read of every sequence is kept. With method EXACT the hash set
+    may use up to memory_bytes before it becomes a Bloom filter of that size;
+    with BLOOM the filter has memory_bytes, or is sized for fp_rate at
+    expected_reads.
+    """
+
+    def __init__(self, method=EXACT, memory_bytes=DEFAULT_MEMORY_MB * 1024 * 1024, expected_reads=None,
+                 fp_rate=None, prefix_length=0, remove=False):
+        if method not in DUPLICATE_METHODS:
+            raise ValueError(f"Unknown duplicate detection method: {method}. Choose from {', '.join(DUPLICATE_METHODS)}")
+        if fp_rate is not None and not 0 < fp_rate < 1:
+            raise ValueError("The false positive rate must be between 0 and 1")
+        self.method = method
+        self.memory_bytes = memory_bytes
+        self.expected_reads = expected_reads or 1_000_000
+        self.fp_rate = fp_rate
+        self.prefix_length = prefix_length
+        self.remove = remove
+        if method == BLOOM:
+            self.fingerprints = self.bloom_filter()
+        else:
+            self.fingerprints = FingerprintSet()
+        self.reads = Counter()
+        self.duplicates = Counter()
+
+    def bloom_filter(self):
+        if self.fp_rate is not None:
+            return BloomFilter.for_false_positive_rate(self.expected_reads, self.fp_rate)
+        return BloomFilter.for_memory(self.memory_bytes, self.expected_reads)
+
+    def add_many(self, keys):
+        fingerprints = self.fingerprints
+        if isinstance(fingerprints, FingerprintSet):
+            capacity = fingerprints.capacity_for(len(fingerprints) + len(keys))
+            if capacity * 8 > self.memory_bytes:
+                logging.warning(
+                    f"The duplicate hash set would outgrow {self.memory_bytes} bytes after "
+                    f"{len(fingerprints)} distinct reads, switching to a Bloom filter"
+                )
+                self.method = BLOOM
+                self.fingerprints = self.bloom_filter()
+                self.fingerprints.add_many(fingerprints.table[fingerprints.table != _EMPTY])
+        return self.fingerprints.add_many(keys)
+
+    def mark(self, batch, barcodes, candidates):
+        """Return the mask of the candidate reads of a RecordBatch that duplicate an earlier candidate."""
+        duplicate = np.zeros(len(batch), dtype=bool)
+        index = np.flatnonzero(candidates)
+        if not index.size:
+            return duplicate
+        barcodes = [barcodes[i] for i in index.tolist()]
+        fingerprints = sequence_fingerprints(batch.take(index), self.prefix_length,
+                                             barcodes if self.prefix_length else None)
+        # Within the batch only the first copy can be new
+        unique, first, inverse = np.unique(fingerprints, return_index=True, return_inverse=True)
+        found = self.add_many(unique)[inverse]
+        later = np.ones(len(fingerprints), dtype=bool)
+        later[first] = False
+        found |= later
+        duplicate[index] = found
+
+        groups = [UNCLASSIFIED if barcode is None else barcode for barcode in barcodes]
+        self.reads.update(groups)
+        self.duplicates.update(group for group, is_duplicate in zip(groups, found.tolist()) if is_duplicate)
+        return duplicate
+
+    def summary(self):
+        reads, duplicates = sum(self.reads.values()), sum(self.duplicates.values())
+
+        def rate(count, total):
+            return count / total * 100 if total else 0
+
+        return {
+            'method': self.method,
+            'prefix_length': self.prefix_length,
+            'removed': self.remove,
+            'memory_bytes': self.fingerprints.memory_bytes,
+            'false_positive_rate': self.fingerprints.false_positive_rate(),
+            'reads_checked': reads,
+            'duplicates': duplicates,
+            'duplication_rate_percent': rate(duplicates, reads),
+            'per_barcode': {
+                group: {'reads': count, 'duplicates': self.duplicates[group],
+                        'duplication_rate_percent': rate(self.duplicates[group], count)}
+                for group, count in self.reads.most_common()
+            },
+        }
@@ -1,18 +1,17 @@
    
 import sys
-from Bio import SeqIO
+import io
 import logging
-import gzip
-
-def calculate_gc_content(seq):
-    gc = seq.count('G') + seq.count('C') + seq.count('g') + seq.count('c')
-    return (gc / len(seq)) * 100 if len(seq) > 0 else 0
-
-def filter_fastq(input_file, output_file,quality_threshold=20, min_length=50, gc_min=30, gc_max=60):
-    total = 0 # Set start total sequence values
-    passed = 0 # Set start passed sequence values
-
-   # Set up logging for each value for using in main
+from functools import partial
+from src.parsing import fastq_reader, fastq_index, compressed_io
+from src.pipeline.parallel import ordered_map
+from src.statistic.batch_metrics import iter_batch_metrics, iter_batches, RecordBatch, BatchMetrics
+from src.pipeline.instrumentation import RunReport
+from src.pipeline.staged import ReaderStage, QueuedWriter
+from src.filter.predicates import FilterEngine, build_predicates, DEFAULT_WINDOW_SIZE
+
+def log_filter_criteria(quality_threshold=20, min_length=50, gc_min=30, gc_max=60):
+    # Set up logging for each value and fill in the defaults that were not given
     if quality_threshold is None: 
         logging.info( f" Quality threshold  not detected. Default value is 20")
         quality_threshold = 20
@@ -31,39 +30,128 @@ def filter_fastq(input_file, output_file,quality_threshold=20, min_length=50, gc
     else:
         logging.info(f"Minimum GC content(%) set to {gc_min} and Maxiimum GC content(%) set to {gc_max}")
 
+    return quality_threshold, min_length, gc_min, gc_max
+
+def log_extra_criteria(max_length=None, max_n_fraction=None, max_expected_errors=None,
+                       window_quality=None, window_size=DEFAULT_WINDOW_SIZE, adaptive=False):
+    # The optional criteria are only logged when they are set
+    if max_length is not None:
+        logging.info(f"Maximum length set to {max_length}")
+    if max_n_fraction is not None:
+        logging.info(f"Maximum N fraction set to {max_n_fraction}")
+    if max_expected_errors is not None:
+        logging.info(f"Maximum expected errors set to {max_expected_errors}")
+    if window_quality is not None:
+        logging.info(f"Minimum quality over a {window_size} base sliding window set to {window_quality}")
+    if adaptive:
+        logging.info("Filter criteria are reordered by their observed rejection rates")
+
+def write_passed(out_handle, records, mask):
+    out_handle.write(b''.join([
+        fastq_reader.to_fastq_bytes(record) for record, keep in zip(records, mask.tolist()) if keep
+    ]))
+
+def trim_batch(batch, metrics, trimmer, report):
+    # Trim a batch with a Trimmer before the filter, counting the trimmed reads
+    # and bases in report; returns the trimmed batch and its metrics, which keep
+    # the barcodes of the untrimmed reads
+    with report.stage("trim") as stage:
+        trimmed, counts = trimmer.trim(batch)
+        report.counters.update(counts)
+        if trimmed is not batch:
+            trimmed_metrics = BatchMetrics(trimmed, 0)
+            trimmed_metrics.barcodes = metrics.barcodes
+            metrics = trimmed_metrics
+        stage.records += len(batch)
+    return trimmed, metrics
+
+def filter_batches(batches, out_handle, report, engine, trimmer=None):
+    # Filter (RecordBatch, BatchMetrics) pairs into out_handle with a FilterEngine,
+    # timing the stages in report; returns (total, passed)
+    total = 0
+    passed = 0
+    while True:
+        with report.stage("parse_and_measure") as stage:
+            batch, metrics = next(batches, (None, None))
+            if batch is None:
+                break
+            stage.records += len(batch)
+            stage.bytes += int(metrics.lengths.sum())
+        if trimmer is not None:
+            batch, metrics = trim_batch(batch, metrics, trimmer, report)
+        with report.stage("filter") as stage:
+            mask, rejections = engine.apply(metrics, batch)
+            report.rejections.update(rejections)
+            stage.records += len(batch)
+        with report.stage("write_fastq") as stage:
+            write_passed(out_handle, batch.records, mask)
+            stage.records += int(mask.sum())
+        total += len(batch)
+        passed += int(mask.sum())
+    return total, passed
 
-    if input_file.endswith('.gz'):
-        input_handle= gzip.open(input_file,"rt")
-    else:
-        input_handle = open(input_file, "r")
-
-    with input_handle, open(output_file, "w") as out_handle:
-
-        for record in SeqIO.parse(input_handle, "fastq"):
-            total += 1
-            # Calculate average quality score
-            qualities = record.letter_annotations.get("phred_quality",[])
-            if not qualities:
-                logging.debug(f" Sequence{record.id} has no quality scores. Skipping.")
-                continue
-            avg_quality = sum(qualities)/ len(qualities)
+def filter_chunk(chunk, engine, reader=fastq_reader.NATIVE, trimmer=None):
+    # Worker of the parallel mode: filter one block of whole records and return
+    # (total, passed, passed records as FASTQ bytes, RunReport of the chunk)
+    out_handle = io.BytesIO()
+    report = RunReport()
+    records = fastq_reader.parse_chunk(fastq_index.load_chunk(chunk), reader)
+    total, passed = filter_batches(iter_batch_metrics(records), out_handle, report, engine, trimmer)
+    return total, passed, out_handle.getvalue(), report
+
+def filter_fastq(input_file, output_file,quality_threshold=20, min_length=50, gc_min=30, gc_max=60,
+                 reader=fastq_reader.NATIVE, threads=1, chunk_size=fastq_reader.CHUNK_SIZE, use_index=False,
+                 compress=None, report=None, max_length=None, max_n_fraction=None, max_expected_errors=None,
+                 window_quality=None, window_size=DEFAULT_WINDOW_SIZE, adaptive=False, pipelined=False,
+                 trimmer=None):
+    total = 0 # Set start total sequence values
+    passed = 0 # Set start passed sequence values
+    # Stage timings and rejection counters are collected in report (a RunReport)
+    report = RunReport() if report is None else report
 
-            if avg_quality < quality_threshold:
-                continue
-            
-            # Check sequence length
-            seq_length = len(record.seq)
-            if seq_length < min_length:
-                continue
-
-            # Check GC content
-            gc_content = calculate_gc_content(str(record.seq))
-            if gc_content < gc_min or gc_content > gc_max:
-                continue
-            
+    quality_threshold, min_length, gc_min, gc_max = log_filter_criteria(
+        quality_threshold, min_length, gc_min, gc_max
+    )
+    log_extra_criteria(max_length, max_n_fraction, max_expected_errors, window_quality, window_size, adaptive)
+    engine = FilterEngine(build_predicates(
+        quality_threshold, min_length, gc_min, gc_max, max_length, max_n_fraction,
+        max_expected_errors, window_quality, window_size
+    ), adaptive)
+
+    # compress is None, "gzip" or "bgzf"; compressed output is written by a thread pool
+    with compressed_io.open_output(output_file, compress) as out_handle:
+
+        if threads > 1:
+            # Parallel mode: record-aligned chunks are filtered in a process pool
+            # and written back in their original order
+            logging.info(f"Filtering with {threads} processes")
+            worker = partial(filter_chunk, engine=engine, reader=reader, trimmer=trimmer)
+            chunks = fastq_index.iter_work_chunks(input_file, chunk_size, use_index)
+            for chunk_total, chunk_passed, data, chunk_report in ordered_map(worker, chunks, threads):
+                total += chunk_total
+                passed += chunk_passed
+                out_handle.write(data)
+                report.merge(chunk_report)
+        elif pipelined:
+            # Pipelined mode: a reader thread parses the batches and a writer thread
+            # writes the passed records while this thread measures and filters
+            logging.info("Filtering with pipelined reader, compute and writer stages")
+            records = fastq_reader.read_fastq(input_file, reader)
+            reader_stage = ReaderStage(RecordBatch(batch) for batch in iter_batches(records))
+            writer = QueuedWriter(out_handle)
+            try:
+                batches = ((batch, BatchMetrics(batch)) for batch in reader_stage)
+                total, passed = filter_batches(batches, writer, report, engine, trimmer)
+                writer.close()
+            except BaseException:
+                writer.cancel()
+                raise
+            finally:
+                reader_stage.close()
+        else:
+            records = fastq_reader.read_fastq(input_file, reader)
             # Write to output if all conditions are met
-            SeqIO.write(record, out_handle, "fastq")
-            passed += 1
+            total, passed = filter_batches(iter_batch_metrics(records), out_handle, report, engine, trimmer)
             
 
     
@@ -0,0 +1,127 @@
+from itertools import islice
+import logging
+import re
+from src.parsing import fastq_reader, compressed_io
+from src.statistic.batch_metrics import iter_batches, RecordBatch, BatchMetrics
+from src.pipeline.instrumentation import RunReport
+from src.filter.filter import log_filter_criteria, log_extra_criteria, write_passed, trim_batch
+from src.filter.predicates import FilterEngine, build_predicates
+from src.constants import BOTH, EITHER, PAIR_POLICIES, DEFAULT_WINDOW_SIZE
+
+# Paired-end filtering: R1 and R2 are read in lockstep, batch by batch, and a
+# pair is kept when both mates (BOTH) or at least one of them (EITHER) pass
+# the criteria. Kept pairs are written to both outputs, so the outputs stay in
+# sync without re-pairing them afterwards.
+MATES = ("R1", "R2")
+# Mate suffixes of old-style Illumina read IDs (read/1, read/2)
+MATE_SUFFIX = re.compile(r'/[12]$')
+
+
+class PairMismatchError(ValueError):
+    """The R1 and R2 files are not in the same order or have different numbers of reads."""
+
+
+def pair_id(record_id):
+    return MATE_SUFFIX.sub('', record_id)
+
+
+def iter_pair_batches(records1, records2):
+    """Yield (R1 records, R2 records) lists of the same reads, checking that the IDs match."""
+    position = 0
+    for batch1 in iter_batches(records1):
+        batch2 = list(islice(records2, len(batch1)))
+        if len(batch2) != len(batch1):
+            raise PairMismatchError(f"R2 ends after {position + len(batch2)} reads, R1 has more")
+        for index, (record1, record2) in enumerate(zip(batch1, batch2)):
+            if pair_id(record1.id) != pair_id(record2.id):
+                raise PairMismatchError(
+                    f"Read {position + index + 1} has ID {record1.id} in R1 but {record2.id} in R2"
+                )
+        position += len(batch1)
+        yield batch1, batch2
+    if next(records2, None) is not None:
+        raise PairMismatchError(f"R1 ends after {position} reads, R2 has more")
+
+
+def filter_paired_fastq(input_r1, input_r2, output_r1, output_r2, quality_threshold=20, min_length=50,
+                        gc_min=30, gc_max=60, policy=BOTH, reader=fastq_reader.NATIVE, compress=None,
+                        report=None, max_length=None, max_n_fraction=None, max_expected_errors=None,
+                        window_quality=None, window_size=DEFAULT_WINDOW_SIZE, adaptive=False, trimmer=None):
+    """Filter the pairs of two mate FASTQ files in one streaming pass; returns (total pairs, passed pairs).
+
+    The rejections of every mate are counted in report as "<mate>_<reason>"
+    and the pairs kept or dropped by their mates in report.counters. With a
+    Trimmer both mates are trimmed before the criteria.
+    """
+    if policy not in PAIR_POLICIES:
+        raise ValueError(f"Unknown pair policy: {policy}. Choose from {', '.join(PAIR_POLICIES)}")
+    report = RunReport() if report is None else report
+
+    quality_threshold, min_length, gc_min, gc_max = log_filter_criteria(
+        quality_threshold, min_length, gc_min, gc_max
+    )
+    log_extra_criteria(max_length, max_n_fraction, max_expected_errors, window_quality, window_size, adaptive)
+    logging.info(f"Pairs are kept when {policy} mates pass the criteria")
+    # One engine per mate: their rejection rates, and so the adaptive order, differ
+    engines = [
+        FilterEngine(build_predicates(
+            quality_threshold, min_length, gc_min, gc_max, max_length, max_n_fraction,
+            max_expected_errors, window_quality, window_size
+        ), adaptive)
+        for _ in MATES
+    ]
+
+    total = 0
+    passed = 0
+    records1 = fastq_reader.read_fastq(input_r1, reader)
+    records2 = fastq_reader.read_fastq(input_r2, reader)
+    with compressed_io.open_output(output_r1, compress) as out_r1, \
+            compressed_io.open_output(output_r2, compress) as out_r2:
+        pairs = iter_pair_batches(records1, records2)
+        while True:
+            with report.stage("parse") as stage:
+                batch_pair = next(pairs, None)
+                if batch_pair is None:
+                    break
+                batches = [RecordBatch(records) for records in batch_pair]
+                stage.records += 2 * len(batches[0])
+                stage.bytes += sum(int(batch.lengths.sum()) for batch in batches)
+            masks = []
+            for number, (mate, batch, engine) in enumerate(zip(MATES, batches, engines)):
+                with report.stage("measure") as stage:
+                    metrics = BatchMetrics(batch, 0)
+                    stage.records += len(batch)
+                if trimmer is not None:
+                    batch, metrics = trim_batch(batch, metrics, trimmer, report)
+                    batches[number] = batch
+                with report.stage("filter") as stage:
+                    mask, rejections = engine.apply(metrics, batch)
+                    report.rejections.update({f"{mate}_{reason}": count for reason, count in rejections.items()})
+                    stage.records += len(batch)
+                masks.append(mask)
+            keep = masks[0] & masks[1] if policy == BOTH else masks[0] | masks[1]
+            with report.stage("write_fastq") as stage:
+                write_passed(out_r1, batches[0].records, keep)
+                write_passed(out_r2, batches[1].records, keep)
+                stage.records += 2 * int(keep.sum())
+            report.counters.update(
+                both_mates_passed=int((masks[0] & masks[1]).sum()),
+                only_r1_passed=int((masks[0] & ~masks[1]).sum()),
+                only_r2_passed=int((~masks[0] & masks[1]).sum()),
+            )
+            total += len(keep)
+            passed += int(keep.sum())
+
+    report.counters.update(pairs=total, passed_pairs=passed, failed_pairs=total - passed)
+    logging.info(f"Filtering completed.")
+    return total, passed
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) != 5:
+        print("Usage: python paired.py input_R1.fastq input_R2.fastq filtered_R1.fastq filtered_R2.fastq")
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+    total_pairs, passed_pairs = filter_paired_fastq(*sys.argv[1:5])
+    logging.info(f"{passed_pairs} of {total_pairs} pairs passed the filter")
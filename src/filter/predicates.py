@@ -0,0 +1,250 @@
+from abc import ABC, abstractmethod
+import numpy as np
+from src.constants import DEFAULT_WINDOW_SIZE
+
+# Relative cost per record of the predicates. The ones reading per-read
+# metrics are cheap; the ones that go back to the per-base qualities cost
+# about as much as measuring the batch again. The per-read metrics themselves
+# are computed for the whole batch by BatchMetrics before the engine runs (the
+# statistics need them for every read), so ordering saves work only on the
+# per-base predicates.
+METRIC_COST = 1
+BASES_COST = 20
+WINDOW_COST = 40
+
+# The adaptive engine keeps the static order until it has seen this many reads
+ADAPT_AFTER = 10000
+# Floor of the observed rejection rate, so a predicate that never rejects is not ranked infinitely late
+MIN_REJECTION_RATE = 1e-3
+
+# Probability that a base with a given Phred score is wrong
+ERROR_PROBABILITY = 10 ** (-np.arange(94) / 10)
+
+
+class Predicate(ABC):
+    """One filter criterion, named after the rejection reason it reports.
+
+    failed(metrics, index, batch) returns a boolean array telling which of
+    the records at index fail the criterion. Predicates with needs_bases set
+    also read the RecordBatch; only the records at index are looked at.
+    """
+
+    reason = None
+    cost = METRIC_COST
+    needs_bases = False
+
+    @abstractmethod
+    def failed(self, metrics, index, batch=None):
+        """Boolean array of the records at index that fail the criterion."""
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.reason})"
+
+
+class NoQualities(Predicate):
+    # Empty reads have no quality scores
+    reason = "no_qualities"
+    cost = 0
+
+    def failed(self, metrics, index, batch=None):
+        return metrics.lengths[index] == 0
+
+
+class MinLength(Predicate):
+    reason = "too_short"
+
+    def __init__(self, min_length):
+        self.min_length = min_length
+
+    def failed(self, metrics, index, batch=None):
+        return metrics.lengths[index] < self.min_length
+
+
+class MaxLength(Predicate):
+    reason = "too_long"
+
+    def __init__(self, max_length):
+        self.max_length = max_length
+
+    def failed(self, metrics, index, batch=None):
+        return metrics.lengths[index] > self.max_length
+
+
+class MinMeanQuality(Predicate):
+    reason = "low_quality"
+
+    def __init__(self, quality_threshold):
+        self.quality_threshold = quality_threshold
+
+    def failed(self, metrics, index, batch=None):
+        return metrics.mean_quality[index] < self.quality_threshold
+
+
+class MaxNFraction(Predicate):
+    reason = "too_many_n"
+
+    def __init__(self, max_n_fraction):
+        self.max_n_fraction = max_n_fraction
+
+    def failed(self, metrics, index, batch=None):
+        lengths = metrics.lengths[index]
+        return metrics.n_count[index] > self.max_n_fraction * lengths
+
+
+class MinGcContent(Predicate):
+    reason = "gc_too_low"
+
+    def __init__(self, gc_min):
+        self.gc_min = gc_min
+
+    def failed(self, metrics, index, batch=None):
+        return metrics.gc_content_any[index] < self.gc_min
+
+
+class MaxGcContent(Predicate):
+    reason = "gc_too_high"
+
+    def __init__(self, gc_max):
+        self.gc_max = gc_max
+
+    def failed(self, metrics, index, batch=None):
+        return metrics.gc_content_any[index] > self.gc_max
+
+
+class MaxExpectedErrors(Predicate):
+    """Reject reads whose expected number of errors (sum of 10^(-Q/10)) is above a limit."""
+
+    reason = "expected_errors"
+    cost = BASES_COST
+    needs_bases = True
+
+    def __init__(self, max_expected_errors):
+        self.max_expected_errors = max_expected_errors
+
+    def failed(self, metrics, index, batch=None):
+        subset = batch.take(index)
+        probabilities = ERROR_PROBABILITY[subset.qualities]
+        prefix = np.zeros(probabilities.size + 1)
+        np.cumsum(probabilities, out=prefix[1:])
+        expected = prefix[subset.starts + subset.lengths] - prefix[subset.starts]
+        return expected > self.max_expected_errors
+
+
+class MinWindowQuality(Predicate):
+    """Reject reads with a window of window_size bases whose mean quality is below a threshold.
+
+    Reads shorter than the window are judged on their mean quality.
+    """
+
+    reason = "low_window_quality"
+    cost = WINDOW_COST
+    needs_bases = True
+
+    def __init__(self, window_quality, window_size=DEFAULT_WINDOW_SIZE):
+        if window_size < 1:
+            raise ValueError("The sliding window must be at least 1 base long")
+        self.window_quality = window_quality
+        self.window_size = window_size
+
+    def failed(self, metrics, index, batch=None):
+        size = self.window_size
+        subset = batch.take(index)
+        lengths, starts = subset.lengths, subset.starts
+        failed = metrics.mean_quality[index] < self.window_quality
+
+        long_reads = lengths >= size
+        if long_reads.any():
+            prefix = np.zeros(subset.qualities.size + 1, dtype=np.int64)
+            np.cumsum(subset.qualities, out=prefix[1:])
+            window_sums = prefix[size:] - prefix[:-size] if subset.qualities.size >= size else np.zeros(0, np.int64)
+            # Windows starting in the last size - 1 bases of a read run into the next read
+            position = np.arange(window_sums.size) - np.repeat(starts, lengths)[:window_sums.size]
+            last_start = np.repeat(lengths - size, lengths)[:window_sums.size]
+            window_sums = np.where(position <= last_start, window_sums, np.iinfo(np.int64).max)
+            minimum = np.minimum.reduceat(window_sums, starts[long_reads])
+            failed[long_reads] = minimum < self.window_quality * size
+        return failed
+
+
+class FilterEngine:
+    """Apply a list of predicates to a batch, cheapest first, with short-circuiting.
+
+    Every predicate only looks at the records that passed the predicates
+    before it, so the expensive per-base criteria run on the survivors only.
+    A read is counted once, under the first predicate it fails. With adaptive
+    set, the order is updated from the observed rejection rates: predicates
+    are ranked by cost divided by rejection rate, so a cheap predicate that
+    rejects many reads moves to the front.
+
+    The metrics are computed before the engine runs, so for the predicates
+    on per-read metrics the order only saves array comparisons; the gain is
+    in running the per-base predicates (expected errors, window quality) on
+    fewer reads.
+    """
+
+    def __init__(self, predicates, adaptive=False):
+        # Stable sort: predicates of equal cost keep the order they were given in
+        self.predicates = sorted(predicates, key=lambda predicate: predicate.cost)
+        self.adaptive = adaptive
+        self.evaluated = {predicate.reason: 0 for predicate in self.predicates}
+        self.rejected = {predicate.reason: 0 for predicate in self.predicates}
+        self.seen = 0
+
+    @property
+    def reasons(self):
+        return tuple(predicate.reason for predicate in self.predicates)
+
+    @property
+    def needs_bases(self):
+        return any(predicate.needs_bases for predicate in self.predicates)
+
+    def apply(self, metrics, batch=None):
+        """Return (mask of the records that pass every predicate, {reason: rejected reads})."""
+        count = len(metrics.lengths)
+        mask = np.zeros(count, dtype=bool)
+        index = np.arange(count)
+        rejections = {}
+        for predicate in self.predicates:
+            rejected = 0
+            if index.size:
+                failed = predicate.failed(metrics, index, batch)
+                rejected = int(np.count_nonzero(failed))
+                self.evaluated[predicate.reason] += index.size
+                self.rejected[predicate.reason] += rejected
+                if rejected:
+                    index = index[~failed]
+            rejections[predicate.reason] = rejected
+        mask[index] = True
+        self.seen += count
+        if self.adaptive and self.seen >= ADAPT_AFTER:
+            self.reorder()
+        return mask, rejections
+
+    def reorder(self):
+        def rank(predicate):
+            evaluated = self.evaluated[predicate.reason]
+            rate = self.rejected[predicate.reason] / evaluated if evaluated else 0
+            return predicate.cost / max(rate, MIN_REJECTION_RATE)
+        self.predicates.sort(key=rank)
+
+
+def build_predicates(quality_threshold=20, min_length=50, gc_min=30, gc_max=60, max_length=None,
+                     max_n_fraction=None, max_expected_errors=None, window_quality=None,
+                     window_size=DEFAULT_WINDOW_SIZE):
+    """Predicates of the filter criteria; the optional ones are left out when None."""
+    predicates = [
+        NoQualities(),
+        MinLength(min_length),
+        MinMeanQuality(quality_threshold),
+        MinGcContent(gc_min),
+        MaxGcContent(gc_max),
+    ]
+    if max_length is not None:
+        predicates.append(MaxLength(max_length))
+    if max_n_fraction is not None:
+        predicates.append(MaxNFraction(max_n_fraction))
+    if max_expected_errors is not None:
+        predicates.append(MaxExpectedErrors(max_expected_errors))
+    if window_quality is not None:
+        predicates.append(MinWindowQuality(window_quality, window_size))
+    return predicates
@@ -0,0 +1,148 @@
+import numpy as np
+from src.filter.predicates import DEFAULT_WINDOW_SIZE
+
+# Optional trimming before the filter criteria, so a long read with a bad
+# tail is shortened instead of rejected. Every step works on the flat
+# quality array of a RecordBatch with prefix sums and reduceat over the
+# reads, so the cost is linear in the number of bases:
+#   adapter clipping   the adapter is cut from the 5' start of the reads that
+#                      start with it (up to max_mismatches mismatches)
+#   window trimming    the read ends with the last window of window_size bases
+#                      whose mean quality is at least window_quality
+#   Mott trimming      the 3' end is cut where the sum of (mott_quality - Q)
+#                      over the cut bases is largest, scanning from the 3'
+#                      end until that sum turns negative, like BWA -q
+_LOWER = 0x20
+_NO_POSITION = -1
+
+
+def last_position(values, lengths, starts):
+    """Largest value of every read (values are base positions or _NO_POSITION); _NO_POSITION for empty reads."""
+    result = np.full(len(lengths), _NO_POSITION, dtype=np.int64)
+    filled = lengths > 0
+    if filled.any():
+        # The bases of the reads are contiguous, so the reads that are not empty cover every base
+        result[filled] = np.maximum.reduceat(values, starts[filled])
+    return result
+
+
+class Trimmer:
+    """Clip a 5' adapter and trim low-quality 3' ends of the records of a RecordBatch.
+
+    The 3' trimming only looks at the bases after the clipped adapter. With
+    both window_quality and mott_quality set, the shorter of the two ends is
+    kept. Reads trimmed to nothing are left empty and fail the filter.
+    """
+
+    def __init__(self, window_quality=None, window_size=DEFAULT_WINDOW_SIZE, mott_quality=None,
+                 adapter=None, max_mismatches=None):
+        if window_size < 1:
+            raise ValueError("The trimming window must be at least 1 base long")
+        self.window_quality = window_quality
+        self.window_size = window_size
+        self.mott_quality = mott_quality
+        self.adapter = adapter.upper() if adapter else None
+        # By default one mismatch per 10 adapter bases
+        if self.adapter and max_mismatches is None:
+            max_mismatches = len(self.adapter) // 10
+        self.max_mismatches = max_mismatches
+
+    def trim(self, batch):
+        """Return the trimmed RecordBatch and the number of clipped and trimmed reads and bases."""
+        left = self.adapter_ends(batch)
+        right = batch.lengths.copy()
+        if self.window_quality is not None or self.mott_quality is not None:
+            # Positions of the bases in the batch, and the part of its read each one may keep
+            positions = np.arange(batch.qualities.size, dtype=np.int64)
+            region_start = np.repeat(batch.starts + left, batch.lengths)
+            region_end = np.repeat(batch.starts + batch.lengths, batch.lengths)
+            if self.window_quality is not None:
+                right = np.minimum(right, self.window_ends(batch, left, positions, region_start, region_end))
+            if self.mott_quality is not None:
+                right = np.minimum(right, self.mott_ends(batch, left, positions, region_start))
+            right = np.maximum(right, left)
+        counts = {
+            'adapter_clipped_reads': int(np.count_nonzero(left)),
+            'adapter_clipped_bases': int(left.sum()),
+            'quality_trimmed_reads': int(np.count_nonzero(right < batch.lengths)),
+            'quality_trimmed_bases': int((batch.lengths - right).sum()),
+        }
+        if not counts['adapter_clipped_bases'] and not counts['quality_trimmed_bases']:
+            return batch, counts
+        return batch.trim(left, right), counts
+
+    def adapter_ends(self, batch):
+        """Number of bases to clip from the start of every read: the adapter length when it starts with the adapter."""
+        left = np.zeros(len(batch), dtype=np.int64)
+        if not self.adapter:
+            return left
+        adapter = np.frombuffer(self.adapter.encode(), dtype=np.uint8)
+        size = len(adapter)
+        index = np.flatnonzero(batch.lengths >= size)
+        if index.size:
+            prefixes = batch.bases[batch.starts[index, None] + np.arange(size)] & ~np.uint8(_LOWER)
+            mismatches = np.count_nonzero(prefixes != adapter, axis=1)
+            left[index[mismatches <= self.max_mismatches]] = size
+        return left
+
+    def window_ends(self, batch, left, positions, region_start, region_end):
+        """End of the last window with a mean quality of at least window_quality in every read after left.
+
+        A read after left shorter than the window is kept whole when its
+        mean quality is high enough; a read without a good window is cut to left.
+        """
+        size = self.window_size
+        prefix = np.zeros(batch.qualities.size + 1, dtype=np.int64)
+        np.cumsum(batch.qualities, out=prefix[1:])
+        window_sums = prefix[np.minimum(positions + size, batch.qualities.size)] - prefix[positions]
+        good = (
+            (positions >= region_start) & (positions + size <= region_end)
+            & (window_sums >= self.window_quality * size)
+        )
+        last = last_position(np.where(good, positions, _NO_POSITION), batch.lengths, batch.starts)
+        ends = np.where(last >= 0, last - batch.starts + size, left)
+
+        region_lengths = batch.lengths - left
+        short = (region_lengths > 0) & (region_lengths < size)
+        region_sums = prefix[batch.starts + batch.lengths] - prefix[batch.starts + left]
+        keep_short = short & (region_sums >= self.window_quality * region_lengths)
+        ends[keep_short] = batch.lengths[keep_short]
+        return ends
+
+    def mott_ends(self, batch, left, positions, region_start):
+        """Cut every read after left where the sum of (mott_quality - Q) over the cut 3' bases is largest.
+
+        Like BWA -q the cut bases are scanned from the 3' end and the scan
+        stops where their sum turns negative, so a low-quality 5' block does
+        not pull the cut in front of the good bases after it.
+        """
+        # prefix[x] is the sum up to base x and prefix[end] - prefix[x] the sum of the
+        # bases from x on; the scan stops at the last x where that sum is negative
+        prefix = np.zeros(batch.qualities.size + 1, dtype=np.float64)
+        np.cumsum(self.mott_quality - batch.qualities.astype(np.float64), out=prefix[1:])
+        ends = batch.starts + batch.lengths
+        end_prefix = np.repeat(prefix[ends], batch.lengths)
+        negative = (positions >= region_start) & (prefix[:-1] > end_prefix)
+        stop = last_position(np.where(negative, positions, _NO_POSITION), batch.lengths, batch.starts)
+        # The cut x maximises prefix[end] - prefix[x], so it is the last x after the
+        # stop with the smallest prefix[x]
+        inside = (positions >= region_start) & (positions > np.repeat(stop, batch.lengths))
+        values = np.where(inside, prefix[:-1], np.inf)
+        minimum = np.full(len(batch), np.inf)
+        filled = batch.lengths > 0
+        if filled.any():
+            minimum[filled] = np.minimum.reduceat(values, batch.starts[filled])
+        minimum = np.minimum(minimum, prefix[ends])
+        at_minimum = inside & (prefix[:-1] == np.repeat(minimum, batch.lengths))
+        last = last_position(np.where(at_minimum, positions, _NO_POSITION), batch.lengths, batch.starts)
+        # Nothing is cut when the end itself has the smallest prefix sum
+        return np.where(prefix[ends] <= minimum, batch.lengths, last - batch.starts)
+
+    def settings(self):
+        return {
+            'window_quality': self.window_quality,
+            'window_size': self.window_size,
+            'mott_quality': self.mott_quality,
+            'adapter': self.adapter,
+            'max_mismatches': self.max_mismatches,
+        }
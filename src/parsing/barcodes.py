@@ -0,0 +1,115 @@
+from itertools import combinations, product
+import hashlib
+import re
+
+# Labels of the reads that do not get a whitelist barcode
+UNASSIGNED = "unassigned"
+AMBIGUOUS = "ambiguous"
+DEFAULT_MAX_MISMATCHES = 1
+
+_BASES = "ACGTN"
+_VALID_BARCODE = re.compile(r'^[ACGT]+$')
+_SEPARATORS = re.compile(r'[\s,]+')
+
+
+class BarcodeWhitelist:
+    """Assign read prefixes to whitelist barcodes, tolerating up to max_mismatches substitutions.
+
+    The index maps every sequence within max_mismatches of a barcode to that
+    barcode, so a read is assigned with one dict lookup. A sequence that is
+    equally close to two barcodes maps to AMBIGUOUS, one that is not in the
+    index is UNASSIGNED.
+    """
+
+    def __init__(self, barcodes, max_mismatches=DEFAULT_MAX_MISMATCHES):
+        # barcodes is a dict {barcode sequence: name} or a list of sequences
+        if not isinstance(barcodes, dict):
+            barcodes = {barcode: barcode for barcode in barcodes}
+        if not barcodes:
+            raise ValueError("The barcode whitelist is empty")
+        lengths = {len(barcode) for barcode in barcodes}
+        if len(lengths) != 1:
+            raise ValueError(f"Whitelist barcodes must all have the same length, found lengths {sorted(lengths)}")
+        for barcode in barcodes:
+            if not _VALID_BARCODE.match(barcode):
+                raise ValueError(f"Invalid whitelist barcode: {barcode}")
+        if max_mismatches < 0:
+            raise ValueError("The maximum number of barcode mismatches cannot be negative")
+
+        self.barcodes = dict(barcodes)
+        self.barcode_length = lengths.pop()
+        self.max_mismatches = max_mismatches
+        self.index = self._build_index()
+
+    @classmethod
+    def load(cls, path, max_mismatches=DEFAULT_MAX_MISMATCHES):
+        """Read a whitelist file with one 'barcode' or 'name barcode' per line ('#' starts a comment)."""
+        barcodes = {}
+        with open(path) as handle:
+            for line_number, line in enumerate(handle, 1):
+                fields = [field for field in _SEPARATORS.split(line.split('#')[0].strip()) if field]
+                if not fields:
+                    continue
+                if len(fields) > 2:
+                    raise ValueError(f"{path}:{line_number}: expected 'barcode' or 'name barcode'")
+                barcode = fields[-1].upper()
+                if barcode in barcodes:
+                    raise ValueError(f"{path}:{line_number}: duplicate barcode {barcode}")
+                barcodes[barcode] = fields[0]
+        return cls(barcodes, max_mismatches)
+
+    def _build_index(self):
+        # sequence -> (distance, name); ties between different barcodes are ambiguous
+        best = {}
+        for barcode, name in self.barcodes.items():
+            for variant, distance in _neighbourhood(barcode, self.max_mismatches):
+                current = best.get(variant)
+                if current is None or distance < current[0]:
+                    best[variant] = (distance, name)
+                elif distance == current[0] and current[1] != name:
+                    best[variant] = (distance, AMBIGUOUS)
+        return {variant: name for variant, (_, name) in best.items()}
+
+    def __len__(self):
+        return len(self.barcodes)
+
+    def assign(self, prefix):
+        """Return the name of the barcode of a read prefix, AMBIGUOUS or UNASSIGNED."""
+        index = self.index
+        return index.get(prefix) or index.get(prefix.upper(), UNASSIGNED)
+
+    def assign_many(self, prefixes):
+        get = self.index.get
+        return [get(prefix) or get(prefix.upper(), UNASSIGNED) for prefix in prefixes]
+
+    def fingerprint(self):
+        """Hash of the barcodes, names and mismatch limit (used in the result cache key)."""
+        text = repr((sorted(self.barcodes.items()), self.max_mismatches))
+        return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+    def ambiguous_sequences(self):
+        return sum(1 for name in self.index.values() if name == AMBIGUOUS)
+
+
+def _neighbourhood(barcode, max_mismatches):
+    # Every sequence within max_mismatches substitutions (to A, C, G, T or N) with its distance
+    yield barcode, 0
+    for mismatches in range(1, max_mismatches + 1):
+        for positions in combinations(range(len(barcode)), mismatches):
+            choices = [[base for base in _BASES if base != barcode[position]] for position in positions]
+            for replacement in product(*choices):
+                variant = list(barcode)
+                for position, base in zip(positions, replacement):
+                    variant[position] = base
+                yield ''.join(variant), mismatches
+
+
+def assignment_counts(counts):
+    """Split a {barcode: reads} mapping into assigned, ambiguous and unassigned read counts."""
+    ambiguous = counts.get(AMBIGUOUS, 0)
+    unassigned = counts.get(UNASSIGNED, 0)
+    return {
+        'assigned': sum(counts.values()) - ambiguous - unassigned,
+        'ambiguous': ambiguous,
+        'unassigned': unassigned,
+    }
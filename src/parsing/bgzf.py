@@ -0,0 +1,159 @@
+import struct
+import zlib
+
+# A BGZF file is a series of gzip members of at most 64 KiB, each carrying its
+# compressed size in a 'BC' extra subfield. Positions inside such a file are
+# virtual offsets: (compressed block offset << 16) | offset inside the block.
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+_HEADER = struct.Struct('<4sIBBH')  # magic, mtime, xfl, os, xlen
+_BLOCK_HEADER = struct.Struct('<4sIBBH2sHH')  # the header above with its 'BC' subfield
+# Uncompressed bytes per block, as used by bgzip so that a block always fits in 64 KiB
+MAX_BLOCK_DATA = 65280
+# Empty block marking the end of a BGZF file
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def is_bgzf(file_path):
+    """Return True if the file starts with a BGZF block."""
+    with open(file_path, 'rb') as handle:
+        header = handle.read(_HEADER.size)
+        if len(header) < _HEADER.size or header[:4] != BGZF_MAGIC:
+            return False
+        extra = handle.read(_HEADER.unpack(header)[4])
+    return _block_size(extra) is not None
+
+
+def make_virtual_offset(block_offset, within_block):
+    return (block_offset << 16) | within_block
+
+
+def split_virtual_offset(virtual_offset):
+    return virtual_offset >> 16, virtual_offset & 0xFFFF
+
+
+def _block_size(extra):
+    # Total block size from the 'BC' subfield of the gzip extra field
+    position = 0
+    while position + 4 <= len(extra):
+        tag, length = extra[position:position + 2], struct.unpack('<H', extra[position + 2:position + 4])[0]
+        if tag == b'BC' and length == 2:
+            return struct.unpack('<H', extra[position + 4:position + 6])[0] + 1
+        position += 4 + length
+    return None
+
+
+def read_raw_block(handle):
+    """Read the next compressed block from a handle positioned at a block start.
+
+    Returns the whole block as bytes, or b'' at the end of the file.
+    """
+    header = handle.read(_HEADER.size)
+    if not header:
+        return b''
+    if len(header) < _HEADER.size or header[:4] != BGZF_MAGIC:
+        raise ValueError("Not a BGZF block")
+    extra = handle.read(_HEADER.unpack(header)[4])
+    size = _block_size(extra)
+    if size is None:
+        raise ValueError("BGZF block without a BC size field")
+    rest = handle.read(size - len(header) - len(extra))
+    return header + extra + rest
+
+
+def inflate_block(block):
+    """Decompress one raw BGZF block and check its CRC."""
+    xlen = _HEADER.unpack(block[:_HEADER.size])[4]
+    data = zlib.decompress(block[_HEADER.size + xlen:-8], -15)
+    crc, size = struct.unpack('<II', block[-8:])
+    if size != len(data) or crc != zlib.crc32(data):
+        raise ValueError("BGZF block failed its CRC check")
+    return data
+
+
+def deflate_block(data, level=6):
+    """Compress at most MAX_BLOCK_DATA bytes into one BGZF block."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    size = _BLOCK_HEADER.size + len(compressed) + 8
+    header = _BLOCK_HEADER.pack(BGZF_MAGIC, 0, 0, 255, 6, b'BC', 2, size - 1)
+    return header + compressed + struct.pack('<II', zlib.crc32(data), len(data))
+
+
+def compress_blocks(data, level=6):
+    """Compress data of any size into consecutive BGZF blocks."""
+    return b''.join(
+        deflate_block(data[start:start + MAX_BLOCK_DATA], level)
+        for start in range(0, len(data), MAX_BLOCK_DATA)
+    )
+
+
+def iter_blocks(handle):
+    """Yield (compressed block offset, decompressed data) for every block of a BGZF handle."""
+    offset = handle.tell()
+    while True:
+        block = read_raw_block(handle)
+        if not block:
+            return
+        yield offset, inflate_block(block)
+        offset += len(block)
+
+
+class BgzfReader:
+    """Minimal random-access reader for BGZF files addressed by virtual offsets."""
+
+    def __init__(self, file_path):
+        self.handle = open(file_path, 'rb')
+        self.block_offset = None
+        self.data = b''
+        self.within = 0
+
+    def tell(self):
+        return make_virtual_offset(self.block_offset or 0, self.within)
+
+    def seek(self, virtual_offset):
+        block_offset, within = split_virtual_offset(virtual_offset)
+        if block_offset != self.block_offset:
+            self.handle.seek(block_offset)
+            self.data = inflate_block(read_raw_block(self.handle))
+            self.block_offset = block_offset
+        self.within = within
+
+    def _next_block(self):
+        self.block_offset = self.handle.tell()
+        block = read_raw_block(self.handle)
+        self.data = inflate_block(block) if block else b''
+        self.within = 0
+        return bool(block)
+
+    def readline(self):
+        parts = []
+        while True:
+            end = self.data.find(b'\n', self.within)
+            if end >= 0:
+                parts.append(self.data[self.within:end + 1])
+                self.within = end + 1
+                return b''.join(parts)
+            parts.append(self.data[self.within:])
+            if not self._next_block():
+                return b''.join(parts)
+
+    def read_until(self, virtual_end):
+        """Read from the current position up to (not including) virtual_end."""
+        end_block, end_within = split_virtual_offset(virtual_end)
+        parts = []
+        while self.block_offset < end_block:
+            parts.append(self.data[self.within:])
+            if not self._next_block():
+                return b''.join(parts)
+        parts.append(self.data[self.within:end_within])
+        self.within = max(self.within, end_within)
+        return b''.join(parts)
+
+    def close(self):
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
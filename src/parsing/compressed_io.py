@@ -0,0 +1,227 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import io
+import os
+import queue
+import threading
+from src.parsing import bgzf
+
+# zlib releases the GIL while it inflates or deflates, so threads overlap
+# (de)compression with the parsing done by the main thread.
+COMPRESSION_THREADS = min(4, os.cpu_count() or 1)
+READ_AHEAD_SIZE = 1024 * 1024
+READ_AHEAD_DEPTH = 8
+# Raw BGZF blocks inflated per task, and uncompressed bytes deflated per task
+BLOCKS_PER_TASK = 16
+COMPRESS_TASK_SIZE = 16 * bgzf.MAX_BLOCK_DATA
+COMPRESSION_LEVEL = 6
+
+GZIP = "gzip"
+BGZF = "bgzf"
+COMPRESSIONS = (GZIP, BGZF)
+EXTENSIONS = ('.gz', '.bgz')
+
+
+class _ChunkReader(io.RawIOBase):
+    # Raw stream over an iterator of bytes chunks; subclasses provide the chunks
+
+    def __init__(self):
+        self.chunk = b''
+        self.position = 0
+        self.chunks = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.position >= len(self.chunk):
+            self.chunk = next(self.chunks, b'')
+            self.position = 0
+            if not self.chunk:
+                return 0
+        size = min(len(buffer), len(self.chunk) - self.position)
+        buffer[:size] = self.chunk[self.position:self.position + size]
+        self.position += size
+        return size
+
+
+class ReadAheadReader(_ChunkReader):
+    """Read a stream (e.g. a gzip file) on a background thread into a bounded queue."""
+
+    def __init__(self, handle, chunk_size=READ_AHEAD_SIZE, depth=READ_AHEAD_DEPTH):
+        super().__init__()
+        self.handle = handle
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+        self.chunks = self._consume()
+
+    def _produce(self):
+        try:
+            while not self.stopped.is_set():
+                data = self.handle.read(self.chunk_size)
+                self._put(data)
+                if not data:
+                    return
+        except BaseException as e:
+            self._put(e)
+
+    def _put(self, item):
+        # Give up when the reader is closed before the end of the stream
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _consume(self):
+        while True:
+            item = self.queue.get()
+            if isinstance(item, BaseException):
+                raise item
+            if not item:
+                return
+            yield item
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+            self.handle.close()
+        super().close()
+
+
+class ParallelBgzfReader(_ChunkReader):
+    """Inflate the blocks of a BGZF file on a thread pool, returning the data in order."""
+
+    def __init__(self, file_path, threads=COMPRESSION_THREADS):
+        super().__init__()
+        self.handle = open(file_path, 'rb')
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.in_flight = 2 * threads
+        self.chunks = self._inflate_all()
+
+    def _read_task(self):
+        blocks = []
+        for _ in range(BLOCKS_PER_TASK):
+            block = bgzf.read_raw_block(self.handle)
+            if not block:
+                break
+            blocks.append(block)
+        return blocks
+
+    def _inflate_all(self):
+        pending = deque()
+        while True:
+            while len(pending) < self.in_flight:
+                blocks = self._read_task()
+                if not blocks:
+                    break
+                pending.append(self.executor.submit(_inflate_blocks, blocks))
+            if not pending:
+                return
+            yield pending.popleft().result()
+
+    def close(self):
+        if not self.closed:
+            self.executor.shutdown(cancel_futures=True)
+            self.handle.close()
+        super().close()
+
+
+def _inflate_blocks(blocks):
+    return b''.join([bgzf.inflate_block(block) for block in blocks])
+
+
+class ParallelCompressWriter(io.RawIOBase):
+    """Compress written data in independent pieces on a thread pool and write them in order.
+
+    With BGZF every piece becomes a series of BGZF blocks; with gzip every piece
+    becomes a gzip member. Both are read back by any gzip reader as one stream.
+    """
+
+    def __init__(self, file_path, compression=GZIP, threads=COMPRESSION_THREADS,
+                 level=COMPRESSION_LEVEL, task_size=COMPRESS_TASK_SIZE):
+        super().__init__()
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression: {compression}. Choose from {', '.join(COMPRESSIONS)}")
+        self.handle = open(file_path, 'wb')
+        self.compression = compression
+        self.level = level
+        self.task_size = task_size
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.in_flight = 2 * threads
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.append(bytes(data))
+        self.buffered += len(data)
+        if self.buffered >= self.task_size:
+            self._submit()
+        return len(data)
+
+    def _submit(self):
+        data = b''.join(self.buffer)
+        self.buffer, self.buffered = [], 0
+        compress = bgzf.compress_blocks if self.compression == BGZF else _compress_member
+        self.pending.append(self.executor.submit(compress, data, self.level))
+        while len(self.pending) >= self.in_flight:
+            self.handle.write(self.pending.popleft().result())
+
+    def close(self):
+        if not self.closed:
+            try:
+                if self.buffered:
+                    self._submit()
+                while self.pending:
+                    self.handle.write(self.pending.popleft().result())
+                if self.compression == BGZF:
+                    self.handle.write(bgzf.EOF_BLOCK)
+            finally:
+                self.executor.shutdown()
+                self.handle.close()
+        super().close()
+
+
+def _compress_member(data, level):
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def is_compressed(file_path):
+    return file_path.endswith(EXTENSIONS)
+
+
+def open_input(file_path, threads=COMPRESSION_THREADS):
+    """Open a plain, gzip or BGZF file for sequential binary reading.
+
+    BGZF blocks are inflated in parallel and gzip streams are inflated on a
+    background thread while the caller parses the previous data.
+    """
+    if not is_compressed(file_path):
+        return open(file_path, 'rb')
+    if bgzf.is_bgzf(file_path):
+        raw = ParallelBgzfReader(file_path, threads)
+    else:
+        raw = ReadAheadReader(gzip.open(file_path, 'rb'))
+    return io.BufferedReader(raw, buffer_size=READ_AHEAD_SIZE)
+
+
+def open_output(file_path, compression=None, threads=COMPRESSION_THREADS):
+    """Open a binary output file, compressed with gzip or BGZF on a thread pool if requested."""
+    if not compression:
+        return open(file_path, 'wb')
+    return io.BufferedWriter(ParallelCompressWriter(file_path, compression, threads), buffer_size=READ_AHEAD_SIZE)
+
+
+def output_path(file_path, compression=None):
+    """Add the .gz extension to an output path when it is compressed."""
+    return file_path + '.gz' if compression and not file_path.endswith('.gz') else file_path
@@ -0,0 +1,145 @@
+from collections import Counter, OrderedDict
+import gzip
+import os
+import re
+from src.parsing import fastq_reader
+from src.statistic.statistic import FastqStat
+
+UNCLASSIFIED = "unclassified"
+MAX_OPEN_FILES = 64
+GROUP_BUFFER_SIZE = 256 * 1024
+MAX_BUFFERED = 64 * 1024 * 1024
+
+_UNSAFE_CHARACTERS = re.compile(r'[^A-Za-z0-9._-]')
+
+
+def record_group(record):
+    """Return the barcode_group of a record ('barcode=' header tag) or 'unclassified'."""
+    return FastqStat.record_barcode_group(record) or UNCLASSIFIED
+
+
+def group_fastq_bytes(records, grouped=None):
+    """Collect the FASTQ bytes of records per barcode group.
+
+    Returns {group: [list of FASTQ bytes, record count]}, used by parallel
+    workers to hand a chunk over to the demultiplexer in the main process.
+    """
+    grouped = {} if grouped is None else grouped
+    for record in records:
+        entry = grouped.setdefault(record_group(record), [[], 0])
+        entry[0].append(fastq_reader.to_fastq_bytes(record))
+        entry[1] += 1
+    return grouped
+
+
+class HandlePool:
+    """Output files kept open in LRU order, with at most max_open open at a time.
+
+    A file is truncated the first time it is opened and appended to when it is
+    reopened after being evicted. Gzip files are reopened as a new gzip member,
+    which gzip readers handle transparently.
+    """
+
+    def __init__(self, max_open=MAX_OPEN_FILES, compress=False):
+        self.max_open = max_open
+        self.compress = compress
+        self.handles = OrderedDict()
+        self.created = set()
+
+    def get(self, path):
+        handle = self.handles.get(path)
+        if handle is not None:
+            self.handles.move_to_end(path)
+            return handle
+
+        if len(self.handles) >= self.max_open:
+            _, oldest = self.handles.popitem(last=False)
+            oldest.close()
+        mode = "ab" if path in self.created else "wb"
+        handle = gzip.open(path, mode) if self.compress else open(path, mode)
+        self.created.add(path)
+        self.handles[path] = handle
+        return handle
+
+    def close(self):
+        while self.handles:
+            _, handle = self.handles.popitem(last=False)
+            handle.close()
+
+
+class BarcodeDemultiplexer:
+    """Stream records into one FASTQ file per barcode group.
+
+    Only a counter and a small write buffer are kept per group. Without an
+    output directory (count-only mode) nothing is written and only the
+    counters are kept.
+    """
+
+    def __init__(self, output_dir=None, compress=False, max_open_files=MAX_OPEN_FILES,
+                 group_buffer_size=GROUP_BUFFER_SIZE, max_buffered=MAX_BUFFERED):
+        self.output_dir = output_dir
+        self.compress = compress
+        self.group_buffer_size = group_buffer_size
+        self.max_buffered = max_buffered
+        self.counts = Counter()
+        self.buffers = {}
+        self.buffered = 0
+        self.paths = {}
+        self.pool = HandlePool(max_open_files, compress)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+
+    @property
+    def count_only(self):
+        return not self.output_dir
+
+    def group_path(self, group):
+        path = self.paths.get(group)
+        if path is None:
+            extension = ".fastq.gz" if self.compress else ".fastq"
+            path = os.path.join(self.output_dir, _UNSAFE_CHARACTERS.sub('_', group) + extension)
+            self.paths[group] = path
+        return path
+
+    def add_records(self, records):
+        if self.count_only:
+            self.counts.update(record_group(record) for record in records)
+            return
+        for group, (data, count) in group_fastq_bytes(records).items():
+            self.write(group, data, count)
+
+    def write(self, group, data, count):
+        """Append a list of FASTQ bytes holding count records to the file of a group."""
+        self.counts[group] += count
+        if self.count_only:
+            return
+        buffer = self.buffers.setdefault(group, [[], 0])
+        size = sum(len(item) for item in data)
+        buffer[0].extend(data)
+        buffer[1] += size
+        self.buffered += size
+        if buffer[1] >= self.group_buffer_size:
+            self.flush(group)
+        elif self.buffered >= self.max_buffered:
+            self.flush_all()
+
+    def flush(self, group):
+        buffer = self.buffers.pop(group, None)
+        if not buffer:
+            return
+        self.buffered -= buffer[1]
+        self.pool.get(self.group_path(group)).write(b''.join(buffer[0]))
+
+    def flush_all(self):
+        for group in list(self.buffers):
+            self.flush(group)
+
+    def close(self):
+        self.flush_all()
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
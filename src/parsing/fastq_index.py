@@ -0,0 +1,327 @@
+import gzip
+import json
+import logging
+import os
+import struct
+import sys
+import numpy as np
+from src.parsing import bgzf, fastq_reader
+from src.statistic.accumulators import Histogram, LENGTH_EDGES
+
+# Sidecar index of a FASTQ file, stored next to it as <input>.fqi:
+#   magic | record count (uint64) | trailer offset (uint64) | records | JSON trailer
+# The records are a packed array of INDEX_DTYPE that is memory-mapped on load.
+# The trailer holds what is needed to detect a stale index.
+INDEX_SUFFIX = ".fqi"
+INDEX_MAGIC = b"FQI\x02"
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('length', '<u4')])
+_PREAMBLE = struct.Struct('<4sQQ')
+
+PLAIN = "plain"
+GZIP = "gzip"
+BGZF = "bgzf"
+
+
+def index_path_for(file_path):
+    return file_path + INDEX_SUFFIX
+
+
+def detect_compression(file_path):
+    if bgzf.is_bgzf(file_path):
+        return BGZF
+    with open(file_path, 'rb') as handle:
+        return GZIP if handle.read(2) == b'\x1f\x8b' else PLAIN
+
+
+def _source_state(file_path):
+    status = os.stat(file_path)
+    return {'source_size': status.st_size, 'source_mtime_ns': status.st_mtime_ns}
+
+
+def _iter_data(file_path, compression, chunk_size, blocks):
+    # Decompressed data of the file; for BGZF the (uncompressed start,
+    # compressed offset) of every block is appended to blocks
+    if compression == BGZF:
+        position = 0
+        with open(file_path, 'rb') as handle:
+            for block_offset, data in bgzf.iter_blocks(handle):
+                blocks.append((position, block_offset))
+                position += len(data)
+                yield data
+            blocks.append((position, handle.tell()))
+        return
+    with fastq_reader.open_fastq(file_path) as handle:
+        while True:
+            data = handle.read(chunk_size)
+            if not data:
+                return
+            yield data
+
+
+def _iter_chunks(data_pieces):
+    # Like fastq_reader.iter_record_chunks: (uncompressed start, block of whole records)
+    position = 0
+    remainder = b''
+    for data in data_pieces:
+        data = remainder + data
+        cut = fastq_reader._four_line_cut(data)
+        if cut:
+            yield position, data[:cut]
+            position += cut
+        remainder = data[cut:]
+    if remainder.strip():
+        yield position, remainder
+
+
+def _virtual_offsets(offsets, blocks):
+    # Convert uncompressed offsets to BGZF virtual offsets
+    starts = np.array([start for start, _ in blocks], dtype=np.uint64)
+    block_offsets = np.array([offset for _, offset in blocks], dtype=np.uint64)
+    index = np.searchsorted(starts, offsets, side='right') - 1
+    return (block_offsets[index] << np.uint64(16)) | (offsets - starts[index])
+
+
+def build_index(file_path, index_path=None, chunk_size=fastq_reader.CHUNK_SIZE):
+    """Scan a FASTQ file once and write its offset index; return the loaded FastqIndex.
+
+    Like the chunked parallel mode, indexing requires the standard 4-line layout.
+    """
+    index_path = index_path or index_path_for(file_path)
+    compression = detect_compression(file_path)
+    blocks = []
+    records = 0
+    data_end = 0
+
+    temporary_path = index_path + ".tmp"
+    try:
+        with open(temporary_path, 'wb') as out_handle:
+            out_handle.write(_PREAMBLE.pack(INDEX_MAGIC, 0, 0))
+            for position, chunk in _iter_chunks(_iter_data(file_path, compression, chunk_size, blocks)):
+                chunk_records = fastq_reader.parse_chunk(chunk)
+                newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == 10)
+                entries = np.zeros(len(chunk_records), dtype=INDEX_DTYPE)
+                entries['offset'][1:] = newlines[3:4 * len(chunk_records) - 1:4] + 1
+                entries['offset'] += position
+                entries['length'] = [len(record.seq) for record in chunk_records]
+                entries.tofile(out_handle)
+                records += len(chunk_records)
+                data_end = position + len(chunk)
+
+            trailer = {
+                'compression': compression,
+                'data_end': data_end,
+            }
+            trailer.update(_source_state(file_path))
+            trailer_offset = out_handle.tell()
+            out_handle.write(json.dumps(trailer).encode())
+            out_handle.seek(0)
+            out_handle.write(_PREAMBLE.pack(INDEX_MAGIC, records, trailer_offset))
+
+        if compression == BGZF:
+            # Offsets were collected in decompressed coordinates; rewrite them in place
+            entries = np.memmap(temporary_path, dtype=INDEX_DTYPE, mode='r+', offset=_PREAMBLE.size, shape=(records,)) \
+                if records else np.zeros(0, dtype=INDEX_DTYPE)
+            entries['offset'] = _virtual_offsets(entries['offset'], blocks)
+            trailer['data_end'] = int(_virtual_offsets(np.array([data_end], dtype=np.uint64), blocks)[0])
+            del entries
+            with open(temporary_path, 'r+b') as out_handle:
+                out_handle.seek(trailer_offset)
+                out_handle.write(json.dumps(trailer).encode())
+                out_handle.truncate()
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+    os.replace(temporary_path, index_path)
+    return FastqIndex(file_path, index_path)
+
+
+def _open_random_access(file_path, compression):
+    if compression == BGZF:
+        return bgzf.BgzfReader(file_path)
+    return gzip.open(file_path, 'rb') if compression == GZIP else open(file_path, 'rb')
+
+
+def read_range(file_path, compression, start, end, handle=None):
+    """Return the raw bytes of the file between two index offsets.
+
+    Plain files are read directly, BGZF files from the block holding start.
+    Gzip files have no random access: the stream is decompressed up to start.
+    """
+    close = handle is None
+    if handle is None:
+        handle = _open_random_access(file_path, compression)
+    try:
+        handle.seek(start)
+        if compression == BGZF:
+            return handle.read_until(end)
+        return handle.read(end - start)
+    finally:
+        if close:
+            handle.close()
+
+
+def load_chunk(chunk):
+    """Return the bytes of a work item: either raw bytes or a (file_path, compression, start, end) range."""
+    if isinstance(chunk, bytes):
+        return chunk
+    return read_range(*chunk)
+
+
+def iter_work_chunks(file_path, chunk_size=fastq_reader.CHUNK_SIZE, use_index=False):
+    """Work items of the parallel mode: index ranges read by the workers, or raw blocks.
+
+    Gzip files cannot be read from an offset, so they are always streamed and
+    no index is built for them.
+    """
+    if use_index:
+        if detect_compression(file_path) == GZIP:
+            logging.warning(f"{file_path} is gzip, not BGZF, so it cannot be split with an index; "
+                            f"it is not indexed. Use bgzip for random access")
+        else:
+            index = FastqIndex.load_or_build(file_path)
+            logging.info(f"Splitting {file_path} with its index ({len(index)} records)")
+            return index.chunk_ranges(chunk_size)
+    return fastq_reader.iter_record_chunks(file_path, chunk_size)
+
+
+class FastqIndex:
+    """Memory-mapped offset index of a FASTQ file.
+
+    offsets[n] is the byte offset of record n (a virtual offset for BGZF
+    files) and lengths[n] its read length.
+    """
+
+    def __init__(self, file_path, index_path=None):
+        self.file_path = file_path
+        self.index_path = index_path or index_path_for(file_path)
+        with open(self.index_path, 'rb') as handle:
+            magic, records, trailer_offset = _PREAMBLE.unpack(handle.read(_PREAMBLE.size))
+            if magic != INDEX_MAGIC:
+                raise ValueError(f"Not a FASTQ index file: {self.index_path}")
+            handle.seek(trailer_offset)
+            self.info = json.loads(handle.read())
+
+        if records:
+            self.entries = np.memmap(self.index_path, dtype=INDEX_DTYPE, mode='r', offset=_PREAMBLE.size, shape=(records,))
+        else:
+            self.entries = np.zeros(0, dtype=INDEX_DTYPE)
+        self.compression = self.info['compression']
+        self.data_end = self.info['data_end']
+        self._handle = None
+
+    @classmethod
+    def load_or_build(cls, file_path):
+        """Load the index next to a FASTQ file, (re)building it if it is missing or stale."""
+        index = cls.load_current(file_path)
+        if index is None:
+            logging.info(f"Indexing {file_path}")
+            index = build_index(file_path)
+        return index
+
+    @classmethod
+    def load_current(cls, file_path):
+        """Load the index next to a FASTQ file, or return None if it is missing or stale."""
+        if not os.path.isfile(index_path_for(file_path)):
+            return None
+        try:
+            index = cls(file_path)
+        except (ValueError, OSError):
+            return None
+        if not index.is_current():
+            return None
+        return index
+
+    def is_current(self):
+        """True if the FASTQ file has not changed since it was indexed."""
+        state = _source_state(self.file_path)
+        return all(self.info[key] == value for key, value in state.items())
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def offsets(self):
+        return self.entries['offset']
+
+    @property
+    def lengths(self):
+        return self.entries['length']
+
+    def record_range(self, start, stop=None):
+        """(start offset, end offset) of records start..stop-1 in the file."""
+        stop = start + 1 if stop is None else stop
+        end = int(self.offsets[stop]) if stop < len(self) else self.data_end
+        return int(self.offsets[start]), end
+
+    def get_record(self, number):
+        """Return record number (0-based) as a FastqRecord without scanning the file."""
+        if not -len(self) <= number < len(self):
+            raise IndexError(f"Record {number} out of range for {len(self)} records")
+        number %= len(self)
+        if self._handle is None:
+            self._handle = _open_random_access(self.file_path, self.compression)
+        start, end = self.record_range(number)
+        return fastq_reader.parse_chunk(read_range(self.file_path, self.compression, start, end, self._handle))[0]
+
+    def chunk_ranges(self, chunk_size=fastq_reader.CHUNK_SIZE):
+        """Split the file at record boundaries into (file_path, compression, start, end) work items.
+
+        Chunks hold about chunk_size bytes (by decompressed size for BGZF) and
+        are read by the workers themselves with load_chunk.
+        """
+        if not len(self):
+            return []
+        if self.compression == BGZF:
+            # Balance by read length, the best size estimate available for virtual offsets
+            sizes = np.cumsum(self.lengths, dtype=np.int64) * 2
+            cuts = np.searchsorted(sizes, np.arange(chunk_size, sizes[-1], chunk_size))
+        else:
+            cuts = np.searchsorted(self.offsets, np.arange(chunk_size, self.data_end, chunk_size))
+        cuts = np.unique(np.concatenate([[0], cuts]))
+        cuts = cuts[cuts < len(self)].tolist() + [len(self)]
+        return [
+            (self.file_path, self.compression) + self.record_range(start, stop)
+            for start, stop in zip(cuts, cuts[1:])
+        ]
+
+    def split(self, parts):
+        """Split the file into the given number of chunks of balanced size."""
+        size = self.data_end if self.compression != BGZF else int(self.lengths.sum(dtype=np.int64)) * 2
+        return self.chunk_ranges(max(1, -(-size // max(1, parts))))
+
+    def length_histogram(self):
+        histogram = Histogram(LENGTH_EDGES)
+        histogram.update(self.lengths.astype(np.float64))
+        return histogram
+
+    def summary(self):
+        lengths = self.lengths
+        return {
+            'reads': len(self),
+            'bases': int(lengths.sum(dtype=np.int64)),
+            'min_length': int(lengths.min()) if len(self) else None,
+            'max_length': int(lengths.max()) if len(self) else None,
+            'n50': self.length_histogram().weighted_median(),
+        }
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python -m src.parsing.fastq_index input.fastq")
+        sys.exit(1)
+
+    with FastqIndex.load_or_build(sys.argv[1]) as fastq_index:
+        for key, value in fastq_index.summary().items():
+            print(f"{key}: {value}")
@@ -0,0 +1,249 @@
+from itertools import chain, zip_longest
+import io
+import sys
+from src.parsing import compressed_io
+
+# Readers selectable by FastqParser, FastqStat and filter_fastq
+NATIVE = "native"
+SEQIO = "seqio"
+READERS = (NATIVE, SEQIO)
+
+CHUNK_SIZE = 4 * 1024 * 1024
+PHRED_OFFSET = 33
+
+# Maps every valid Sanger quality character to its Phred score. The other
+# characters are mapped to 0xFF so an invalid quality string can be detected
+# after a single bytes.translate call.
+_PHRED_TABLE = bytes(
+    byte - PHRED_OFFSET if PHRED_OFFSET <= byte < PHRED_OFFSET + 94 else 0xFF
+    for byte in range(256)
+)
+
+
+class FastqRecord:
+    """Lightweight FASTQ record holding the raw bytes of its three fields.
+
+    The attribute names follow SeqRecord closely enough for the helpers in
+    this project (id, description, seq, letter_annotations), but nothing is
+    decoded until it is asked for.
+    """
+    __slots__ = ('title', 'seq', 'qual', '_phred')
+
+    def __init__(self, title, seq, qual):
+        self.title = title
+        self.seq = seq
+        self.qual = qual
+        self._phred = None
+
+    @property
+    def id(self):
+        return self.title.split(None, 1)[0].decode()
+
+    @property
+    def description(self):
+        return self.title.decode()
+
+    @property
+    def phred_quality(self):
+        """Phred scores as a bytes object of ints, decoded on first use."""
+        if self._phred is None:
+            phred = self.qual.translate(_PHRED_TABLE)
+            if b'\xff' in phred:
+                raise ValueError("Invalid character in quality string")
+            self._phred = phred
+        return self._phred
+
+    @property
+    def letter_annotations(self):
+        return {"phred_quality": self.phred_quality}
+
+    def __len__(self):
+        return len(self.seq)
+
+    def to_bytes(self):
+        """Return the record in the same 4-line layout SeqIO.write produces."""
+        return b'@' + self.title + b'\n' + self.seq + b'\n+\n' + self.qual + b'\n'
+
+
+def to_fastq_bytes(record):
+    """Format a FastqRecord or SeqRecord as FASTQ bytes."""
+    if isinstance(record, FastqRecord):
+        return record.to_bytes()
+    return record.format("fastq").encode()
+
+
+def open_fastq(file_path, binary=True):
+    # Compressed input is inflated on background threads while it is parsed
+    handle = compressed_io.open_input(file_path)
+    return handle if binary else io.TextIOWrapper(handle)
+
+
+def _read_lines(handle, chunk_size):
+    # Split large binary chunks into lines, carrying the incomplete last line over
+    remainder = b''
+    while True:
+        chunk = handle.read(chunk_size)
+        if not chunk:
+            break
+        lines = (remainder + chunk).split(b'\n')
+        remainder = lines.pop()
+        yield lines
+    if remainder:
+        yield [remainder]
+
+
+def parse_records(handle, chunk_size=CHUNK_SIZE):
+    """Parse FASTQ records from a binary handle.
+
+    The rules are the same as Bio.SeqIO's FASTQ parser, including multi-line
+    sequences and the optional repeated title on the '+' line.
+    """
+    lines = map(bytes.rstrip, chain.from_iterable(_read_lines(handle, chunk_size)))
+    line = next(lines, None)
+
+    # Blank lines between records are read as empty quality lines, as SeqIO does;
+    # a blank first line is an error like any line not starting with '@'
+    while line is not None:
+        if line[:1] != b'@':
+            raise ValueError("Records in Fastq files should start with '@' character")
+        title = line[1:]
+
+        seq_lines = []
+        for line in lines:
+            if line[:1] == b'+':
+                break
+            seq_lines.append(line)
+        else:
+            if seq_lines:
+                raise ValueError("End of file without quality information.")
+            raise ValueError("Unexpected end of file")
+
+        second_title = line[1:]
+        if second_title and second_title != title:
+            raise ValueError("Sequence and quality captions differ.")
+        seq = seq_lines[0] if len(seq_lines) == 1 else b''.join(seq_lines)
+        if b' ' in seq or b'\t' in seq:
+            raise ValueError("Whitespace is not allowed in the sequence.")
+        seq_len = len(seq)
+
+        # A quality line may itself start with '@', so the record only ends
+        # once enough quality characters have been read
+        qual_lines = []
+        qual_len = 0
+        line = None
+        for line in lines:
+            if line[:1] == b'@' and qual_len >= seq_len:
+                break
+            qual_lines.append(line)
+            qual_len += len(line)
+        else:
+            if line is None:
+                raise ValueError("Unexpected end of file")
+            line = None
+
+        qual = qual_lines[0] if len(qual_lines) == 1 else b''.join(qual_lines)
+        if seq_len != len(qual):
+            raise ValueError(
+                "Lengths of sequence and quality values differs for %s (%i and %i)."
+                % (title.decode(), seq_len, len(qual))
+            )
+        yield FastqRecord(title, seq, qual)
+
+
+def _four_line_cut(data):
+    # Position just after the last complete 4-line record in data, 0 if there is none
+    end = data.rfind(b'\n') + 1
+    for _ in range(data.count(b'\n', 0, end) % 4):
+        end = data.rfind(b'\n', 0, end - 1) + 1
+    return end
+
+
+def iter_record_chunks(file_path, chunk_size=CHUNK_SIZE):
+    """Yield raw blocks of about chunk_size bytes that hold whole records.
+
+    Blocks are cut every fourth line, so they are only record-aligned for the
+    standard 4-line FASTQ layout. parse_chunk checks this for every block.
+    """
+    with open_fastq(file_path) as handle:
+        remainder = b''
+        while True:
+            data = handle.read(chunk_size)
+            if not data:
+                break
+            data = remainder + data
+            cut = _four_line_cut(data)
+            if cut:
+                yield data[:cut]
+            remainder = data[cut:]
+        if remainder.strip():
+            yield remainder
+
+
+def parse_chunk(chunk, reader=NATIVE):
+    """Parse a block from iter_record_chunks into a list of records."""
+    if reader == NATIVE:
+        records = list(parse_records(io.BytesIO(chunk)))
+    elif reader == SEQIO:
+        from Bio import SeqIO
+        records = list(SeqIO.parse(io.StringIO(chunk.decode()), "fastq"))
+    else:
+        raise ValueError(f"Unknown FASTQ reader: {reader}. Choose from {', '.join(READERS)}")
+
+    lines = chunk.count(b'\n') + (not chunk.endswith(b'\n'))
+    if lines != 4 * len(records):
+        raise ValueError("Chunked processing requires FASTQ records of exactly 4 lines")
+    return records
+
+
+def read_fastq(file_path, reader=NATIVE, chunk_size=CHUNK_SIZE):
+    """Yield the records of a plain or gzipped FASTQ file with the chosen reader."""
+    if reader == NATIVE:
+        with open_fastq(file_path) as handle:
+            yield from parse_records(handle, chunk_size)
+    elif reader == SEQIO:
+        from Bio import SeqIO
+        with open_fastq(file_path, binary=False) as handle:
+            yield from SeqIO.parse(handle, "fastq")
+    else:
+        raise ValueError(f"Unknown FASTQ reader: {reader}. Choose from {', '.join(READERS)}")
+
+
+def record_difference(native, record):
+    """Name the first field in which a FastqRecord and a SeqRecord differ, None if they are the same."""
+    if native.id != record.id:
+        return f"id {native.id} != {record.id}"
+    if native.description != record.description:
+        return "description differs"
+    if native.seq.decode() != str(record.seq):
+        return "sequence differs"
+    if list(native.phred_quality) != record.letter_annotations["phred_quality"]:
+        return "qualities differ"
+    if native.to_bytes().decode() != record.format("fastq"):
+        return "output differs"
+    return None
+
+
+def compare_with_seqio(file_path):
+    """Check that the native reader returns the same records as Bio.SeqIO.
+
+    Returns the number of records compared and raises ValueError on the
+    first record that differs.
+    """
+    count = 0
+    pairs = zip_longest(read_fastq(file_path, NATIVE), read_fastq(file_path, SEQIO))
+    for count, (native, record) in enumerate(pairs, 1):
+        if native is None or record is None:
+            raise ValueError(f"Record {count}: record counts differ")
+        difference = record_difference(native, record)
+        if difference is not None:
+            raise ValueError(f"Record {count}: {difference}")
+    return count
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python -m src.parsing.fastq_reader input.fastq")
+        sys.exit(1)
+
+    compared = compare_with_seqio(sys.argv[1])
+    print(f"{compared} records are identical between the native reader and Bio.SeqIO")
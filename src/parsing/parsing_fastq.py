@@ -1,66 +1,96 @@
-from Bio import SeqIO
-import gzip
-import os
-
-class FastqParser:
-    def __init__(self, file_path):
-        self.file_path = file_path
-        self.grouped_sequences = {}
-        
-
-    def parse_fastq(self):
-        if not os.path.isfile(self.file_path):
-            raise FileNotFoundError("FASTQ file not found:{self.file_path}")
-        
-        if self.file_path.endswith('.gz'):
-            handle = gzip.open(self.file_path, "rt")
-        else:
-            handle = open(self.file_path, "r")
-
-        for record in SeqIO.parse(handle, "fastq"):
-            
-            group, barcode_seq = self.extract_barcode(record)
-            
-            if barcode_seq and group:
-                combined_key = f"{barcode_seq}_{group}"
-            else:
-                combined_key = "No Barcode_No Group"
-
-            if combined_key not in self.grouped_sequences:
-                self.grouped_sequences[combined_key] = {
-                    'barcode_seq': barcode_seq,
-                    'group': group if group else "No Group",
-                    'sequences': []
-                }
-
-            self.grouped_sequences[combined_key]['sequences'].append(str(record.seq))
-
-        handle.close()
-
-    def extract_barcode(self, record):
-        
-        barcode_seq = str(record.seq[:6])
-        
-        if 'barcode=' in record.description:
-            group = record.description.split('barcode=')[1].split()[0]
-        else:
-            group = None 
-        
-        return group, barcode_seq
-
-    def print_grouped_sequences(self):
-        output = []
-        for key, data in self.grouped_sequences.items():
-            barcode_seq = data['barcode_seq']
-            group = data['group']
-            output.append(f"Barcode: {barcode_seq}, Number of Sequences: {len(data['sequences'])}, group={group}")
-            for seq in data['sequences']:
-                output.append(f"  Sequence: {seq}") 
-        output.append("\n")
-        return "\n".join(output)
-    
-    def get_grouped_sequences(self):
-        return self.grouped_sequences
-
-
-
+from src.parsing import fastq_reader
+import os
+
+class FastqParser:
+    def __init__(self, file_path, reader=fastq_reader.NATIVE, keep_sequences=True, whitelist=None):
+        self.file_path = file_path
+        self.reader = reader
+        # Optional BarcodeWhitelist used to assign the barcode with mismatches
+        self.whitelist = whitelist
+        # Count-only mode keeps a counter per group instead of every sequence
+        self.keep_sequences = keep_sequences
+        self.grouped_sequences = {}
+        
+
+    def parse_fastq(self):
+        if not os.path.isfile(self.file_path):
+            raise FileNotFoundError("FASTQ file not found:{self.file_path}")
+
+        for record in fastq_reader.read_fastq(self.file_path, self.reader):
+            self.add_record(record)
+
+    def add_record(self, record):
+        group, barcode_seq = self.extract_barcode(record)
+        
+        if barcode_seq and group:
+            combined_key = f"{barcode_seq}_{group}"
+        else:
+            combined_key = "No Barcode_No Group"
+
+        if combined_key not in self.grouped_sequences:
+            self.grouped_sequences[combined_key] = {
+                'barcode_seq': barcode_seq,
+                'group': group if group else "No Group",
+                'count': 0,
+                'sequences': []
+            }
+
+        self.grouped_sequences[combined_key]['count'] += 1
+        if self.keep_sequences:
+            self.grouped_sequences[combined_key]['sequences'].append(bytes(record.seq).decode())
+        return combined_key
+
+    def add_group(self, combined_key, barcode_seq, group, count):
+        # Add the count of a group without its sequences, e.g. from the result cache
+        if combined_key not in self.grouped_sequences:
+            self.grouped_sequences[combined_key] = {
+                'barcode_seq': barcode_seq,
+                'group': group,
+                'count': 0,
+                'sequences': []
+            }
+        self.grouped_sequences[combined_key]['count'] += count
+
+    def merge(self, other):
+        # Append the groups of another parser, e.g. one that parsed a later chunk of the file
+        for combined_key, data in other.grouped_sequences.items():
+            if combined_key not in self.grouped_sequences:
+                self.grouped_sequences[combined_key] = {
+                    'barcode_seq': data['barcode_seq'],
+                    'group': data['group'],
+                    'count': 0,
+                    'sequences': []
+                }
+            self.grouped_sequences[combined_key]['count'] += data['count']
+            self.grouped_sequences[combined_key]['sequences'].extend(data['sequences'])
+
+    def extract_barcode(self, record):
+        
+        if self.whitelist is not None:
+            barcode_seq = self.whitelist.assign(bytes(record.seq[:self.whitelist.barcode_length]).decode())
+        else:
+            barcode_seq = bytes(record.seq[:6]).decode()
+        
+        if 'barcode=' in record.description:
+            group = record.description.split('barcode=')[1].split()[0]
+        else:
+            group = None 
+        
+        return group, barcode_seq
+
+    def print_grouped_sequences(self):
+        output = []
+        for key, data in self.grouped_sequences.items():
+            barcode_seq = data['barcode_seq']
+            group = data['group']
+            output.append(f"Barcode: {barcode_seq}, Number of Sequences: {data['count']}, group={group}")
+            for seq in data['sequences']:
+                output.append(f"  Sequence: {seq}")
+        output.append("\n")
+        return "\n".join(output)
+    
+    def get_grouped_sequences(self):
+        return self.grouped_sequences
+
+
+
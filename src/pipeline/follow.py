@@ -0,0 +1,287 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from src.parsing import fastq_reader, compressed_io
+from src.statistic.accumulators import StreamingStats
+from src.statistic.batch_metrics import iter_batches, RecordBatch
+from src.statistic.metrics_writer import MetricsCsvWriter
+from src.constants import CHECKPOINT_FILE, POLL_INTERVAL, IDLE_TIMEOUT
+
+# Follow mode tails a FASTQ file that is still being written (e.g. by MinKNOW).
+# Only complete 4-line records are processed; a partial record at the end is
+# read again on the next poll. When the input stops growing, a last record
+# without its final newline is processed too. After every poll that found new records the
+# byte offset and the accumulator state are written to the checkpoint, so a
+# restart resumes where the last checkpoint left off.
+CHECKPOINT_VERSION = 1
+# A checkpoint is also written after every CHECKPOINT_BYTES of a long backlog
+CHECKPOINT_BYTES = 64 * 1024 * 1024
+# Bytes at the start of the input hashed to recognise it on resume
+HEAD_SIZE = 64 * 1024
+
+
+def _head_hash(file_path, size):
+    with open(file_path, 'rb') as handle:
+        return hashlib.blake2b(handle.read(min(size, HEAD_SIZE)), digest_size=16).hexdigest()
+
+
+def _groups_to_list(parser):
+    return [[key, data['barcode_seq'], data['group'], data['count']] for key, data in parser.grouped_sequences.items()]
+
+
+class FollowRunner:
+    """Process the records appended to the input of a FusedPipeline until it stops growing.
+
+    The filtered FASTQ and the statistics CSV files are appended to. The run
+    ends when the input has not grown for idle_timeout seconds or on Ctrl-C;
+    either way the pipeline then holds the statistics of every record seen.
+    """
+
+    def __init__(self, pipeline, checkpoint_path, poll_interval=POLL_INTERVAL, idle_timeout=IDLE_TIMEOUT,
+                 chunk_size=fastq_reader.CHUNK_SIZE):
+        self.pipeline = pipeline
+        self.checkpoint_path = checkpoint_path
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.chunk_size = chunk_size
+        self.offset = 0
+        self.out_handle = None
+        self.unsaved = 0
+
+    def check_supported(self):
+        pipeline = self.pipeline
+        if not os.path.isfile(pipeline.input_file):
+            raise FileNotFoundError(f"FASTQ file not found:{pipeline.input_file}")
+        if pipeline.input_file.endswith(compressed_io.EXTENSIONS):
+            raise ValueError("--follow needs an uncompressed FASTQ input")
+        if pipeline.compress:
+            raise ValueError("--follow cannot append to a compressed filtered FASTQ")
+        if pipeline.demux_dir:
+            raise ValueError("--follow does not support --demux")
+        if pipeline.duplicates is not None:
+            raise ValueError("--follow does not support duplicate detection")
+        if pipeline.quality_profile is not None:
+            raise ValueError("--follow does not support --quality_profile")
+        if not pipeline.original_csv:
+            raise ValueError("--follow needs the statistics CSV paths of the pipeline (--metrics_format csv)")
+        if pipeline.threads > 1:
+            logging.info("Follow mode processes the appended records in a single process")
+
+    def settings(self):
+        # Settings that must match for a checkpoint to be resumed
+        pipeline = self.pipeline
+        settings = {
+            'input': os.path.abspath(pipeline.input_file),
+            'barcode_length': pipeline.barcode_length,
+            'header_barcode': pipeline.header_barcode,
+            'whitelist': pipeline.whitelist.fingerprint() if pipeline.whitelist is not None else None,
+            'criteria': {predicate.reason: vars(predicate) for predicate in pipeline.engine.predicates},
+        }
+        if pipeline.trimmer is not None:
+            settings['trimming'] = pipeline.trimmer.settings()
+        return settings
+
+    def run(self):
+        """Follow the input and return (total, passed) like FusedPipeline.run."""
+        pipeline = self.pipeline
+        self.check_supported()
+        pipeline.setup_filter()
+        checkpoint = self.load_checkpoint()
+        if checkpoint is not None:
+            self.restore(checkpoint)
+        else:
+            self.open_outputs(None)
+
+        logging.info(
+            f"Following {pipeline.input_file} from byte {self.offset} "
+            f"(polling every {self.poll_interval}s, stopping after {self.idle_timeout}s without new records)"
+        )
+        try:
+            idle_since = time.monotonic()
+            while True:
+                if self.process_new_data():
+                    idle_since = time.monotonic()
+                elif time.monotonic() - idle_since >= self.idle_timeout:
+                    logging.info(f"No new records for {self.idle_timeout}s, stopping follow mode")
+                    self.process_last_record()
+                    break
+                else:
+                    time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            logging.info("Follow mode interrupted, the last checkpoint is kept")
+        finally:
+            self.out_handle.close()
+            pipeline.original_writer.close()
+            pipeline.filtered_writer.close()
+
+        pipeline.report.counters.update(
+            reads=pipeline.total, passed=pipeline.passed, failed=pipeline.total - pipeline.passed
+        )
+        logging.info(f"Filtering completed.")
+        return pipeline.total, pipeline.passed
+
+    def process_new_data(self):
+        """Process the complete records appended since the last poll; returns the bytes consumed."""
+        path = self.pipeline.input_file
+        size = os.path.getsize(path)
+        if size < self.offset:
+            raise ValueError(
+                f"{path} is shorter than the followed offset {self.offset}; "
+                f"remove {self.checkpoint_path} to start over"
+            )
+        consumed = 0
+        with open(path, 'rb') as handle:
+            handle.seek(self.offset)
+            data = b''
+            if self.offset and size > self.offset and self.after_unterminated_record(handle):
+                # The newline of a last record processed without one was appended later
+                self.offset += 1
+                self.unsaved += 1
+                consumed += 1
+                handle.seek(self.offset)
+            while self.offset + len(data) < size:
+                block = handle.read(min(self.chunk_size, size - self.offset - len(data)))
+                if not block:
+                    break
+                data += block
+                cut = fastq_reader._four_line_cut(data)
+                if not cut:
+                    # A record longer than the chunk, or the partial record at the end
+                    continue
+                self.process_records(fastq_reader.parse_chunk(data[:cut], self.pipeline.reader))
+                self.offset += cut
+                self.unsaved += cut
+                consumed += cut
+                data = data[cut:]
+                if self.unsaved >= CHECKPOINT_BYTES:
+                    self.write_checkpoint()
+        if self.unsaved:
+            self.write_checkpoint()
+        if consumed:
+            logging.info(
+                f"Processed {consumed} new bytes: {self.pipeline.total} reads so far, "
+                f"{self.pipeline.passed} passed the filter"
+            )
+        return consumed
+
+    def after_unterminated_record(self, handle):
+        # True if the offset follows a record processed without its final newline and
+        # that newline has been appended since
+        handle.seek(self.offset - 1)
+        around = handle.read(2)
+        handle.seek(self.offset)
+        return around[:1] != b'\n' and around[1:] == b'\n'
+
+    def process_last_record(self):
+        """Process a complete last record without its final newline, or warn about a partial one."""
+        path = self.pipeline.input_file
+        with open(path, 'rb') as handle:
+            handle.seek(self.offset)
+            data = handle.read()
+        if not data.strip():
+            return
+        chunk = data + b'\n'
+        try:
+            if fastq_reader._four_line_cut(chunk) != len(chunk):
+                raise ValueError("the record is not complete")
+            records = fastq_reader.parse_chunk(chunk, self.pipeline.reader)
+        except ValueError as e:
+            logging.warning(
+                f"The last {len(data)} bytes of {path} are not a complete record ({e}); "
+                f"they are processed if the record is completed and follow mode is run again"
+            )
+            return
+        self.process_records(records)
+        self.offset += len(data)
+        self.unsaved += len(data)
+        logging.info(f"Processed the last record of {path}, which has no final newline")
+        self.write_checkpoint()
+
+    def process_records(self, records):
+        pipeline = self.pipeline
+        for records_batch in iter_batches(records):
+            batch = RecordBatch(records_batch)
+            pipeline.process_batch(batch, pipeline.measure(batch), self.out_handle)
+
+    def open_outputs(self, checkpoint):
+        pipeline = self.pipeline
+        if checkpoint is None:
+            self.out_handle = open(pipeline.output_file, 'wb')
+            pipeline.original_writer = MetricsCsvWriter.open(pipeline.original_csv)
+            pipeline.filtered_writer = MetricsCsvWriter.open(pipeline.filtered_csv)
+            return
+        # Drop whatever was written after the checkpoint
+        outputs = checkpoint['outputs']
+        for path, size in ((pipeline.output_file, outputs['fastq_size']),
+                           (pipeline.original_csv, outputs['original_csv_size']),
+                           (pipeline.filtered_csv, outputs['filtered_csv_size'])):
+            if not os.path.isfile(path) or os.path.getsize(path) < size:
+                raise ValueError(f"{path} is missing or shorter than at the checkpoint; remove {self.checkpoint_path}")
+            os.truncate(path, size)
+        self.out_handle = open(pipeline.output_file, 'ab')
+        pipeline.original_writer = MetricsCsvWriter.open(pipeline.original_csv, outputs['original_rows'])
+        pipeline.filtered_writer = MetricsCsvWriter.open(pipeline.filtered_csv, outputs['filtered_rows'])
+
+    def load_checkpoint(self):
+        if not os.path.isfile(self.checkpoint_path):
+            return None
+        with open(self.checkpoint_path) as handle:
+            checkpoint = json.load(handle)
+        if checkpoint.get('version') != CHECKPOINT_VERSION or checkpoint['settings'] != self.settings():
+            raise ValueError(
+                f"{self.checkpoint_path} was written for another input or other settings; "
+                f"remove it to start over"
+            )
+        path = self.pipeline.input_file
+        if os.path.getsize(path) < checkpoint['offset'] or _head_hash(path, checkpoint['offset']) != checkpoint['head_hash']:
+            raise ValueError(f"{path} is not the file of {self.checkpoint_path}; remove it to start over")
+        return checkpoint
+
+    def restore(self, checkpoint):
+        pipeline = self.pipeline
+        self.offset = checkpoint['offset']
+        pipeline.total = checkpoint['total']
+        pipeline.passed = checkpoint['passed']
+        pipeline.report.rejections.update(checkpoint['rejections'])
+        pipeline.original_stats = StreamingStats.from_dict(checkpoint['original_stats'])
+        pipeline.filtered_stats = StreamingStats.from_dict(checkpoint['filtered_stats'])
+        for parser, groups in ((pipeline.original_parser, checkpoint['original_groups']),
+                               (pipeline.filtered_parser, checkpoint['filtered_groups'])):
+            for key, barcode_seq, group, count in groups:
+                parser.add_group(key, barcode_seq, group, count)
+        self.open_outputs(checkpoint)
+        logging.info(f"Resuming from {self.checkpoint_path}: {pipeline.total} reads were already processed")
+
+    def write_checkpoint(self):
+        pipeline = self.pipeline
+        self.out_handle.flush()
+        pipeline.original_writer.flush()
+        pipeline.filtered_writer.flush()
+        checkpoint = {
+            'version': CHECKPOINT_VERSION,
+            'settings': self.settings(),
+            'offset': self.offset,
+            'head_hash': _head_hash(pipeline.input_file, self.offset),
+            'total': pipeline.total,
+            'passed': pipeline.passed,
+            'rejections': dict(pipeline.report.rejections),
+            'original_stats': pipeline.original_stats.to_dict(),
+            'filtered_stats': pipeline.filtered_stats.to_dict(),
+            'original_groups': _groups_to_list(pipeline.original_parser),
+            'filtered_groups': _groups_to_list(pipeline.filtered_parser),
+            'outputs': {
+                'fastq_size': os.path.getsize(pipeline.output_file),
+                'original_csv_size': os.path.getsize(pipeline.original_csv),
+                'filtered_csv_size': os.path.getsize(pipeline.filtered_csv),
+                'original_rows': pipeline.original_writer.rows,
+                'filtered_rows': pipeline.filtered_writer.rows,
+            },
+        }
+        # Write the new checkpoint next to the old one and swap them atomically
+        temporary = self.checkpoint_path + ".tmp"
+        with open(temporary, 'w') as handle:
+            json.dump(checkpoint, handle)
+        os.replace(temporary, self.checkpoint_path)
+        self.unsaved = 0
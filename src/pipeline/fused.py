@@ -0,0 +1,523 @@
+from functools import partial
+from itertools import islice
+import io
+import logging
+import os
+import shutil
+import numpy as np
+from src.parsing import fastq_reader, fastq_index, compressed_io
+from src.parsing.parsing_fastq import FastqParser
+from src.parsing.demux import BarcodeDemultiplexer, group_fastq_bytes, MAX_OPEN_FILES
+from src.statistic.statistic import FastqStat
+from src.statistic.batch_metrics import iter_batches, RecordBatch, BatchMetrics
+from src.statistic.accumulators import StreamingStats
+from src.statistic.metrics_writer import MetricsCsvWriter
+from src.statistic.columnar_writer import open_metrics_writer, select_columns, ColumnBuffer
+from src.statistic.quality_profile import QualityProfile
+from src.filter.filter import log_filter_criteria, log_extra_criteria, write_passed, trim_batch
+from src.filter.predicates import FilterEngine, build_predicates, DEFAULT_WINDOW_SIZE
+from src.filter.duplicates import DUPLICATE_REASON
+from src.pipeline.parallel import ordered_map
+from src.pipeline.result_cache import cache_key, ORIGINAL_CSV
+from src.pipeline.instrumentation import RunReport
+from src.pipeline.staged import ReaderStage, QueuedWriter
+
+class FusedPipeline:
+    """Parse, analyse and filter a FASTQ file in a single pass.
+
+    Every record is decoded exactly once. In the same loop it is grouped by
+    barcode, measured for the original statistics, checked against the filter
+    criteria and, if it passes, written to the filtered FASTQ and measured
+    again for the filtered statistics. Optionally it is also demultiplexed into
+    a FASTQ file per barcode group.
+
+    With pipelined set, a single-process run parses on a reader thread and
+    writes the filtered FASTQ on a writer thread, around the main thread that
+    measures, filters and updates the statistics.
+
+    With columnar paths and a format ("parquet" or "npy") the per-read metrics
+    are written as typed columns, without building a row dict per read.
+
+    With a DuplicateDetector the reads that pass the filter criteria are
+    checked for duplicates, which are counted per barcode and, if the detector
+    removes them, left out of the filtered outputs. Duplicate detection needs
+    every read in one process, so it turns the parallel mode off.
+
+    With a Trimmer every read is clipped and trimmed before the filter
+    criteria; the filtered FASTQ, metrics and statistics hold the trimmed
+    reads, the original ones the reads as they were read. The result cache
+    stores untrimmed metrics, so it is not used with a Trimmer.
+
+    With quality_profile set the per-position and length-binned quality
+    histograms of the original and filtered reads are accumulated as well.
+    With a Trimmer they are taken from the trimmed reads, the reads the
+    filter criteria were checked against.
+
+    With a ResultCache the per-read metrics are stored on the first run; later
+    runs on the same input only re-apply the filter to the cached metrics.
+    The records are still parsed to write the filtered FASTQ, so a cache hit
+    saves measuring the reads and writing the original statistics, not the
+    parsing.
+    """
+
+    def __init__(self, input_file, output_file, barcode_length=6, header_barcode=False,
+                 quality_threshold=20, min_length=50, gc_min=30, gc_max=60, reader=fastq_reader.NATIVE,
+                 threads=1, chunk_size=fastq_reader.CHUNK_SIZE, original_csv=None, filtered_csv=None,
+                 demux_dir=None, demux_compress=False, max_open_files=MAX_OPEN_FILES, use_index=False,
+                 cache=None, compress=None, report=None, whitelist=None, max_length=None, max_n_fraction=None,
+                 max_expected_errors=None, window_quality=None, window_size=DEFAULT_WINDOW_SIZE, adaptive_filter=False,
+                 pipelined=False, original_columns=None, filtered_columns=None, columns_format=None,
+                 duplicates=None, quality_profile=False, trimmer=None):
+        self.input_file = input_file
+        self.output_file = output_file
+        # A BarcodeWhitelist sets the barcode length and assigns barcodes with mismatches
+        self.whitelist = whitelist
+        self.barcode_length = whitelist.barcode_length if whitelist is not None else barcode_length
+        self.header_barcode = header_barcode
+        self.quality_threshold = quality_threshold
+        self.min_length = min_length
+        self.gc_min = gc_min
+        self.gc_max = gc_max
+        # Optional criteria; the FilterEngine is built from all criteria when the run starts
+        self.max_length = max_length
+        self.max_n_fraction = max_n_fraction
+        self.max_expected_errors = max_expected_errors
+        self.window_quality = window_quality
+        self.window_size = window_size
+        self.adaptive_filter = adaptive_filter
+        self.engine = None
+        # Optional DuplicateDetector, shared with the copies of copy_for
+        self.duplicates = duplicates
+        # Optional Trimmer applied before the filter criteria
+        self.trimmer = trimmer
+        self.reader = reader
+        self.threads = threads
+        self.pipelined = pipelined
+        self.chunk_size = chunk_size
+        # With CSV paths the metrics rows are streamed to disk instead of being kept in the lists
+        self.original_csv = original_csv
+        self.filtered_csv = filtered_csv
+        # With columnar paths the metrics are also written as typed columns in columns_format
+        self.original_columns = original_columns
+        self.filtered_columns = filtered_columns
+        self.columns_format = columns_format
+        # With a demux directory every record is also written to a FASTQ file per barcode group
+        self.demux_dir = demux_dir
+        self.demux_compress = demux_compress
+        self.max_open_files = max_open_files
+        # With an index the parallel workers read their own byte ranges of the input
+        self.use_index = use_index
+        # None, "gzip" or "bgzf" for the filtered FASTQ
+        self.compress = compress
+        # The cache needs the streamed original CSV, it is not used with the in-memory lists
+        # nor with columnar metrics (a cache hit only copies the CSV) nor with trimming
+        self.cache = cache if original_csv and not original_columns and trimmer is None else None
+
+        # Only the number of reads per group is needed, not the sequences
+        self.original_parser = FastqParser(input_file, reader, keep_sequences=False, whitelist=whitelist)
+        self.filtered_parser = FastqParser(output_file, reader, keep_sequences=False, whitelist=whitelist)
+        self.demux = None
+        self.demux_groups = {}
+        self.original_metrics = []
+        self.filtered_metrics = []
+        self.original_writer = None
+        self.filtered_writer = None
+        self.original_columns_writer = None
+        self.filtered_columns_writer = None
+        self.original_stats = StreamingStats()
+        self.filtered_stats = StreamingStats()
+        self.quality_profile = QualityProfile() if quality_profile else None
+        self.cache_entry = None
+        self.cache_writer = None
+        self.cache_batches = None
+        # Stage timings and rejection counters
+        self.report = RunReport() if report is None else report
+        self.total = 0
+        self.passed = 0
+
+    def run(self):
+        """Run the pass and return (total, passed) like filter_fastq."""
+        if not os.path.isfile(self.input_file):
+            raise FileNotFoundError(f"FASTQ file not found:{self.input_file}")
+
+        self.setup_filter()
+
+        key = None
+        if self.cache is not None:
+            key = cache_key(self.input_file, self.barcode_length, self.header_barcode, self.whitelist)
+            self.cache_entry = self.cache.lookup(key)
+            if self.cache_entry is None:
+                try:
+                    self.cache_writer = self.cache.create(key)
+                except OSError as e:
+                    logging.warning(f"Result cache disabled: {e}")
+
+        if self.original_csv:
+            if self.cache_entry is None:
+                self.original_writer = MetricsCsvWriter.open(self.original_csv)
+            self.filtered_writer = MetricsCsvWriter.open(self.filtered_csv)
+        if self.original_columns:
+            self.original_columns_writer = open_metrics_writer(self.original_columns, self.columns_format)
+            self.filtered_columns_writer = open_metrics_writer(self.filtered_columns, self.columns_format)
+        if self.demux_dir:
+            self.demux = BarcodeDemultiplexer(self.demux_dir, self.demux_compress, self.max_open_files)
+
+        try:
+            with compressed_io.open_output(self.output_file, self.compress) as out_handle:
+                if self.threads > 1 and self.duplicates is not None:
+                    logging.info("Duplicate detection needs every read in one process, processing in a single process")
+                if self.cache_entry is not None:
+                    logging.info(f"Reusing cached metrics from {self.cache_entry.path}; the input is still read for the filtered FASTQ")
+                    self.run_cached(out_handle)
+                elif self.threads > 1 and self.duplicates is None:
+                    # Parallel mode: every chunk is processed by an empty copy of this
+                    # pipeline in a worker, and the partial results are merged in order
+                    logging.info(f"Processing with {self.threads} processes")
+                    worker = partial(process_chunk, pipeline=self.empty_copy())
+                    chunks = fastq_index.iter_work_chunks(self.input_file, self.chunk_size, self.use_index)
+                    for part, data, csv_text in ordered_map(worker, chunks, self.threads):
+                        with self.report.stage("merge"):
+                            out_handle.write(data)
+                            self.merge(part, csv_text)
+                elif self.pipelined:
+                    logging.info("Processing with pipelined reader, compute and writer stages")
+                    self.run_pipelined(out_handle)
+                else:
+                    records = fastq_reader.read_fastq(self.input_file, self.reader)
+                    for batch, metrics in self.iter_measured_batches(records):
+                        self.process_batch(batch, metrics, out_handle)
+        except BaseException:
+            if self.cache_writer is not None:
+                self.cache_writer.abort()
+                self.cache_writer = None
+            raise
+
+        with self.report.stage("csv_write"):
+            if self.original_writer is not None:
+                self.original_writer.close()
+            if self.filtered_writer is not None:
+                self.filtered_writer.close()
+        if self.original_columns_writer is not None:
+            with self.report.stage("columns_write"):
+                self.original_columns_writer.close()
+                self.filtered_columns_writer.close()
+        if self.demux is not None:
+            with self.report.stage("demux"):
+                self.demux.close()
+        if self.cache_writer is not None:
+            with self.report.stage("cache"):
+                self.store_in_cache(key)
+        self.report.counters.update(reads=self.total, passed=self.passed, failed=self.total - self.passed)
+
+        logging.info(f"Filtering completed.")
+        return self.total, self.passed
+
+    def run_cached(self, out_handle):
+        # Copy the original statistics and re-apply the filter to the cached metrics.
+        # The records are still read to write the filtered FASTQ and the demux files.
+        report = self.report
+        report.counters['cache_hit'] = 1
+        with report.stage("csv_write"):
+            shutil.copyfile(self.cache_entry.file(ORIGINAL_CSV), self.original_csv)
+        groups = self.cache_entry.info['groups']
+        records = fastq_reader.read_fastq(self.input_file, self.reader)
+        with open(self.cache_entry.file(ORIGINAL_CSV), newline='') as csv_handle:
+            next(csv_handle, None)  # header
+            for metrics, barcodes, group_ids in self.cache_entry.iter_batches():
+                with report.stage("parse") as stage:
+                    batch_records = list(islice(records, len(group_ids)))
+                    if len(batch_records) != len(group_ids):
+                        raise ValueError("The cached metrics do not match the input; rerun with --no-cache")
+                    stage.records += len(batch_records)
+                    stage.bytes += int(metrics.lengths.sum())
+                with report.stage("filter") as stage:
+                    # The per-base criteria read the records again, the others only the cached metrics
+                    needs_batch = self.engine.needs_bases or self.duplicates is not None or self.quality_profile is not None
+                    batch = RecordBatch(batch_records) if needs_batch else None
+                    mask, rejections = self.engine.apply(metrics, batch)
+                    report.rejections.update(rejections)
+                    stage.records += len(batch_records)
+                if self.duplicates is not None:
+                    mask = self.mark_duplicates(batch, metrics, mask)
+                with report.stage("write_fastq"):
+                    write_passed(out_handle, batch_records, mask)
+                keep = mask.tolist()
+                passed = sum(keep)
+                with report.stage("csv_write"):
+                    rows = [line for line, passed_row in zip(islice(csv_handle, len(keep)), keep) if passed_row]
+                    self.filtered_writer.write_text(''.join(rows), passed)
+
+                self.total += len(keep)
+                self.passed += passed
+                with report.stage("stats"):
+                    self.original_stats.update(metrics, barcodes)
+                    self.filtered_stats.update(metrics, barcodes, mask)
+                    for parser, ids in ((self.original_parser, group_ids), (self.filtered_parser, group_ids[mask])):
+                        # Groups are added in order of first appearance, like add_record does
+                        unique, first, counts = np.unique(ids, return_index=True, return_counts=True)
+                        for index in np.argsort(first):
+                            parser.add_group(*groups[unique[index]], int(counts[index]))
+                if self.quality_profile is not None:
+                    with report.stage("quality_profile"):
+                        self.quality_profile.update(batch, metrics, barcodes, mask)
+                if self.demux is not None:
+                    with report.stage("demux"):
+                        self.demux.add_records(batch_records)
+        if next(records, None) is not None:
+            raise ValueError("The cached metrics do not match the input; rerun with --no-cache")
+
+    def store_in_cache(self, key):
+        try:
+            self.cache_entry = self.cache_writer.commit(self.original_parser, self.original_csv)
+            self.cache.evict(keep=key)
+        except OSError as e:
+            logging.warning(f"Could not store the results in the cache: {e}")
+            self.cache_writer.abort()
+        self.cache_writer = None
+
+    def run_pipelined(self, out_handle):
+        # Errors of the reader and writer threads are raised here as StageError;
+        # an error of any stage stops the other two
+        records = fastq_reader.read_fastq(self.input_file, self.reader)
+        reader = ReaderStage(self.iter_packed_batches(records), "reader")
+        writer = QueuedWriter(out_handle, "writer")
+        try:
+            for batch in reader:
+                self.process_batch(batch, self.measure(batch), writer)
+            with self.report.stage("write_fastq"):
+                writer.close()
+        except BaseException:
+            writer.cancel()
+            raise
+        finally:
+            reader.close()
+
+    def iter_packed_batches(self, records):
+        """Parse records into RecordBatches, timing the parse stage."""
+        batches = iter_batches(records)
+        while True:
+            with self.report.stage("parse") as stage:
+                records_batch = next(batches, None)
+                if records_batch is None:
+                    return
+                batch = RecordBatch(records_batch)
+                stage.records += len(batch)
+                stage.bytes += int(batch.lengths.sum())
+            yield batch
+
+    def measure(self, batch):
+        with self.report.stage("measure") as stage:
+            metrics = BatchMetrics(batch, self.barcode_length, self.whitelist)
+            stage.records += len(batch)
+        return metrics
+
+    def iter_measured_batches(self, records):
+        """Like iter_batch_metrics, timing the parse and measure stages separately."""
+        for batch in self.iter_packed_batches(records):
+            yield batch, self.measure(batch)
+
+    def trim(self, batch, metrics):
+        """Return the trimmed batch and its metrics (with the barcodes of the untrimmed reads)."""
+        if self.trimmer is None:
+            return batch, metrics
+        return trim_batch(batch, metrics, self.trimmer, self.report)
+
+    def process_batch(self, batch, metrics, out_handle):
+        report = self.report
+        # Without a Trimmer the filtered records are written unchanged, so their metrics are the same
+        kept, kept_metrics = self.trim(batch, metrics)
+        with report.stage("filter") as stage:
+            mask, rejections = self.engine.apply(kept_metrics, kept)
+            report.rejections.update(rejections)
+            stage.records += len(batch)
+        if self.duplicates is not None:
+            mask = self.mark_duplicates(kept, kept_metrics, mask)
+        with report.stage("write_fastq") as stage:
+            write_passed(out_handle, kept.records, mask)
+            stage.records += int(mask.sum())
+        keep = mask.tolist()
+
+        with report.stage("stats") as stage:
+            barcodes = FastqStat.batch_barcodes(batch, metrics, self.header_barcode)
+            self.original_stats.update(metrics, barcodes)
+            self.filtered_stats.update(kept_metrics, barcodes, mask)
+            if kept is not batch:
+                trimmed_bases = metrics.lengths - kept_metrics.lengths
+                self.original_stats.update_trimmed(trimmed_bases)
+                self.filtered_stats.update_trimmed(trimmed_bases, mask)
+            groups = []
+            for record, passed in zip(batch.records, keep):
+                groups.append(self.original_parser.add_record(record))
+                if passed:
+                    self.filtered_parser.add_record(record)
+            stage.records += len(batch)
+        if self.quality_profile is not None:
+            with report.stage("quality_profile") as stage:
+                self.quality_profile.update(kept, kept_metrics, barcodes, mask)
+                stage.records += len(batch)
+                stage.bytes += kept.bases.size
+
+        passed = sum(keep)
+        self.total += len(batch)
+        self.passed += passed
+        if self.original_columns_writer is not None:
+            with report.stage("columns_write") as stage:
+                columns = FastqStat.batch_metrics_columns(batch, metrics)
+                self.original_columns_writer.write_columns(columns)
+                if kept is not batch:
+                    columns = FastqStat.batch_metrics_columns(kept, kept_metrics)
+                self.filtered_columns_writer.write_columns(select_columns(columns, mask))
+                stage.records += len(batch) + passed
+        if self.original_writer is not None or not self.original_columns:
+            with report.stage("csv_write") as stage:
+                rows = FastqStat.batch_metrics_rows(batch, metrics)
+                kept_rows = rows if kept is batch else FastqStat.batch_metrics_rows(kept, kept_metrics)
+                filtered_rows = [row for row, passed_row in zip(kept_rows, keep) if passed_row]
+                if self.original_writer is not None:
+                    self.original_writer.write_rows(rows)
+                    self.filtered_writer.write_rows(filtered_rows)
+                else:
+                    self.original_metrics.extend(rows)
+                    self.filtered_metrics.extend(filtered_rows)
+                stage.records += len(rows) + len(filtered_rows)
+
+        if self.cache_writer is not None:
+            with report.stage("cache"):
+                self.cache_writer.add(metrics, barcodes, groups)
+        elif self.cache_batches is not None:
+            # Parallel worker: keep the metrics for the cache writer of the main process
+            self.cache_batches.append((metrics, barcodes, groups))
+
+        if self.demux is not None:
+            with report.stage("demux"):
+                self.demux.add_records(batch.records)
+        elif self.demux_dir:
+            # Parallel worker: keep the grouped bytes for the demultiplexer of the main process
+            with report.stage("demux"):
+                group_fastq_bytes(batch.records, self.demux_groups)
+
+    def mark_duplicates(self, batch, metrics, mask):
+        # Check the reads that passed the criteria; returns the mask without the removed duplicates
+        with self.report.stage("duplicates") as stage:
+            barcodes = FastqStat.batch_barcodes(batch, metrics, self.header_barcode)
+            duplicate = self.duplicates.mark(batch, barcodes, mask)
+            stage.records += int(mask.sum())
+        if not self.duplicates.remove:
+            return mask
+        self.report.rejections[DUPLICATE_REASON] += int(duplicate.sum())
+        return mask & ~duplicate
+
+    def setup_filter(self):
+        """Log the filter criteria (filling in the defaults) and build the FilterEngine."""
+        self.quality_threshold, self.min_length, self.gc_min, self.gc_max = log_filter_criteria(
+            self.quality_threshold, self.min_length, self.gc_min, self.gc_max
+        )
+        log_extra_criteria(
+            self.max_length, self.max_n_fraction, self.max_expected_errors,
+            self.window_quality, self.window_size, self.adaptive_filter
+        )
+        self.engine = self.build_engine()
+
+    def build_engine(self):
+        predicates = build_predicates(
+            self.quality_threshold, self.min_length, self.gc_min, self.gc_max, self.max_length,
+            self.max_n_fraction, self.max_expected_errors, self.window_quality, self.window_size
+        )
+        return FilterEngine(predicates, self.adaptive_filter)
+
+    def empty_copy(self):
+        """Return a pipeline with the same settings and no results."""
+        pipeline = FusedPipeline(
+            self.input_file, self.output_file, self.barcode_length, self.header_barcode,
+            self.quality_threshold, self.min_length, self.gc_min, self.gc_max,
+            self.reader, self.threads, self.chunk_size, self.original_csv, self.filtered_csv,
+            self.demux_dir, self.demux_compress, self.max_open_files, self.use_index,
+            whitelist=self.whitelist, max_length=self.max_length, max_n_fraction=self.max_n_fraction,
+            max_expected_errors=self.max_expected_errors, window_quality=self.window_quality,
+            window_size=self.window_size, adaptive_filter=self.adaptive_filter,
+            original_columns=self.original_columns, filtered_columns=self.filtered_columns,
+            columns_format=self.columns_format, quality_profile=self.quality_profile is not None,
+            trimmer=self.trimmer
+        )
+        pipeline.engine = self.build_engine()
+        if self.cache_writer is not None:
+            pipeline.cache_batches = []
+        return pipeline
+
+    def copy_for(self, input_file, output_file, original_csv=None, filtered_csv=None, demux_dir=None,
+                 original_columns=None, filtered_columns=None):
+        """Return a single-process pipeline with the same settings for other files, e.g. one input of many."""
+        return FusedPipeline(
+            input_file, output_file, self.barcode_length, self.header_barcode,
+            self.quality_threshold, self.min_length, self.gc_min, self.gc_max,
+            self.reader, 1, self.chunk_size, original_csv, filtered_csv,
+            demux_dir, self.demux_compress, self.max_open_files, self.use_index,
+            cache=self.cache, whitelist=self.whitelist, max_length=self.max_length,
+            max_n_fraction=self.max_n_fraction, max_expected_errors=self.max_expected_errors,
+            window_quality=self.window_quality, window_size=self.window_size,
+            adaptive_filter=self.adaptive_filter, pipelined=self.pipelined,
+            original_columns=original_columns, filtered_columns=filtered_columns, columns_format=self.columns_format,
+            duplicates=self.duplicates, quality_profile=self.quality_profile is not None,
+            trimmer=self.trimmer
+        )
+
+    def merge(self, other, csv_text=None):
+        """Append the results of a pipeline that processed the following part of the input.
+
+        csv_text holds the (original, filtered) metrics CSV text of a streaming worker.
+        """
+        self.original_parser.merge(other.original_parser)
+        self.filtered_parser.merge(other.filtered_parser)
+        self.report.merge(other.report)
+        self.original_stats.merge(other.original_stats)
+        self.filtered_stats.merge(other.filtered_stats)
+        if self.quality_profile is not None:
+            self.quality_profile.merge(other.quality_profile)
+        if csv_text is not None:
+            self.original_writer.write_text(csv_text[0], other.total)
+            self.filtered_writer.write_text(csv_text[1], other.passed)
+        else:
+            self.original_metrics.extend(other.original_metrics)
+            self.filtered_metrics.extend(other.filtered_metrics)
+        if isinstance(other.original_columns_writer, ColumnBuffer):
+            other.original_columns_writer.write_to(self.original_columns_writer)
+            other.filtered_columns_writer.write_to(self.filtered_columns_writer)
+        for group, (data, count) in other.demux_groups.items():
+            self.demux.write(group, data, count)
+        for metrics, barcodes, groups in other.cache_batches or ():
+            self.cache_writer.add(metrics, barcodes, groups)
+        self.total += other.total
+        self.passed += other.passed
+
+    def get_original_distribution(self):
+        return FastqStat.barcode_distribution(self.original_stats.barcodes)
+
+    def get_filtered_distribution(self):
+        return FastqStat.barcode_distribution(self.filtered_stats.barcodes)
+
+
+def process_chunk(chunk, pipeline):
+    # Worker of the parallel mode: run an empty pipeline over one block of whole
+    # records and return it with the FASTQ bytes of the records that passed and,
+    # when streaming, the header-less CSV text of its metrics rows (the metrics
+    # columns stay in the ColumnBuffers of the returned pipeline)
+    out_handle = io.BytesIO()
+    if pipeline.original_csv:
+        pipeline.original_writer = MetricsCsvWriter(io.StringIO(), header=False)
+        pipeline.filtered_writer = MetricsCsvWriter(io.StringIO(), header=False)
+    if pipeline.original_columns:
+        # The column dicts are written by the columnar writers of the main process
+        pipeline.original_columns_writer = ColumnBuffer()
+        pipeline.filtered_columns_writer = ColumnBuffer()
+
+    with pipeline.report.stage("read_chunk"):
+        records = fastq_reader.parse_chunk(fastq_index.load_chunk(chunk), pipeline.reader)
+    for batch, metrics in pipeline.iter_measured_batches(records):
+        pipeline.process_batch(batch, metrics, out_handle)
+
+    csv_text = None
+    if pipeline.original_csv:
+        csv_text = (pipeline.original_writer.handle.getvalue(), pipeline.filtered_writer.handle.getvalue())
+        # The csv writers cannot be pickled back to the main process
+        pipeline.original_writer = pipeline.filtered_writer = None
+    return pipeline, out_handle.getvalue(), csv_text
@@ -0,0 +1,149 @@
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import cProfile
+import io
+import json
+import pstats
+import resource
+import sys
+import time
+
+REPORT_FILE = "run_report.json"
+PROFILE_FILE = "profile.pstats"
+PROFILE_TEXT_FILE = "profile.txt"
+PROFILE_TOP = 40
+
+
+def _status_mb(field):
+    # Memory fields of /proc/self/status (Linux only), in MB
+    try:
+        with open('/proc/self/status') as handle:
+            for line in handle:
+                if line.startswith(field):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB."""
+    peak = _status_mb('VmHWM:')
+    if peak is not None:
+        return peak
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def current_rss_mb():
+    """Current resident memory of this process in MB (the peak where it is not available)."""
+    current = _status_mb('VmRSS:')
+    return current if current is not None else peak_rss_mb()
+
+
+class StageStats:
+    """Time, work and memory accumulated over every run of one stage."""
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.records = 0
+        self.bytes = 0
+        self.max_rss = 0.0
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.wall += other.wall
+        self.cpu += other.cpu
+        self.records += other.records
+        self.bytes += other.bytes
+        self.max_rss = max(self.max_rss, other.max_rss)
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'wall_s': self.wall,
+            'cpu_s': self.cpu,
+            'records': self.records,
+            'bytes': self.bytes,
+            'records_per_s': self.records / self.wall if self.wall else 0,
+            'max_rss_mb': self.max_rss,
+        }
+
+
+class RunReport:
+    """Per-stage timings and counters of a run, written as run_report.json.
+
+    CPU time is measured in the process that runs a stage, so merged reports
+    of parallel workers add up the CPU time of every process.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = Counter()
+        self.rejections = Counter()
+        self.info = {}
+        self.started = time.time()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+
+    @contextmanager
+    def stage(self, name):
+        """Time a block as one run of a stage; yields the StageStats to add records and bytes to."""
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = StageStats()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield stats
+        finally:
+            stats.calls += 1
+            stats.wall += time.perf_counter() - wall
+            stats.cpu += time.process_time() - cpu
+            stats.max_rss = max(stats.max_rss, current_rss_mb())
+
+    def merge(self, other):
+        for name, stats in other.stages.items():
+            self.stages.setdefault(name, StageStats()).merge(stats)
+        self.counters.update(other.counters)
+        self.rejections.update(other.rejections)
+
+    def to_dict(self):
+        return {
+            'started': datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+            'finished': datetime.now(timezone.utc).isoformat(),
+            'wall_s': time.perf_counter() - self.start_wall,
+            'cpu_s': time.process_time() - self.start_cpu,
+            'peak_rss_mb': peak_rss_mb(),
+            'stages': {name: stats.to_dict() for name, stats in self.stages.items()},
+            'counters': dict(self.counters),
+            'rejections': dict(self.rejections),
+            **self.info,
+        }
+
+    def write(self, path):
+        with open(path, 'w') as handle:
+            json.dump(self.to_dict(), handle, indent=2, default=str)
+
+
+@contextmanager
+def profiled(enabled, pstats_path, text_path=None, top=PROFILE_TOP):
+    """Run a block under cProfile when enabled and dump the stats (and a text summary)."""
+    if not enabled:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(pstats_path)
+        if text_path:
+            text = io.StringIO()
+            pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(top)
+            with open(text_path, 'w') as handle:
+                handle.write(text.getvalue())
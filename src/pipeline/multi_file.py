@@ -0,0 +1,181 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import csv
+import glob
+import logging
+import os
+import shutil
+from src.parsing import compressed_io
+from src.parsing.demux import BarcodeDemultiplexer
+from src.statistic.metrics_writer import MetricsCsvWriter
+from src.statistic.columnar_writer import open_metrics_writer, metrics_path
+from src.constants import PER_FILE_SUMMARY
+
+# Basecallers write a run as many small FASTQ files. Every input file is
+# processed by its own single-process FusedPipeline in a process pool, largest
+# file first, and the per-file outputs are merged in input order into one set
+# of outputs.
+FASTQ_SUFFIXES = tuple(
+    suffix + extension for suffix in ('.fastq', '.fq') for extension in ('',) + compressed_io.EXTENSIONS
+)
+PARTS_DIR = "parts"
+SUMMARY_COLUMNS = (
+    "file", "reads", "passed", "failed", "passed_percent", "bases", "mean_length", "n50",
+    "mean_gc_content", "mean_quality_score", "barcodes",
+)
+
+
+def expand_inputs(path):
+    """Return the sorted FASTQ files of a directory or glob pattern, or [path] for a single file."""
+    if os.path.isdir(path):
+        files = [os.path.join(path, name) for name in os.listdir(path) if name.endswith(FASTQ_SUFFIXES)]
+        if not files:
+            raise FileNotFoundError(f"No FASTQ files found in directory: {path}")
+    elif not os.path.exists(path) and glob.has_magic(path):
+        files = [name for name in glob.glob(path) if os.path.isfile(name)]
+        if not files:
+            raise FileNotFoundError(f"No files match the pattern: {path}")
+    else:
+        return [path]
+    return sorted(files)
+
+
+def is_multi_input(path):
+    return os.path.isdir(path) or (not os.path.exists(path) and glob.has_magic(path))
+
+
+def _quiet_worker():
+    # The main process logs one line per file instead of the full log of every pipeline
+    logging.getLogger().setLevel(logging.WARNING)
+
+
+def process_file(job, template):
+    # Worker: run a copy of the template pipeline over one input file, writing
+    # uncompressed part outputs; returns (index, pipeline, demux counts)
+    index, input_file, part_dir = job
+    os.makedirs(part_dir, exist_ok=True)
+    pipeline = template.copy_for(
+        input_file,
+        os.path.join(part_dir, "filtered.fastq"),
+        os.path.join(part_dir, "original_statistics.csv") if template.original_csv else None,
+        os.path.join(part_dir, "filtered_statistics.csv") if template.original_csv else None,
+        os.path.join(part_dir, "demux") if template.demux_dir else None,
+        metrics_path(part_dir, "original_statistics", template.columns_format) if template.original_columns else None,
+        metrics_path(part_dir, "filtered_statistics", template.columns_format) if template.original_columns else None,
+    )
+    pipeline.run()
+    demux_counts = {}
+    if pipeline.demux is not None:
+        demux_counts = {group: (pipeline.demux.group_path(group), count) for group, count in pipeline.demux.counts.items()}
+    # Open handles cannot be pickled back to the main process
+    pipeline.original_writer = pipeline.filtered_writer = pipeline.demux = None
+    pipeline.original_columns_writer = pipeline.filtered_columns_writer = None
+    pipeline.cache_entry = pipeline.cache_writer = None
+    return index, pipeline, demux_counts
+
+
+class MultiFileRunner:
+    """Run a FusedPipeline template over many input files and merge the results into it.
+
+    After run() the template holds the merged groups, statistics, rejection
+    counters and totals, and its output files hold the merged outputs, so it
+    can be used like a pipeline that processed a single file.
+    """
+
+    def __init__(self, template, inputs, processes=1, work_dir=None, summary_path=None):
+        self.template = template
+        self.inputs = inputs
+        self.processes = max(1, processes)
+        self.work_dir = work_dir or os.path.join(os.path.dirname(template.output_file) or '.', PARTS_DIR)
+        self.summary_path = summary_path
+
+    def run(self):
+        """Process every input and return (total, passed) of all of them."""
+        template = self.template
+        template.setup_filter()
+        if template.duplicates is not None and self.processes > 1:
+            # The files share the DuplicateDetector of the template
+            logging.info("Duplicate detection needs every read in one process, processing the files one at a time")
+            self.processes = 1
+        jobs = [(index, path, os.path.join(self.work_dir, f"{index:06d}")) for index, path in enumerate(self.inputs)]
+        # Largest first, so a big file does not start last and hold up the end of the run
+        jobs.sort(key=lambda job: os.path.getsize(job[1]), reverse=True)
+        logging.info(f"Processing {len(jobs)} FASTQ files with {self.processes} processes, largest first")
+
+        results = [None] * len(jobs)
+        try:
+            if self.processes == 1:
+                for job in jobs:
+                    self._done(results, *process_file(job, template))
+            else:
+                with ProcessPoolExecutor(max_workers=self.processes, initializer=_quiet_worker) as pool:
+                    futures = [pool.submit(process_file, job, template) for job in jobs]
+                    for future in as_completed(futures):
+                        self._done(results, *future.result())
+            self.merge(results)
+            if self.summary_path:
+                self.write_summary(results)
+        finally:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+        return template.total, template.passed
+
+    def _done(self, results, index, pipeline, demux_counts):
+        results[index] = (pipeline, demux_counts)
+        logging.info(f"Processed {pipeline.input_file}: {pipeline.total} reads, {pipeline.passed} passed the filter")
+
+    def merge(self, results):
+        # Outputs are merged in input order, whatever order the files finished in
+        template = self.template
+        with template.report.stage("merge"):
+            for pipeline, _ in results:
+                template.merge(pipeline)
+            with compressed_io.open_output(template.output_file, template.compress) as out_handle:
+                for pipeline, _ in results:
+                    with open(pipeline.output_file, 'rb') as part:
+                        shutil.copyfileobj(part, out_handle)
+            if template.original_csv:
+                with MetricsCsvWriter.open(template.original_csv) as original, \
+                        MetricsCsvWriter.open(template.filtered_csv) as filtered:
+                    for pipeline, _ in results:
+                        original.append_file(pipeline.original_csv, pipeline.total)
+                        filtered.append_file(pipeline.filtered_csv, pipeline.passed)
+            if template.original_columns:
+                with open_metrics_writer(template.original_columns, template.columns_format) as original, \
+                        open_metrics_writer(template.filtered_columns, template.columns_format) as filtered:
+                    for pipeline, _ in results:
+                        original.append_file(pipeline.original_columns)
+                        filtered.append_file(pipeline.filtered_columns)
+            if template.demux_dir:
+                self.merge_demux(results)
+        # The merged worker reports already added up their own counters
+        counters = template.report.counters
+        counters['reads'], counters['passed'] = template.total, template.passed
+        counters['failed'], counters['files'] = template.total - template.passed, len(results)
+
+    def merge_demux(self, results):
+        template = self.template
+        demux = BarcodeDemultiplexer(template.demux_dir, template.demux_compress)
+        started = set()
+        for _, demux_counts in results:
+            for group, (path, count) in demux_counts.items():
+                # gzip members can be concatenated like plain FASTQ files
+                target = demux.group_path(group)
+                with open(path, 'rb') as source, open(target, 'ab' if group in started else 'wb') as handle:
+                    shutil.copyfileobj(source, handle)
+                started.add(group)
+                demux.counts[group] += count
+        template.demux = demux
+
+    def write_summary(self, results):
+        with open(self.summary_path, 'w', newline='') as handle:
+            writer = csv.writer(handle)
+            writer.writerow(SUMMARY_COLUMNS)
+            for pipeline, _ in results:
+                summary = pipeline.original_stats.summary()
+                failed = pipeline.total - pipeline.passed
+                passed_percent = pipeline.passed / pipeline.total * 100 if pipeline.total else 0
+                writer.writerow([
+                    pipeline.input_file, pipeline.total, pipeline.passed, failed, f"{passed_percent:.2f}",
+                    summary['bases'], f"{summary['mean_length']:.2f}", f"{summary['n50']:.0f}",
+                    f"{summary['mean_gc_content']:.2f}", f"{summary['mean_quality_score']:.2f}", summary['barcodes'],
+                ])
+        logging.info(f"Per-file summary is saved to {self.summary_path}")
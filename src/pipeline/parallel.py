@@ -0,0 +1,18 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+def ordered_map(func, items, processes, in_flight=None):
+    """Run func over items in a process pool and yield the results in input order.
+
+    At most in_flight items (default: two per process) are submitted at any
+    time, so memory stays bounded by the window and not by the input size.
+    """
+    in_flight = in_flight or processes * 2
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
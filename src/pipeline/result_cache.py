@@ -0,0 +1,222 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import numpy as np
+from src.statistic.batch_metrics import BatchMetrics, BATCH_SIZE
+from src.constants import DEFAULT_CACHE_DIR
+
+# Results that only depend on the input and the barcode settings are cached per
+# input fingerprint, so re-runs with other filter thresholds skip computing the
+# metrics and the original statistics. The records are still parsed on a hit,
+# to write the filtered FASTQ.
+# Every entry is a directory holding one raw little-endian file per column,
+# the original statistics CSV, the original pie chart and info.json.
+CACHE_VERSION = 1
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+SAMPLE_COUNT = 16
+SAMPLE_SIZE = 64 * 1024
+
+COLUMNS = (
+    ('lengths', '<u4'),
+    ('gc_count', '<u4'),
+    ('gc_count_any', '<u4'),
+    ('n_count', '<u4'),
+    ('quality_sum', '<u8'),
+    ('barcode', '<u4'),
+    ('group', '<u4'),
+)
+NO_BARCODE = np.iinfo(np.uint32).max
+INFO_FILE = "info.json"
+ORIGINAL_CSV = "original_statistics.csv"
+# One original pie chart per number of barcodes shown (main.py --top_barcodes)
+ORIGINAL_CHART = "original_barcode_distribution_piechart_top{top_k}.png"
+
+
+def fingerprint(file_path):
+    """Size, mtime and a hash of SAMPLE_COUNT evenly spaced blocks of a file."""
+    status = os.stat(file_path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as handle:
+        step = max(status.st_size // SAMPLE_COUNT, 1)
+        for position in range(0, max(status.st_size, 1), step):
+            handle.seek(position)
+            digest.update(handle.read(SAMPLE_SIZE))
+    return {'size': status.st_size, 'mtime_ns': status.st_mtime_ns, 'sample_hash': digest.hexdigest()}
+
+
+def cache_key(file_path, barcode_length, header_barcode, whitelist=None):
+    key = {
+        'version': CACHE_VERSION,
+        'input': fingerprint(file_path),
+        'barcode_length': barcode_length,
+        'header_barcode': header_barcode,
+        'whitelist': whitelist.fingerprint() if whitelist is not None else None,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:32]
+
+
+def _directory_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+class ResultCache:
+    """Directory of cache entries with size-bounded LRU eviction.
+
+    The mtime of the info file of an entry is its last use.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def lookup(self, key):
+        """Return the CacheEntry of a key (marking it as used) or None.
+
+        A partial or damaged entry is removed and looked up as a miss, so the
+        run stores it again.
+        """
+        path = self.entry_path(key)
+        if not os.path.isdir(path):
+            return None
+        try:
+            entry = CacheEntry(path)
+            entry.check()
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Ignoring the damaged cache entry {path}: {e}")
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+        os.utime(os.path.join(path, INFO_FILE))
+        return entry
+
+    def create(self, key):
+        return CacheWriter(self.entry_path(key) + f".tmp{os.getpid()}", self.entry_path(key))
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            info = os.path.join(entry.path, INFO_FILE)
+            if entry.is_dir() and os.path.isfile(info):
+                entries.append((os.stat(info).st_mtime_ns, entry.name, _directory_size(entry.path)))
+        total = sum(size for _, _, size in entries)
+        for _, name, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            logging.info(f"Evicting cache entry {name} ({size} bytes)")
+            shutil.rmtree(self.entry_path(name), ignore_errors=True)
+            total -= size
+
+
+class CacheWriter:
+    """Build a cache entry in a temporary directory while the pipeline runs.
+
+    Columns are appended batch by batch; commit moves the entry in place.
+    """
+
+    def __init__(self, path, final_path):
+        self.path = path
+        self.final_path = final_path
+        os.makedirs(path, exist_ok=True)
+        self.handles = {name: open(os.path.join(path, name), 'wb') for name, _ in COLUMNS}
+        self.barcodes = {}
+        self.groups = {}
+        self.records = 0
+
+    def add(self, metrics, barcodes, groups):
+        """Append a BatchMetrics with the barcode and FastqParser group key of every record."""
+        columns = {
+            'lengths': metrics.lengths,
+            'gc_count': metrics.gc_count,
+            'gc_count_any': metrics.gc_count_any,
+            'n_count': metrics.n_count,
+            'quality_sum': metrics.quality_sum,
+            'barcode': [NO_BARCODE if barcode is None else self.barcodes.setdefault(barcode, len(self.barcodes))
+                        for barcode in barcodes],
+            'group': [self.groups.setdefault(group, len(self.groups)) for group in groups],
+        }
+        for name, dtype in COLUMNS:
+            np.asarray(columns[name]).astype(dtype).tofile(self.handles[name])
+        self.records += len(metrics.lengths)
+
+    def commit(self, parser, original_csv):
+        """Store the original CSV and the group table of parser, then publish the entry."""
+        for handle in self.handles.values():
+            handle.close()
+        shutil.copyfile(original_csv, os.path.join(self.path, ORIGINAL_CSV))
+        grouped = parser.get_grouped_sequences()
+        info = {
+            'version': CACHE_VERSION,
+            'records': self.records,
+            'barcodes': list(self.barcodes),
+            'groups': [[key, grouped[key]['barcode_seq'], grouped[key]['group']] for key in self.groups],
+        }
+        with open(os.path.join(self.path, INFO_FILE), 'w') as handle:
+            json.dump(info, handle)
+        if os.path.isdir(self.final_path):
+            # Another run stored the same entry in the meantime
+            shutil.rmtree(self.path, ignore_errors=True)
+        else:
+            os.replace(self.path, self.final_path)
+        return CacheEntry(self.final_path)
+
+    def abort(self):
+        for handle in self.handles.values():
+            handle.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class CacheEntry:
+    """A committed cache entry; columns are memory-mapped."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INFO_FILE)) as handle:
+            self.info = json.load(handle)
+
+    def __len__(self):
+        return self.info['records']
+
+    def check(self):
+        """Raise ValueError if a column or the original CSV does not hold every record."""
+        for name, dtype in COLUMNS:
+            size = os.path.getsize(self.file(name))
+            if size != len(self) * np.dtype(dtype).itemsize:
+                raise ValueError(f"{name} has {size} bytes for {len(self)} records")
+        rows = -1  # header
+        with open(self.file(ORIGINAL_CSV), 'rb') as handle:
+            for block in iter(lambda: handle.read(1024 * 1024), b''):
+                rows += block.count(b'\n')
+        if rows != len(self):
+            raise ValueError(f"{ORIGINAL_CSV} has {rows} rows for {len(self)} records")
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def add_file(self, name, source):
+        shutil.copyfile(source, self.file(name))
+
+    def column(self, name):
+        dtype = dict(COLUMNS)[name]
+        if not len(self):
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self.file(name), dtype=dtype, mode='r', shape=(len(self),))
+
+    def iter_batches(self, batch_size=BATCH_SIZE):
+        """Yield (BatchMetrics, barcodes, group ids) for consecutive slices of the records."""
+        columns = {name: self.column(name) for name, _ in COLUMNS}
+        table = self.info['barcodes']
+        for start in range(0, len(self), batch_size):
+            part = {name: np.asarray(values[start:start + batch_size]) for name, values in columns.items()}
+            barcodes = [None if barcode == NO_BARCODE else table[barcode] for barcode in part['barcode'].tolist()]
+            metrics = BatchMetrics.from_counts(
+                part['lengths'], part['gc_count'], part['gc_count_any'],
+                part['n_count'], part['quality_sum'], barcodes
+            )
+            yield metrics, barcodes, part['group']
@@ -0,0 +1,364 @@
+from collections import Counter
+from statistics import NormalDist
+import logging
+import math
+import os
+import numpy as np
+from src.parsing import fastq_reader, fastq_index, compressed_io
+from src.statistic.batch_metrics import iter_batches, RecordBatch, BatchMetrics
+from src.statistic.statistic import FastqStat
+from src.statistic.report_data import TOP_BARCODES
+from src.constants import SAMPLE_FILE, CONFIDENCE
+
+# Preview mode estimates the statistics of a FASTQ file from a uniform sample
+# of its records, with confidence intervals, instead of reading every record.
+# Records are drawn in three ways, the first that applies:
+#   index    a current .fqi index: record numbers drawn without replacement
+#   seek     a plain file: random byte offsets; the record holding the offset is
+#            drawn with a probability proportional to its size in bytes, so every
+#            record is weighted by 1/size (a ratio estimator)
+#   stream   anything else (gzip, multi-line records): one pass with a reservoir
+#            sample of N records or a Bernoulli sample of a fraction
+# Index and seek draws come in rounds and stop early once every interval is
+# within the tolerance; a stream sample is only complete at the end of the file.
+ROUND_SIZE = 1000
+# Intervals are not trusted for convergence below this many sampled records
+MIN_SAMPLE = 1000
+SEEK_WINDOW = 64 * 1024
+MAX_SEEK_WINDOW = 64 * 1024 * 1024
+INDEX = "index"
+SEEK = "seek"
+STREAM = "stream"
+_MEANS = ("length", "gc_content", "mean_quality")
+
+
+def wilson_interval(p, n, z):
+    """Wilson score interval of a proportion p estimated from n reads, as (p, low, high)."""
+    if not n:
+        return 0.0, 0.0, 1.0
+    centre = (p + z * z / (2 * n)) / (1 + z * z / n)
+    half = z * math.sqrt(max(p * (1 - p), 0.0) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    return p, max(0.0, centre - half), min(1.0, centre + half)
+
+
+def find_record_start(data, at_end=False):
+    """Index of the first 4-line record start in data after its first byte, or None.
+
+    A record start is a '@' line after a newline, followed by a sequence, a '+'
+    line, a quality of the same length and then another '@' line or the end of
+    the file. Returns -1 when data ends before a candidate could be checked and
+    does not reach the end of the file.
+    """
+    if at_end:
+        data += b'\n'
+    position = data.find(b'\n@')
+    while position != -1:
+        lines = data[position + 1:].split(b'\n', 4)
+        if (len(lines) < 5 or not lines[4]) and not at_end:
+            return -1
+        if (len(lines) == 5 and lines[2].startswith(b'+') and len(lines[3].rstrip(b'\r')) == len(lines[1].rstrip(b'\r'))
+                and (lines[4].startswith(b'@') or not lines[4].strip())):
+            return position + 1
+        position = data.find(b'\n@', position + 1)
+    return None
+
+
+class SampleEstimates:
+    """Weighted sufficient statistics of a sample and their confidence intervals.
+
+    Reads drawn with unequal probabilities are weighted by the inverse of it;
+    a mean is then the ratio sum(w * x) / sum(w) with a linearised variance, a
+    percentage a Wilson interval at the effective sample size. Without weights
+    these are the usual mean and Wilson intervals.
+    """
+
+    def __init__(self, confidence=CONFIDENCE):
+        self.z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        self.confidence = confidence
+        self.n = 0
+        self.weight = 0.0
+        self.weight_squares = 0.0
+        self.sums = dict.fromkeys(_MEANS, 0.0)
+        self.cross = dict.fromkeys(_MEANS, 0.0)
+        self.squares = dict.fromkeys(_MEANS, 0.0)
+        # Weighted read counts
+        self.passed = 0.0
+        self.barcodes = Counter()
+        self.failing = Counter()
+
+    def update(self, metrics, barcodes, mask, failing, weights=None):
+        """Add the metrics, barcodes, pass mask and {reason: failed mask} of a batch of sampled reads."""
+        count = len(metrics.lengths)
+        weights = np.ones(count) if weights is None else np.asarray(weights, dtype=np.float64)
+        squared_weights = weights * weights
+        for name, values in zip(_MEANS, (metrics.lengths, metrics.gc_content, metrics.mean_quality)):
+            values = values.astype(np.float64)
+            self.sums[name] += float(weights @ values)
+            self.cross[name] += float(squared_weights @ values)
+            self.squares[name] += float(squared_weights @ (values * values))
+        self.n += count
+        self.weight += float(weights.sum())
+        self.weight_squares += float(squared_weights.sum())
+        self.passed += float(weights[mask].sum())
+        for barcode, weight in zip(barcodes, weights.tolist()):
+            if barcode is not None:
+                self.barcodes[barcode] += weight
+        for reason, failed in failing.items():
+            self.failing[reason] += float(weights[failed].sum())
+
+    @property
+    def effective_size(self):
+        return self.weight * self.weight / self.weight_squares if self.weight_squares else 0
+
+    def mean_interval(self, name):
+        """(estimate, low, high) of the mean of a per-read metric."""
+        if not self.n:
+            return 0.0, 0.0, 0.0
+        mean = self.sums[name] / self.weight
+        residuals = self.squares[name] - 2 * mean * self.cross[name] + mean * mean * self.weight_squares
+        variance = max(residuals, 0.0) / (self.weight * self.weight) * self.n / max(self.n - 1, 1)
+        half = self.z * math.sqrt(variance)
+        return mean, mean - half, mean + half
+
+    def percent_interval(self, weighted_count):
+        """(estimate, low, high) in percent of the reads with a property, from its weighted count."""
+        p = weighted_count / self.weight if self.weight else 0.0
+        return tuple(value * 100 for value in wilson_interval(p, self.effective_size, self.z))
+
+    def total_reads_interval(self, file_size):
+        """(estimate, low, high) of the reads in a file of file_size bytes sampled with 1/size weights.
+
+        The mean weight (1/size of the drawn record) estimates the reads per byte.
+        """
+        if not self.n:
+            return 0.0, 0.0, 0.0
+        mean = self.weight / self.n
+        variance = max(self.weight_squares / self.n - mean * mean, 0.0) / max(self.n - 1, 1)
+        half = self.z * math.sqrt(variance)
+        return file_size * mean, file_size * max(mean - half, 0.0), file_size * (mean + half)
+
+    def converged(self, tolerance):
+        """True if every mean is within tolerance percent and every percentage within tolerance points."""
+        if self.n < MIN_SAMPLE:
+            return False
+        for name in _MEANS:
+            mean, low, high = self.mean_interval(name)
+            if (high - low) / 2 > tolerance / 100 * abs(mean):
+                return False
+        counts = [self.passed, *self.barcodes.values(), *self.failing.values()]
+        return all((high - low) / 2 <= tolerance for _, low, high in map(self.percent_interval, counts))
+
+    def to_dict(self, top_k=TOP_BARCODES):
+        def interval(values):
+            estimate, low, high = values
+            return {'estimate': estimate, 'low': low, 'high': high}
+
+        barcodes = self.barcodes.most_common(top_k or None)
+        return {
+            'sampled_reads': self.n,
+            'confidence': self.confidence,
+            'mean_length': interval(self.mean_interval("length")),
+            'mean_gc_content': interval(self.mean_interval("gc_content")),
+            'mean_quality_score': interval(self.mean_interval("mean_quality")),
+            'pass_rate_percent': interval(self.percent_interval(self.passed)),
+            # A read can fail several criteria
+            'failing_percent': {reason: interval(self.percent_interval(count)) for reason, count in self.failing.items()},
+            'barcode_percent': {barcode: interval(self.percent_interval(count)) for barcode, count in barcodes},
+        }
+
+
+class SamplePreview:
+    """Estimate the statistics and the filter pass rate of the input of a FusedPipeline from a sample.
+
+    Give the sample size (records) or the sample fraction; with a tolerance
+    (in percent, see SampleEstimates.converged) index and seek sampling stop
+    as soon as the estimates are that precise.
+    """
+
+    def __init__(self, pipeline, sample_size=None, sample_fraction=None, tolerance=None,
+                 confidence=CONFIDENCE, seed=None, round_size=ROUND_SIZE):
+        if (sample_size is None) == (sample_fraction is None):
+            raise ValueError("Give either a sample size or a sample fraction")
+        if sample_fraction is not None and not 0 < sample_fraction <= 1:
+            raise ValueError("The sample fraction must be in (0, 1]")
+        if sample_size is not None and sample_size < 1:
+            raise ValueError("The sample size must be at least 1")
+        self.pipeline = pipeline
+        self.sample_size = sample_size
+        self.sample_fraction = sample_fraction
+        self.tolerance = tolerance
+        self.confidence = confidence
+        self.rng = np.random.default_rng(seed)
+        self.round_size = round_size
+        self.estimates = SampleEstimates(confidence)
+        self.method = None
+        self.total_reads = None
+        self.stopped_early = False
+
+    def choose_method(self):
+        path = self.pipeline.input_file
+        index = fastq_index.FastqIndex.load_current(path)
+        if index is not None and index.compression != fastq_index.GZIP:
+            return INDEX, index
+        if not path.endswith(compressed_io.EXTENSIONS) and fastq_index.detect_compression(path) == fastq_index.PLAIN:
+            return SEEK, None
+        return STREAM, None
+
+    def run(self):
+        """Draw the sample and return the estimates as a dict."""
+        pipeline = self.pipeline
+        if not os.path.isfile(pipeline.input_file):
+            raise FileNotFoundError(f"FASTQ file not found:{pipeline.input_file}")
+        pipeline.setup_filter()
+        self.method, index = self.choose_method()
+        with pipeline.report.stage("sample") as stage:
+            if self.method == INDEX:
+                self.sample_index(index)
+            elif self.method == SEEK:
+                try:
+                    self.sample_seek()
+                except ValueError as e:
+                    logging.info(f"Random access sampling failed ({e}), sampling in one pass instead")
+                    self.method, self.estimates = STREAM, SampleEstimates(self.confidence)
+                    self.sample_stream()
+            else:
+                self.sample_stream()
+            stage.records += self.estimates.n
+        return self.results()
+
+    def target_size(self, total):
+        if self.sample_size is not None:
+            return min(self.sample_size, total) if self.method == INDEX else self.sample_size
+        return max(1, math.ceil(self.sample_fraction * total))
+
+    def add_records(self, records, weights=None):
+        pipeline = self.pipeline
+        batch = RecordBatch(records)
+        metrics = BatchMetrics(batch, pipeline.barcode_length, pipeline.whitelist)
+        # The criteria see the trimmed reads, the estimates the reads as they are
+        kept, kept_metrics = pipeline.trim(batch, metrics)
+        mask, _ = pipeline.engine.apply(kept_metrics, kept)
+        index = np.arange(len(batch))
+        failing = {
+            predicate.reason: predicate.failed(kept_metrics, index, kept) for predicate in pipeline.engine.predicates
+        }
+        barcodes = FastqStat.batch_barcodes(batch, metrics, pipeline.header_barcode)
+        self.estimates.update(metrics, barcodes, mask, failing, weights)
+
+    def done(self):
+        if self.tolerance is not None and self.estimates.converged(self.tolerance):
+            self.stopped_early = True
+            return True
+        return False
+
+    def sample_index(self, index):
+        self.total_reads = len(index)
+        if not len(index):
+            return
+        numbers = self.rng.choice(len(index), size=self.target_size(len(index)), replace=False)
+        for start in range(0, len(numbers), self.round_size):
+            # Sorted, so every round reads the file front to back
+            records = [index.get_record(int(number)) for number in np.sort(numbers[start:start + self.round_size])]
+            self.add_records(records)
+            if self.done():
+                break
+
+    def sample_seek(self):
+        path = self.pipeline.input_file
+        file_size = os.path.getsize(path)
+        if not file_size:
+            self.total_reads = 0
+            return
+        target = self.sample_size
+        with open(path, 'rb') as handle:
+            # Finding record boundaries only works for 4-line records; parse_chunk raises on others
+            first, _ = self.record_at(handle, 0, file_size)
+            fastq_reader.parse_chunk(first, self.pipeline.reader)
+            while target is None or self.estimates.n < target:
+                count = self.round_size if target is None else min(self.round_size, target - self.estimates.n)
+                offsets = np.sort(self.rng.integers(0, file_size, size=count))
+                chunks, sizes = zip(*(self.record_at(handle, offset, file_size) for offset in offsets.tolist()))
+                weights = 1.0 / np.array(sizes, dtype=np.float64)
+                self.add_records(fastq_reader.parse_chunk(b''.join(chunks), self.pipeline.reader), weights)
+                self.total_reads = self.estimates.total_reads_interval(file_size)
+                if target is None:
+                    # The fraction needs the number of reads, estimated from the first round
+                    target = self.target_size(self.total_reads[0])
+                if self.done():
+                    break
+
+    def next_record_start(self, handle, position, file_size):
+        """Offset of the first record starting at or after position (> 0), file_size if there is none."""
+        window = SEEK_WINDOW
+        while True:
+            handle.seek(position - 1)
+            data = handle.read(window)
+            found = find_record_start(data, at_end=position - 1 + len(data) >= file_size)
+            if found is None:
+                return file_size
+            if found != -1:
+                return position - 1 + found
+            if window >= MAX_SEEK_WINDOW:
+                raise ValueError(f"no 4-line FASTQ record found within {MAX_SEEK_WINDOW} bytes")
+            window *= 2
+
+    def record_at(self, handle, offset, file_size):
+        """(bytes, size in the file) of the record holding the byte at offset."""
+        end = self.next_record_start(handle, offset + 1, file_size)
+        window = SEEK_WINDOW
+        while True:
+            start = max(end - window, 0)
+            handle.seek(start)
+            data = handle.read(end - start)
+            if not data.endswith(b'\n'):
+                data += b'\n'  # the last record of a file without a final newline
+            # The record starts after the fifth newline from its end
+            cut = len(data) - 1
+            for _ in range(4):
+                cut = data.rfind(b'\n', 0, cut)
+                if cut == -1:
+                    break
+            if cut != -1 or start == 0:
+                return data[cut + 1:], end - (start + cut + 1)
+            if window >= MAX_SEEK_WINDOW:
+                raise ValueError(f"no 4-line FASTQ record found within {MAX_SEEK_WINDOW} bytes")
+            window *= 2
+
+    def sample_stream(self):
+        # Reservoir (algorithm R) of sample_size records, or a Bernoulli sample of the fraction
+        pipeline = self.pipeline
+        records = fastq_reader.read_fastq(pipeline.input_file, pipeline.reader)
+        reservoir = []
+        seen = 0
+        for records_batch in iter_batches(records):
+            if self.sample_fraction is not None:
+                keep = self.rng.random(len(records_batch)) < self.sample_fraction
+                chosen = [record for record, kept in zip(records_batch, keep.tolist()) if kept]
+                if chosen:
+                    self.add_records(chosen)
+            else:
+                slots = (self.rng.random(len(records_batch)) * np.arange(seen + 1, seen + len(records_batch) + 1)).astype(np.int64)
+                for number, (record, slot) in enumerate(zip(records_batch, slots.tolist()), seen):
+                    if number < self.sample_size:
+                        reservoir.append(record)
+                    elif slot < self.sample_size:
+                        reservoir[slot] = record
+            seen += len(records_batch)
+        for start in range(0, len(reservoir), self.round_size):
+            self.add_records(reservoir[start:start + self.round_size])
+        self.total_reads = seen
+
+    def results(self):
+        results = {
+            'input': self.pipeline.input_file,
+            'method': self.method,
+            'stopped_early': self.stopped_early,
+            'tolerance_percent': self.tolerance,
+            **self.estimates.to_dict(),
+        }
+        if isinstance(self.total_reads, tuple):
+            estimate, low, high = self.total_reads
+            results['total_reads'] = {'estimate': estimate, 'low': low, 'high': high}
+        else:
+            results['total_reads'] = self.total_reads
+        return results
@@ -0,0 +1,160 @@
+import queue
+import threading
+
+# Pipelined execution: a reader thread parses record batches ahead of the
+# compute stage and a writer thread writes the results behind it. The stages
+# are connected by bounded queues, so a slow stage blocks the one feeding it
+# (backpressure) and at most QUEUE_DEPTH batches are buffered between two
+# stages. Decompression, numpy and file writes release the GIL, which is
+# where the stages overlap.
+QUEUE_DEPTH = 4
+_POLL_SECONDS = 0.1
+_END = object()
+
+
+class StageError(RuntimeError):
+    """An error raised by a pipeline stage running on another thread."""
+
+    def __init__(self, stage, error):
+        super().__init__(f"{stage} stage failed: {type(error).__name__}: {error}")
+        self.stage = stage
+        self.error = error
+
+
+class _Stage:
+    # A background thread and the bounded queue it shares with the main thread
+
+    def __init__(self, name, depth):
+        self.name = name
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _start(self, target):
+        self.thread = threading.Thread(target=target, name=f"{self.name}-stage", daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        # Give up when the other side cancelled the pipeline
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=_POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def cancel(self):
+        """Stop the thread without waiting for the queued items."""
+        self.stopped.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+
+class ReaderStage(_Stage):
+    """Iterate over an iterable (e.g. of record batches) on a background thread.
+
+    Iterating the stage yields the items in order. An error of the iterable is
+    raised in the consuming thread as a StageError; closing the stage early
+    stops the thread.
+    """
+
+    def __init__(self, iterable, name="reader", depth=QUEUE_DEPTH):
+        super().__init__(name, depth)
+        self.iterable = iterable
+        self._start(self._produce)
+
+    def _produce(self):
+        try:
+            for item in self.iterable:
+                if not self._put(item):
+                    return
+            self._put(_END)
+        except BaseException as e:
+            self._put(StageError(self.name, e))
+
+    def __iter__(self):
+        try:
+            while True:
+                try:
+                    item = self.queue.get(timeout=_POLL_SECONDS)
+                except queue.Empty:
+                    if not self.thread.is_alive() and self.queue.empty():
+                        raise StageError(self.name, RuntimeError("the thread stopped without a result"))
+                    continue
+                if item is _END:
+                    return
+                if isinstance(item, StageError):
+                    raise item
+                yield item
+        finally:
+            self.cancel()
+
+    def close(self):
+        self.cancel()
+
+
+class WriterStage(_Stage):
+    """Call consume(item) for every put item on a background thread, in order.
+
+    put blocks while the queue is full. An error of consume is raised as a
+    StageError by the next put or by close, and the items after it are dropped.
+    """
+
+    def __init__(self, consume, name="writer", depth=QUEUE_DEPTH):
+        super().__init__(name, depth)
+        self.consume = consume
+        self.error = None
+        self._start(self._run)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                item = self.queue.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                continue
+            if item is _END:
+                return
+            try:
+                self.consume(item)
+            except BaseException as e:
+                self.error = StageError(self.name, e)
+                self.stopped.set()
+                return
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, item):
+        self._check()
+        if not self._put(item):
+            self._check()
+            raise StageError(self.name, RuntimeError("the stage was cancelled"))
+
+    def close(self):
+        """Wait until every queued item is consumed, then raise the error of the stage, if any."""
+        if not self.stopped.is_set():
+            self._put(_END)
+            self.thread.join()
+        self._check()
+
+
+class QueuedWriter:
+    """File-like object whose write() hands the data to a WriterStage writing to handle."""
+
+    def __init__(self, handle, name="writer", depth=QUEUE_DEPTH):
+        self.handle = handle
+        self.stage = WriterStage(handle.write, name, depth)
+
+    def write(self, data):
+        if data:
+            self.stage.put(data)
+        return len(data)
+
+    def close(self):
+        # Only the stage is closed; the caller owns handle
+        self.stage.close()
+
+    def cancel(self):
+        self.stage.cancel()
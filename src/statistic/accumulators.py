@@ -0,0 +1,231 @@
+from collections import Counter
+import numpy as np
+
+# Length bins: one bin per length below 100 bases, then bins 1% wide up to
+# 100 Mb. Quantiles and N50 read from them are accurate to about 1%.
+LENGTH_EDGES = np.unique(np.concatenate([
+    np.arange(100),
+    np.floor(100 * 1.01 ** np.arange(0, int(np.log(1e6) / np.log(1.01)) + 1)),
+])).astype(np.float64)
+# Mean quality and GC content bins are 0.1 wide
+QUALITY_EDGES = np.arange(0, 94.1, 0.1)
+GC_EDGES = np.arange(0, 100.1, 0.1)
+QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+
+
+class RunningStats:
+    """Count, sum, minimum and maximum of a stream of values."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def update(self, values):
+        if not len(values):
+            return
+        self.count += len(values)
+        self.total += float(values.sum())
+        low, high = values.min().item(), values.max().item()
+        self.minimum = low if self.minimum is None else min(self.minimum, low)
+        self.maximum = high if self.maximum is None else max(self.maximum, high)
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        for value in (other.minimum, other.maximum):
+            if value is not None:
+                self.minimum = value if self.minimum is None else min(self.minimum, value)
+                self.maximum = value if self.maximum is None else max(self.maximum, value)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def to_dict(self):
+        return {'count': self.count, 'total': self.total, 'min': self.minimum, 'max': self.maximum}
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.count, stats.total = data['count'], data['total']
+        stats.minimum, stats.maximum = data['min'], data['max']
+        return stats
+
+
+class Histogram:
+    """Fixed-bin histogram keeping the count and the sum of the values in every bin.
+
+    Values above the last edge are counted in the last bin. Two histograms with
+    the same edges are merged by adding their arrays.
+    """
+
+    def __init__(self, edges):
+        self.edges = edges
+        self.counts = np.zeros(len(edges), dtype=np.int64)
+        self.sums = np.zeros(len(edges), dtype=np.float64)
+
+    def update(self, values):
+        if not len(values):
+            return
+        index = np.searchsorted(self.edges, values, side='right') - 1
+        np.clip(index, 0, len(self.edges) - 1, out=index)
+        self.counts += np.bincount(index, minlength=len(self.edges))
+        self.sums += np.bincount(index, weights=values, minlength=len(self.edges))
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.sums += other.sums
+
+    def quantile(self, q):
+        """Approximate quantile, interpolated linearly inside its bin."""
+        total = self.counts.sum()
+        if not total:
+            return 0
+        cumulative = np.cumsum(self.counts)
+        target = q * total
+        index = int(np.searchsorted(cumulative, target, side='left'))
+        index = min(index, len(self.edges) - 1)
+        lower = self.edges[index]
+        upper = self.edges[index + 1] if index + 1 < len(self.edges) else lower
+        before = cumulative[index] - self.counts[index]
+        fraction = (target - before) / self.counts[index] if self.counts[index] else 0
+        return float(lower + (upper - lower) * fraction)
+
+    def weighted_median(self):
+        """Value at which the cumulative sum of values from the top reaches half of the total (N50 for lengths)."""
+        total = self.sums.sum()
+        if not total:
+            return 0
+        cumulative = np.cumsum(self.sums[::-1])
+        index = len(self.sums) - 1 - int(np.searchsorted(cumulative, total / 2, side='left'))
+        return float(self.sums[index] / self.counts[index])
+
+    def to_dict(self):
+        return {'counts': self.counts.tolist(), 'sums': self.sums.tolist()}
+
+    @classmethod
+    def from_dict(cls, edges, data):
+        histogram = cls(edges)
+        histogram.counts[:] = data['counts']
+        histogram.sums[:] = data['sums']
+        return histogram
+
+
+class StreamingStats:
+    """Mergeable accumulators for the per-read metrics of a FASTQ file.
+
+    Memory use is fixed by the histogram bins and the number of distinct
+    barcodes; it does not grow with the number of reads.
+    """
+
+    def __init__(self):
+        self.lengths = RunningStats()
+        self.gc_content = RunningStats()
+        self.mean_quality = RunningStats()
+        self.n_bases = 0
+        # Reads shortened by the trimming stage and the bases cut from them
+        self.trimmed_reads = 0
+        self.trimmed_bases = 0
+        self.length_histogram = Histogram(LENGTH_EDGES)
+        self.gc_histogram = Histogram(GC_EDGES)
+        self.quality_histogram = Histogram(QUALITY_EDGES)
+        self.barcodes = Counter()
+
+    @property
+    def count(self):
+        return self.lengths.count
+
+    def update(self, metrics, barcodes, mask=None):
+        """Add a BatchMetrics (optionally only the records selected by mask) and their barcodes."""
+        lengths, gc_content, mean_quality, n_count = (
+            metrics.lengths, metrics.gc_content, metrics.mean_quality, metrics.n_count
+        )
+        if mask is not None:
+            lengths, gc_content, mean_quality, n_count = (
+                lengths[mask], gc_content[mask], mean_quality[mask], n_count[mask]
+            )
+            barcodes = [barcode for barcode, keep in zip(barcodes, mask.tolist()) if keep]
+
+        self.lengths.update(lengths)
+        self.gc_content.update(gc_content)
+        self.mean_quality.update(mean_quality)
+        self.n_bases += int(n_count.sum())
+        self.length_histogram.update(lengths.astype(np.float64))
+        self.gc_histogram.update(gc_content)
+        self.quality_histogram.update(mean_quality)
+        self.barcodes.update(barcode for barcode in barcodes if barcode is not None)
+
+    def update_trimmed(self, trimmed_bases, mask=None):
+        """Add the number of bases trimmed from every record (optionally only the records selected by mask)."""
+        if mask is not None:
+            trimmed_bases = trimmed_bases[mask]
+        self.trimmed_reads += int(np.count_nonzero(trimmed_bases))
+        self.trimmed_bases += int(trimmed_bases.sum())
+
+    def merge(self, other):
+        self.lengths.merge(other.lengths)
+        self.gc_content.merge(other.gc_content)
+        self.mean_quality.merge(other.mean_quality)
+        self.n_bases += other.n_bases
+        self.trimmed_reads += other.trimmed_reads
+        self.trimmed_bases += other.trimmed_bases
+        self.length_histogram.merge(other.length_histogram)
+        self.gc_histogram.merge(other.gc_histogram)
+        self.quality_histogram.merge(other.quality_histogram)
+        self.barcodes.update(other.barcodes)
+
+    def summary(self):
+        """Return the statistics as a flat dict of plain Python values."""
+        summary = {
+            'reads': self.count,
+            'bases': int(self.lengths.total),
+            'n_bases': self.n_bases,
+            'min_length': self.lengths.minimum,
+            'max_length': self.lengths.maximum,
+            'mean_length': self.lengths.mean,
+            'n50': self.length_histogram.weighted_median(),
+            'mean_gc_content': self.gc_content.mean,
+            'mean_quality_score': self.mean_quality.mean,
+            'barcodes': len(self.barcodes),
+            'trimmed_reads': self.trimmed_reads,
+            'trimmed_bases': self.trimmed_bases,
+        }
+        for q in QUANTILES:
+            percent = int(q * 100)
+            summary[f'length_q{percent}'] = self.length_histogram.quantile(q)
+            summary[f'gc_content_q{percent}'] = self.gc_histogram.quantile(q)
+            summary[f'mean_quality_q{percent}'] = self.quality_histogram.quantile(q)
+        return summary
+
+    def to_dict(self):
+        """Serialise the accumulator state (e.g. to JSON) so it can be restored and merged later."""
+        return {
+            'lengths': self.lengths.to_dict(),
+            'gc_content': self.gc_content.to_dict(),
+            'mean_quality': self.mean_quality.to_dict(),
+            'n_bases': self.n_bases,
+            'trimmed_reads': self.trimmed_reads,
+            'trimmed_bases': self.trimmed_bases,
+            'length_histogram': self.length_histogram.to_dict(),
+            'gc_histogram': self.gc_histogram.to_dict(),
+            'quality_histogram': self.quality_histogram.to_dict(),
+            'barcodes': list(self.barcodes.items()),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.lengths = RunningStats.from_dict(data['lengths'])
+        stats.gc_content = RunningStats.from_dict(data['gc_content'])
+        stats.mean_quality = RunningStats.from_dict(data['mean_quality'])
+        stats.n_bases = data['n_bases']
+        # Checkpoints written before the trimming stage have no trimmed counts
+        stats.trimmed_reads = data.get('trimmed_reads', 0)
+        stats.trimmed_bases = data.get('trimmed_bases', 0)
+        stats.length_histogram = Histogram.from_dict(LENGTH_EDGES, data['length_histogram'])
+        stats.gc_histogram = Histogram.from_dict(GC_EDGES, data['gc_histogram'])
+        stats.quality_histogram = Histogram.from_dict(QUALITY_EDGES, data['quality_histogram'])
+        stats.barcodes = Counter(dict(data['barcodes']))
+        return stats
@@ -0,0 +1,177 @@
+import numpy as np
+from src.parsing.fastq_reader import FastqRecord, PHRED_OFFSET
+
+# Default batch limits. The base limit keeps the buffers of a batch bounded
+# even for ultra-long nanopore reads.
+BATCH_SIZE = 10000
+MAX_BATCH_BASES = 16 * 1024 * 1024
+
+# Block size of the prefix sums in RecordBatch.per_record_sum
+SUM_BLOCK = 64
+
+_G, _C, _N = ord('G'), ord('C'), ord('N')
+_LOWER = 0x20  # ASCII case bit, 'G' | 0x20 == 'g'
+
+
+def iter_batches(records, batch_size=BATCH_SIZE, max_bases=MAX_BATCH_BASES):
+    """Group an iterable of records into lists of at most batch_size records or max_bases bases."""
+    batch = []
+    bases = 0
+    for record in records:
+        batch.append(record)
+        bases += len(record.seq)
+        if len(batch) >= batch_size or bases >= max_bases:
+            yield batch
+            batch = []
+            bases = 0
+    if batch:
+        yield batch
+
+
+class RecordBatch:
+    """A list of records packed into flat NumPy buffers.
+
+    bases holds the concatenated sequences as uint8, qualities the matching
+    Phred scores as uint8 and starts/lengths give the slice of every record.
+    """
+
+    def __init__(self, records):
+        self.records = records
+        self.lengths = np.fromiter((len(record.seq) for record in records), dtype=np.int64, count=len(records))
+        self.starts = np.zeros(len(records), dtype=np.int64)
+        np.cumsum(self.lengths[:-1], out=self.starts[1:])
+
+        if all(isinstance(record, FastqRecord) for record in records):
+            self.bases = np.frombuffer(b''.join([record.seq for record in records]), dtype=np.uint8)
+            raw = np.frombuffer(b''.join([record.qual for record in records]), dtype=np.uint8)
+            if raw.size and (raw.min() < PHRED_OFFSET or raw.max() >= PHRED_OFFSET + 94):
+                raise ValueError("Invalid character in quality string")
+            self.qualities = raw - PHRED_OFFSET
+        else:
+            # SeqRecords already carry decoded Phred scores
+            self.bases = np.frombuffer(b''.join([bytes(record.seq) for record in records]), dtype=np.uint8)
+            self.qualities = np.frombuffer(
+                b''.join([bytes(record.letter_annotations["phred_quality"]) for record in records]),
+                dtype=np.uint8
+            )
+
+    def __len__(self):
+        return len(self.records)
+
+    def take(self, index):
+        """Return a RecordBatch of the records at index (bases and qualities are copied)."""
+        if len(index) == len(self.records):
+            return self
+        subset = RecordBatch.__new__(RecordBatch)
+        subset.records = [self.records[i] for i in index.tolist()]
+        subset.lengths = self.lengths[index]
+        subset.starts = np.zeros(len(index), dtype=np.int64)
+        np.cumsum(subset.lengths[:-1], out=subset.starts[1:])
+        positions = np.repeat(self.starts[index] - subset.starts, subset.lengths) + np.arange(int(subset.lengths.sum()))
+        subset.bases = self.bases[positions]
+        subset.qualities = self.qualities[positions]
+        return subset
+
+    def trim(self, left, right):
+        """Return a RecordBatch of every record cut to its bases left:right (records left whole are reused)."""
+        subset = RecordBatch.__new__(RecordBatch)
+        subset.lengths = right - left
+        subset.starts = np.zeros(len(self.records), dtype=np.int64)
+        np.cumsum(subset.lengths[:-1], out=subset.starts[1:])
+        positions = np.repeat(self.starts + left - subset.starts, subset.lengths) + np.arange(int(subset.lengths.sum()))
+        subset.bases = self.bases[positions]
+        subset.qualities = self.qualities[positions]
+        cut = ((left > 0) | (right < self.lengths)).tolist()
+        subset.records = [
+            (FastqRecord(record.title, record.seq[start:end], record.qual[start:end])
+             if isinstance(record, FastqRecord) else record[start:end]) if is_cut else record
+            for record, start, end, is_cut in zip(self.records, left.tolist(), right.tolist(), cut)
+        ]
+        return subset
+
+    def per_record_sum(self, values):
+        """Sum a per-base uint8 array over every record (empty records sum to 0).
+
+        np.add.reduceat is slow on long arrays, so the sums are taken from
+        prefix sums at the record boundaries instead. The prefix sums are built
+        from fixed-size block sums (a fast contiguous reduction) plus the
+        partial block in front of each boundary.
+        """
+        size = values.size
+        n_blocks = size // SUM_BLOCK
+        block_sums = values[:n_blocks * SUM_BLOCK].reshape(n_blocks, SUM_BLOCK).sum(axis=1, dtype=np.uint16)
+        block_prefix = np.zeros(n_blocks + 1, dtype=np.int64)
+        np.cumsum(block_sums, out=block_prefix[1:])
+
+        bounds = np.append(self.starts, size)
+        block_index = bounds // SUM_BLOCK
+        columns = np.arange(SUM_BLOCK)
+        in_partial = columns < (bounds - block_index * SUM_BLOCK)[:, None]
+        partial_index = np.minimum(block_index[:, None] * SUM_BLOCK + columns, max(size - 1, 0))
+        partial = values[partial_index] if size else np.zeros(partial_index.shape, dtype=np.uint8)
+        prefix = block_prefix[block_index] + np.where(in_partial, partial, 0).sum(axis=1, dtype=np.int64)
+        return np.diff(prefix)
+
+    def prefixes(self, length):
+        """Return the first `length` bases of every record as a list of str."""
+        if length <= 0:
+            return [''] * len(self.records)
+        columns = np.arange(length)
+        index = self.starts[:, None] + columns
+        valid = columns < self.lengths[:, None]
+        padded = np.where(valid, self.bases[np.where(valid, index, 0)] if self.bases.size else 0, 0)
+        # NUL padding is dropped by the fixed-width bytes dtype
+        return padded.astype(np.uint8).view(f'S{length}').ravel().astype(f'U{length}').tolist()
+
+
+class BatchMetrics:
+    """Per-record metrics of a RecordBatch, computed with vectorized operations.
+
+    gc_content follows FastqStat (upper-case G/C only) while gc_content_any
+    follows filter_fastq (G/C in either case). With a BarcodeWhitelist the
+    barcodes are the assigned whitelist names instead of the raw prefixes.
+    """
+
+    def __init__(self, batch, barcode_length=6, whitelist=None):
+        lengths = batch.lengths
+        upper = batch.bases & ~np.uint8(_LOWER)
+        is_gc = (batch.bases == _G) | (batch.bases == _C)
+        is_gc_any = (upper == _G) | (upper == _C)
+
+        self.lengths = lengths
+        self.gc_count = batch.per_record_sum(is_gc)
+        self.gc_count_any = batch.per_record_sum(is_gc_any)
+        self.n_count = batch.per_record_sum(upper == _N)
+        self.quality_sum = batch.per_record_sum(batch.qualities)
+        if whitelist is not None:
+            self.barcodes = whitelist.assign_many(batch.prefixes(whitelist.barcode_length))
+        else:
+            self.barcodes = batch.prefixes(barcode_length)
+        self._derive()
+
+    @classmethod
+    def from_counts(cls, lengths, gc_count, gc_count_any, n_count, quality_sum, barcodes):
+        """Rebuild the metrics from stored per-record counts (e.g. from the result cache)."""
+        metrics = cls.__new__(cls)
+        metrics.lengths = lengths.astype(np.int64)
+        metrics.gc_count = gc_count.astype(np.int64)
+        metrics.gc_count_any = gc_count_any.astype(np.int64)
+        metrics.n_count = n_count.astype(np.int64)
+        metrics.quality_sum = quality_sum.astype(np.int64)
+        metrics.barcodes = barcodes
+        metrics._derive()
+        return metrics
+
+    def _derive(self):
+        lengths = self.lengths
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.gc_content = np.where(lengths > 0, (self.gc_count / lengths) * 100, 0.0)
+            self.gc_content_any = np.where(lengths > 0, (self.gc_count_any / lengths) * 100, 0.0)
+            self.mean_quality = np.where(lengths > 0, self.quality_sum / lengths, 0.0)
+
+
+def iter_batch_metrics(records, barcode_length=6, batch_size=BATCH_SIZE, max_bases=MAX_BATCH_BASES, whitelist=None):
+    """Yield (RecordBatch, BatchMetrics) pairs for an iterable of records."""
+    for records_batch in iter_batches(records, batch_size, max_bases):
+        batch = RecordBatch(records_batch)
+        yield batch, BatchMetrics(batch, barcode_length, whitelist)
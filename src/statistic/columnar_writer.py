@@ -0,0 +1,236 @@
+import importlib.util
+import json
+import logging
+import os
+import struct
+import numpy as np
+from src.constants import CSV, PARQUET, NPY, METRICS_FORMATS
+
+# Per-read metrics as typed columns instead of CSV rows (main.py --metrics_format).
+# The columns are built from the BatchMetrics arrays of every batch and written
+# right away, so memory stays bounded by the batch size. Parquet needs pyarrow;
+# without it every column is a memory-mappable .npy file in a directory:
+#   length.npy, gc_content.npy, mean_quality_score.npy    numbers
+#   sequence_id.npy, sequence_id_offsets.npy              UTF-8 bytes of all ids and the
+#                                                         start of every id (rows + 1 values)
+#   barcode.npy, barcode_group.npy                        int32 codes into the categories
+#                                                         of columns.json, -1 for None
+METRICS_COLUMNS = ("sequence_id", "length", "gc_content", "mean_quality_score", "barcode", "barcode_group")
+CATEGORY_COLUMNS = ("barcode", "barcode_group")
+NUMBER_COLUMNS = (("length", '<i8'), ("gc_content", '<f8'), ("mean_quality_score", '<f8'))
+NPY_INFO_FILE = "columns.json"
+NPY_VERSION = 1
+NO_CATEGORY = -1
+# Fixed size of the .npy headers, so the final shape can be written over the first one
+_NPY_HEADER_SIZE = 128
+READ_CHUNK = 65536
+
+
+def has_pyarrow():
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def resolve_format(metrics_format):
+    """Return the format to write: Parquet falls back to .npy columns without pyarrow."""
+    if metrics_format == PARQUET and not has_pyarrow():
+        logging.warning("pyarrow is not installed, writing the metrics as .npy columns instead of Parquet")
+        return NPY
+    return metrics_format
+
+
+def metrics_path(directory, name, metrics_format):
+    """Path of the metrics of a name (e.g. "original_statistics") in a format."""
+    if metrics_format == PARQUET:
+        return os.path.join(directory, f"{name}.parquet")
+    if metrics_format == NPY:
+        return os.path.join(directory, f"{name}_columns")
+    return os.path.join(directory, f"{name}.csv")
+
+
+def select_columns(columns, mask):
+    """Keep the rows of a column dict where mask is True."""
+    keep = mask.tolist()
+    return {
+        name: values[mask] if isinstance(values, np.ndarray) else [value for value, passed in zip(values, keep) if passed]
+        for name, values in columns.items()
+    }
+
+
+def open_metrics_writer(path, metrics_format):
+    if metrics_format == PARQUET:
+        return ParquetMetricsWriter(path)
+    if metrics_format == NPY:
+        return NpyMetricsWriter(path)
+    raise ValueError(f"Unknown columnar metrics format: {metrics_format}")
+
+
+class _NpyAppender:
+    """Append values to a .npy file; the header holds the final shape after close."""
+
+    def __init__(self, path, dtype):
+        self.dtype = np.dtype(dtype)
+        self.handle = open(path, 'wb')
+        self.count = 0
+        self.write_header()
+
+    def write_header(self):
+        header = repr({
+            'descr': np.lib.format.dtype_to_descr(self.dtype), 'fortran_order': False, 'shape': (self.count,),
+        })
+        magic = np.lib.format.magic(1, 0)
+        size = _NPY_HEADER_SIZE - len(magic) - 2
+        self.handle.seek(0)
+        self.handle.write(magic + struct.pack('<H', size) + (header.ljust(size - 1) + '\n').encode('latin1'))
+
+    def append(self, values):
+        values = np.asarray(values, dtype=self.dtype)
+        if len(values):
+            values.tofile(self.handle)
+            self.count += len(values)
+
+    def close(self):
+        self.write_header()
+        self.handle.close()
+
+
+class NpyMetricsWriter:
+    """Write metrics column dicts (FastqStat.batch_metrics_columns) to a directory of .npy files."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.numbers = {name: _NpyAppender(os.path.join(path, f"{name}.npy"), dtype) for name, dtype in NUMBER_COLUMNS}
+        self.codes = {name: _NpyAppender(os.path.join(path, f"{name}.npy"), '<i4') for name in CATEGORY_COLUMNS}
+        self.categories = {name: {} for name in CATEGORY_COLUMNS}
+        self.ids = _NpyAppender(os.path.join(path, "sequence_id.npy"), np.uint8)
+        self.offsets = _NpyAppender(os.path.join(path, "sequence_id_offsets.npy"), '<i8')
+        self.offsets.append([0])
+        self.rows = 0
+
+    def write_columns(self, columns):
+        for name, _ in NUMBER_COLUMNS:
+            self.numbers[name].append(columns[name])
+        for name in CATEGORY_COLUMNS:
+            table = self.categories[name]
+            self.codes[name].append([
+                NO_CATEGORY if value is None else table.setdefault(value, len(table)) for value in columns[name]
+            ])
+        encoded = [sequence_id.encode() for sequence_id in columns["sequence_id"]]
+        self.offsets.append(self.ids.count + np.cumsum([len(sequence_id) for sequence_id in encoded], dtype=np.int64))
+        self.ids.append(np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        self.rows += len(encoded)
+
+    def append_file(self, path):
+        """Append the rows of metrics written by another NpyMetricsWriter."""
+        for columns in iter_npy_metrics(path):
+            self.write_columns(columns)
+
+    def close(self):
+        for appender in (*self.numbers.values(), *self.codes.values(), self.ids, self.offsets):
+            appender.close()
+        info = {
+            'version': NPY_VERSION,
+            'rows': self.rows,
+            'categories': {name: list(table) for name, table in self.categories.items()},
+        }
+        with open(os.path.join(self.path, NPY_INFO_FILE), 'w') as handle:
+            json.dump(info, handle)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load_npy_metrics(path):
+    """Memory-map the columns written by an NpyMetricsWriter.
+
+    Returns (columns, categories): the number, code, sequence_id and
+    sequence_id_offsets arrays and the category list of every code column.
+    """
+    with open(os.path.join(path, NPY_INFO_FILE)) as handle:
+        info = json.load(handle)
+    if info.get('version') != NPY_VERSION:
+        raise ValueError(f"Unsupported metrics columns version in {path}")
+    names = [name for name, _ in NUMBER_COLUMNS] + list(CATEGORY_COLUMNS) + ["sequence_id", "sequence_id_offsets"]
+    # Empty files cannot be memory-mapped
+    columns = {
+        name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r' if info['rows'] else None) for name in names
+    }
+    return columns, info['categories']
+
+
+def iter_npy_metrics(path, chunk_size=READ_CHUNK):
+    """Yield the rows of an NpyMetricsWriter directory as column dicts of chunk_size rows."""
+    columns, categories = load_npy_metrics(path)
+    rows = len(columns["length"])
+    offsets = columns["sequence_id_offsets"]
+    for start in range(0, rows, chunk_size):
+        end = min(start + chunk_size, rows)
+        chunk = {name: np.asarray(columns[name][start:end]) for name, _ in NUMBER_COLUMNS}
+        for name in CATEGORY_COLUMNS:
+            table = categories[name]
+            chunk[name] = [None if code == NO_CATEGORY else table[code] for code in columns[name][start:end].tolist()]
+        ids = bytes(columns["sequence_id"][offsets[start]:offsets[end]])
+        bounds = (offsets[start:end + 1] - offsets[start]).tolist()
+        chunk["sequence_id"] = [ids[begin:stop].decode() for begin, stop in zip(bounds, bounds[1:])]
+        yield chunk
+
+
+class ParquetMetricsWriter:
+    """Write metrics column dicts to a Parquet file, one row group per batch (needs pyarrow)."""
+
+    def __init__(self, path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.pq = pq
+        self.path = path
+        self.schema = pa.schema([
+            ("sequence_id", pa.string()),
+            ("length", pa.int64()),
+            ("gc_content", pa.float64()),
+            ("mean_quality_score", pa.float64()),
+            ("barcode", pa.string()),
+            ("barcode_group", pa.string()),
+        ])
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.rows = 0
+
+    def write_columns(self, columns):
+        if not len(columns["length"]):
+            return
+        self.writer.write_table(self.pa.Table.from_pydict(columns, schema=self.schema))
+        self.rows += len(columns["length"])
+
+    def append_file(self, path):
+        """Append the rows of a Parquet file written by another ParquetMetricsWriter."""
+        for record_batch in self.pq.ParquetFile(path).iter_batches(batch_size=READ_CHUNK):
+            self.writer.write_table(self.pa.Table.from_batches([record_batch], schema=self.schema))
+            self.rows += record_batch.num_rows
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ColumnBuffer:
+    """Keep the column dicts of a parallel worker for the writer of the main process."""
+
+    def __init__(self):
+        self.chunks = []
+        self.rows = 0
+
+    def write_columns(self, columns):
+        self.chunks.append(columns)
+        self.rows += len(columns["length"])
+
+    def write_to(self, writer):
+        for columns in self.chunks:
+            writer.write_columns(columns)
@@ -0,0 +1,77 @@
+import csv
+import os
+import shutil
+
+METRICS_COLUMNS = ("sequence_id", "length", "gc_content​ (%)", "mean_quality_score", "barcode", "barcode_group")
+_FLOAT_COLUMNS = (2, 3)
+
+
+class MetricsCsvWriter:
+    """Stream metrics rows (as built by FastqStat.batch_metrics_rows) to a CSV file.
+
+    The output is the same as pd.DataFrame(rows).to_csv(path, index=False):
+    the header is written before the first row, None becomes an empty field,
+    the GC and quality columns are always floats and a file without rows holds
+    a single empty line.
+    """
+
+    def __init__(self, handle, header=True):
+        self.handle = handle
+        self.header = header
+        self.rows = 0
+        self.writer = csv.writer(handle, lineterminator=os.linesep)
+
+    @classmethod
+    def open(cls, path, append_after=None):
+        # append_after is the number of rows already in the file, to continue it
+        if append_after is None:
+            return cls(open(path, 'w', newline=''))
+        writer = cls(open(path, 'a', newline=''))
+        writer.rows = append_after
+        return writer
+
+    def flush(self):
+        self.handle.flush()
+
+    def write_rows(self, rows):
+        if not rows:
+            return
+        if self.header and not self.rows:
+            self.writer.writerow(METRICS_COLUMNS)
+        for row in rows:
+            values = list(row.values())
+            for column in _FLOAT_COLUMNS:
+                values[column] = float(values[column])
+            self.writer.writerow(values)
+        self.rows += len(rows)
+
+    def write_text(self, text, rows):
+        """Append CSV text produced by a header-less writer in a worker."""
+        if not rows:
+            return
+        if self.header and not self.rows:
+            self.writer.writerow(METRICS_COLUMNS)
+        self.handle.write(text)
+        self.rows += rows
+
+    def append_file(self, path, rows):
+        """Append the rows of a CSV file written by another MetricsCsvWriter (its header is skipped)."""
+        if not rows:
+            return
+        if self.header and not self.rows:
+            self.writer.writerow(METRICS_COLUMNS)
+        with open(path, newline='') as source:
+            source.readline()
+            shutil.copyfileobj(source, self.handle)
+        self.rows += rows
+
+    def close(self):
+        if self.header and not self.rows:
+            self.handle.write(os.linesep)
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
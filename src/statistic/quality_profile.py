@@ -0,0 +1,225 @@
+import numpy as np
+from src.parsing.demux import UNCLASSIFIED
+from src.constants import QUALITY_PROFILE_FILE, QUALITY_HEATMAP_FILE, STATES
+
+# Per-position quality profile: 2D histograms of position x Phred score,
+# counted from the 5' start and from the 3' end of every read (the 3' profile
+# shows the quality drop at the end of nanopore reads whatever their length),
+# and length-binned histograms of GC content and mean quality. The histograms
+# have fixed sizes, so a 100 kb read adds counts, not memory.
+QUALITY_PROFILE_VERSION = 1
+# One bin per position below 100 bases, then bins 5% wide up to 10 Mb
+POSITION_EDGES = np.unique(np.concatenate([
+    np.arange(100),
+    np.floor(100 * 1.05 ** np.arange(0, int(np.log(1e5) / np.log(1.05)) + 1)),
+])).astype(np.int64)
+PHRED_SCORES = 94
+LENGTH_BIN_EDGES = np.array([0, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000], dtype=np.int64)
+GC_BINS = 101
+# Barcode groups beyond MAX_GROUPS (the largest ONT barcoding kits) are counted
+# together in OTHER; the rows of the groups are only touched once they are used
+MAX_GROUPS = 96
+OTHER = "other"
+ARRAYS = ('from_start', 'from_end', 'length_gc', 'length_quality', 'length_gc_sum', 'length_quality_sum')
+# Bases binned at a time, bounding the temporary arrays of a batch
+PROFILE_BLOCK = 1 << 20
+# Position bins of the first positions are looked up instead of searched
+_POSITION_LOOKUP = np.searchsorted(POSITION_EDGES, np.arange(1 << 16), side='right') - 1
+
+
+def bin_index(edges, values):
+    """Index of the bin of every value; values above the last edge go to the last bin."""
+    return np.searchsorted(edges, values, side='right') - 1
+
+
+def position_bins(positions):
+    bins = _POSITION_LOOKUP[np.minimum(positions, len(_POSITION_LOOKUP) - 1)]
+    far = positions >= len(_POSITION_LOOKUP)
+    if far.any():
+        bins[far] = bin_index(POSITION_EDGES, positions[far])
+    return bins
+
+
+class QualityProfile:
+    """Mergeable per-position and length-binned quality histograms, per barcode group.
+
+    The arrays have a leading group axis (groups in order of first appearance)
+    and a state axis: 0 for the reads failing the filter, 1 for the reads
+    passing it. The original reads are the sum of both.
+    """
+
+    def __init__(self):
+        self.groups = {}
+        # One row per group and one for OTHER; rows not used yet stay zero
+        rows, positions, lengths = MAX_GROUPS + 1, len(POSITION_EDGES), len(LENGTH_BIN_EDGES)
+        self.from_start = np.zeros((rows, 2, positions, PHRED_SCORES), dtype=np.int64)
+        self.from_end = np.zeros((rows, 2, positions, PHRED_SCORES), dtype=np.int64)
+        self.length_gc = np.zeros((rows, 2, lengths, GC_BINS), dtype=np.int64)
+        self.length_quality = np.zeros((rows, 2, lengths, PHRED_SCORES), dtype=np.int64)
+        self.length_gc_sum = np.zeros((rows, 2, lengths), dtype=np.float64)
+        self.length_quality_sum = np.zeros((rows, 2, lengths), dtype=np.float64)
+
+    def __getstate__(self):
+        # Parallel workers send back only the rows of their groups
+        state = dict(self.__dict__)
+        for name in ARRAYS:
+            state[name] = state[name][:len(self.groups)]
+        return state
+
+    def __setstate__(self, state):
+        for name in ARRAYS:
+            array = state[name]
+            state[name] = np.concatenate([array, np.zeros((MAX_GROUPS + 1 - len(array),) + array.shape[1:], dtype=array.dtype)])
+        self.__dict__.update(state)
+
+    def group_codes(self, barcodes):
+        """Index of the group of every barcode, adding groups as they appear."""
+        table = {}
+        # In order of first appearance, so the order of the groups does not depend on string hashing
+        for barcode in dict.fromkeys(barcodes):
+            group = UNCLASSIFIED if barcode is None else barcode
+            if group not in self.groups and len(self.groups) >= MAX_GROUPS:
+                group = OTHER
+            table[barcode] = self.group_index(group)
+        return np.array([table[barcode] for barcode in barcodes], dtype=np.int64)
+
+    def group_index(self, group):
+        if group not in self.groups:
+            self.groups[group] = len(self.groups)
+        return self.groups[group]
+
+    def update(self, batch, metrics, barcodes, mask):
+        """Add a RecordBatch, its BatchMetrics and barcodes; mask selects the reads passing the filter."""
+        if not len(batch):
+            return
+        codes = self.group_codes(barcodes)
+        # Cells are counted for the groups of the batch only, then added to their rows
+        present, local = np.unique(codes, return_inverse=True)
+        keys = local * 2 + mask.astype(np.int64)
+        slots = len(present) * 2
+
+        positions = len(POSITION_EDGES)
+        from_start = np.zeros(slots * positions * PHRED_SCORES, dtype=np.int64)
+        from_end = np.zeros(slots * positions * PHRED_SCORES, dtype=np.int64)
+        for start in range(0, batch.bases.size, PROFILE_BLOCK):
+            stop = min(start + PROFILE_BLOCK, batch.bases.size)
+            # Values of the reads overlapping the block, repeated for their bases in it
+            first, last = np.searchsorted(batch.starts, [start, stop - 1], side='right') - 1
+            starts = batch.starts[first:last + 1]
+            ends = starts + batch.lengths[first:last + 1]
+            inside = np.maximum(np.minimum(ends, stop) - np.maximum(starts, start), 0)
+            offsets = np.arange(start, stop, dtype=np.int64)
+            cells = np.repeat(keys[first:last + 1] * (positions * PHRED_SCORES), inside) + batch.qualities[start:stop]
+            for counts, at in ((from_start, offsets - np.repeat(starts, inside)),
+                               (from_end, np.repeat(ends - 1, inside) - offsets)):
+                counts += np.bincount(cells + position_bins(at) * PHRED_SCORES, minlength=counts.size)
+        shape = (len(present), 2, positions, PHRED_SCORES)
+        self.from_start[present] += from_start.reshape(shape)
+        self.from_end[present] += from_end.reshape(shape)
+
+        lengths = len(LENGTH_BIN_EDGES)
+        cells = keys * lengths + bin_index(LENGTH_BIN_EDGES, metrics.lengths)
+        gc_bin = np.clip(np.floor(metrics.gc_content), 0, GC_BINS - 1).astype(np.int64)
+        quality_bin = np.clip(np.floor(metrics.mean_quality), 0, PHRED_SCORES - 1).astype(np.int64)
+        self.length_gc[present] += np.bincount(
+            cells * GC_BINS + gc_bin, minlength=slots * lengths * GC_BINS
+        ).reshape(len(present), 2, lengths, GC_BINS)
+        self.length_quality[present] += np.bincount(
+            cells * PHRED_SCORES + quality_bin, minlength=slots * lengths * PHRED_SCORES
+        ).reshape(len(present), 2, lengths, PHRED_SCORES)
+        self.length_gc_sum[present] += np.bincount(
+            cells, weights=metrics.gc_content, minlength=slots * lengths
+        ).reshape(len(present), 2, lengths)
+        self.length_quality_sum[present] += np.bincount(
+            cells, weights=metrics.mean_quality, minlength=slots * lengths
+        ).reshape(len(present), 2, lengths)
+
+    def merge(self, other):
+        for group, index in other.groups.items():
+            if group not in self.groups and len(self.groups) >= MAX_GROUPS:
+                group = OTHER
+            target = self.group_index(group)
+            self.from_start[target] += other.from_start[index]
+            self.from_end[target] += other.from_end[index]
+            self.length_gc[target] += other.length_gc[index]
+            self.length_quality[target] += other.length_quality[index]
+            self.length_gc_sum[target] += other.length_gc_sum[index]
+            self.length_quality_sum[target] += other.length_quality_sum[index]
+
+    def by_state(self, array):
+        """Rows of the groups, with the (failed, passed) state axis turned into (original, filtered)."""
+        array = array[:len(self.groups)]
+        return np.stack([array[:, 0] + array[:, 1], array[:, 1]], axis=1)
+
+    def write(self, path):
+        """Save the histograms, with the state axis as STATES, to a compressed .npz file."""
+        np.savez_compressed(
+            path,
+            version=QUALITY_PROFILE_VERSION,
+            groups=np.array(list(self.groups), dtype=str),
+            states=np.array(STATES),
+            position_edges=POSITION_EDGES,
+            length_bin_edges=LENGTH_BIN_EDGES,
+            from_start=self.by_state(self.from_start),
+            from_end=self.by_state(self.from_end),
+            length_gc=self.by_state(self.length_gc),
+            length_quality=self.by_state(self.length_quality),
+            length_gc_sum=self.by_state(self.length_gc_sum),
+            length_quality_sum=self.by_state(self.length_quality_sum),
+        )
+
+    def summary(self, positions=100):
+        """Mean quality of the first and last `positions` bases and the length-binned means, overall and per group."""
+        return profile_summary(
+            list(self.groups), self.by_state(self.from_start), self.by_state(self.from_end),
+            self.by_state(self.length_quality), self.by_state(self.length_gc_sum),
+            self.by_state(self.length_quality_sum), positions
+        )
+
+
+def load_quality_profile(path):
+    """Load a file written by QualityProfile.write as a dict of arrays (groups as a list of str)."""
+    with np.load(path) as data:
+        profile = {name: data[name] for name in data.files}
+    if int(profile['version']) != QUALITY_PROFILE_VERSION:
+        raise ValueError(f"Unsupported quality profile version in {path}")
+    profile['groups'] = profile['groups'].tolist()
+    return profile
+
+
+def mean_phred(counts):
+    """Mean Phred score of a (..., PHRED_SCORES) count array, 0 where there are no bases."""
+    total = counts.sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(total > 0, (counts * np.arange(counts.shape[-1])).sum(axis=-1) / total, 0.0)
+
+
+def profile_summary(groups, from_start, from_end, length_quality, length_gc_sum, length_quality_sum, positions=100):
+    # Arrays with a group and a STATES axis; the overall summary adds up the groups
+    edge = int(np.searchsorted(POSITION_EDGES, positions))
+    arrays = (from_start[:, :, :edge], from_end[:, :, :edge], length_quality.sum(axis=-1),
+              length_gc_sum, length_quality_sum)
+
+    def section(start, end, reads, gc_sum, quality_sum):
+        return {
+            name: {
+                f'mean_quality_first_{positions}': float(mean_phred(start[state].sum(axis=0))),
+                f'mean_quality_last_{positions}': float(mean_phred(end[state].sum(axis=0))),
+                'length_bins': [
+                    {
+                        'min_length': int(LENGTH_BIN_EDGES[i]),
+                        'max_length': int(LENGTH_BIN_EDGES[i + 1]) - 1 if i + 1 < len(LENGTH_BIN_EDGES) else None,
+                        'reads': int(reads[state, i]),
+                        'mean_gc_content': float(gc_sum[state, i] / reads[state, i]),
+                        'mean_quality_score': float(quality_sum[state, i] / reads[state, i]),
+                    }
+                    for i in range(len(LENGTH_BIN_EDGES)) if reads[state, i]
+                ],
+            }
+            for state, name in enumerate(STATES)
+        }
+
+    return {
+        'overall': section(*(array.sum(axis=0) for array in arrays)),
+        'per_barcode': {group: section(*(array[index] for array in arrays)) for index, group in enumerate(groups)},
+    }
@@ -0,0 +1,47 @@
+import json
+from collections import Counter
+
+# Compact summary written after the processing pass: the barcode counts and
+# summary statistics of the original and filtered reads. The pie charts can be
+# rendered from it later (main.py --report-only) without reading the FASTQ again.
+REPORT_DATA_FILE = "report_data.json"
+REPORT_DATA_VERSION = 1
+# Pie charts show the TOP_BARCODES largest barcodes and one slice for the rest
+TOP_BARCODES = 20
+OTHER = "other"
+
+
+def top_barcodes(distribution, top_k=TOP_BARCODES):
+    """Keep the top_k largest slices of a distribution (in their original order) and sum the rest into OTHER.
+
+    top_k of 0 or None keeps every slice.
+    """
+    if not top_k or len(distribution) <= top_k:
+        return distribution
+    largest = set(sorted(distribution, key=distribution.get, reverse=True)[:top_k])
+    capped = {label: value for label, value in distribution.items() if label in largest}
+    capped[OTHER] = capped.get(OTHER, 0) + sum(value for label, value in distribution.items() if label not in largest)
+    return capped
+
+
+def write_report_data(path, original_stats, filtered_stats, info=None):
+    """Save the barcode counts and summaries of two StreamingStats as JSON."""
+    data = {
+        'version': REPORT_DATA_VERSION,
+        'original': {'summary': original_stats.summary(), 'barcodes': list(original_stats.barcodes.items())},
+        'filtered': {'summary': filtered_stats.summary(), 'barcodes': list(filtered_stats.barcodes.items())},
+        **(info or {}),
+    }
+    with open(path, 'w') as handle:
+        json.dump(data, handle)
+
+
+def load_report_data(path):
+    """Load report data; the barcode counts are returned as Counters."""
+    with open(path) as handle:
+        data = json.load(handle)
+    if data.get('version') != REPORT_DATA_VERSION:
+        raise ValueError(f"Unsupported report data version in {path}")
+    for label in ('original', 'filtered'):
+        data[label]['barcodes'] = Counter(dict(data[label]['barcodes']))
+    return data
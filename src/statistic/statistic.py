@@ -1,97 +1,147 @@
 from collections import Counter
-from Bio import SeqIO
+from src.parsing import fastq_reader
+from src.statistic.batch_metrics import iter_batch_metrics
+from src.statistic.accumulators import StreamingStats
+from src.statistic.metrics_writer import MetricsCsvWriter
 import re
-import gzip
+import numpy as np
+
+BARCODE_TAG = re.compile(r'barcode=(\S+)')
 
 class FastqStat:
-    def __init__(self, filename):
+    def __init__(self, filename, reader=fastq_reader.NATIVE, whitelist=None):
         self.filename = filename
+        self.reader = reader
+        # Optional BarcodeWhitelist: barcodes are assigned with mismatches instead of taken as-is
+        self.whitelist = whitelist
 
     def read_fastq(self):
-        """Reads the FASTQ file and returns a list of SeqRecord objects."""
-        if self.filename.endswith('.gz'):
-            with gzip.open(self.filename,"rt") as fastq_file:
-                return list(SeqIO.parse(fastq_file,"fastq"))
-        else:
-            with open(self.filename, 'r') as fastq_file:
-                return list(SeqIO.parse(fastq_file, "fastq"))
+        """Reads the FASTQ file and returns a list of records (FastqRecord or SeqRecord, see reader)."""
+        return list(fastq_reader.read_fastq(self.filename, self.reader))
 
     def sequence(self):
         """Return a list of sequence IDs from the FASTQ file."""
         records = self.read_fastq()
         return [record.id for record in records]
 
+    def iter_batch_metrics(self, barcode_length=0):
+        """Yield (RecordBatch, BatchMetrics) pairs computed with the vectorized engine."""
+        records = fastq_reader.read_fastq(self.filename, self.reader)
+        return iter_batch_metrics(records, barcode_length, whitelist=self.whitelist)
+
     def calculate_sequence_lengths(self):
         """Calculate lengths of all sequences."""
-        records = self.read_fastq()
-        return [len(record.seq) for record in records]
+        lengths = []
+        for _, metrics in self.iter_batch_metrics():
+            lengths.extend(metrics.lengths.tolist())
+        return lengths
 
     def calculate_gc_content_per_sequence(self):
         """Calculate GC content for each sequence."""
         gc_contents = []
-        records = self.read_fastq()
-        for record in records:
-            gc_count = record.seq.count('G') + record.seq.count('C')
-            gc_contents.append((gc_count / len(record.seq)) * 100 if len(record.seq) > 0 else 0)
+        for _, metrics in self.iter_batch_metrics():
+            gc_contents.extend(
+                gc if length else 0
+                for gc, length in zip(metrics.gc_content.tolist(), metrics.lengths.tolist())
+            )
         return gc_contents
 
     def calculate_mean_quality_scores(self):
         """Calculate mean quality scores for each sequence."""
         quality_scores = []
-        records = self.read_fastq()
-        for record in records:
-            scores = record.letter_annotations["phred_quality"]
-            mean_quality = sum(scores) / len(scores) if scores else 0
-            quality_scores.append(mean_quality)
+        for _, metrics in self.iter_batch_metrics():
+            quality_scores.extend(
+                quality if length else 0
+                for quality, length in zip(metrics.mean_quality.tolist(), metrics.lengths.tolist())
+            )
         return quality_scores
 
     def calculate_barcode_distribution(self, barcode_length, header_barcode=False):
         """Calculate the distribution of barcodes."""
         barcode_counter = Counter()
-        records = self.read_fastq()
-        for record in records:
-            if header_barcode:
-                match = re.search(r'barcode=(\S+)', record.description)
-                if match:
-                    barcode = match.group(1)
-                else:
-                    continue
-            else:
-                barcode = str(record.seq)[:barcode_length]  # Assuming barcode is at the start
-            barcode_counter[barcode] += 1
+        for batch, metrics in self.iter_batch_metrics(barcode_length):
+            barcode_counter.update(
+                barcode for barcode in self.batch_barcodes(batch, metrics, header_barcode)
+                if barcode is not None
+            )
+        return self.barcode_distribution(barcode_counter)
 
+    def calculate_metrics(self, barcode_length, header_barcode= False):
+        """Calculate and return all metrics in a structured format."""
+        rows = []
+        for batch, metrics in self.iter_batch_metrics(barcode_length):
+            rows.extend(self.batch_metrics_rows(batch, metrics))
+        return rows
+
+    def calculate_streaming_stats(self, barcode_length, header_barcode=False, csv_path=None):
+        """Calculate summary statistics in constant memory, optionally streaming the metrics rows to a CSV file."""
+        stats = StreamingStats()
+        writer = MetricsCsvWriter.open(csv_path) if csv_path else None
+        try:
+            for batch, metrics in self.iter_batch_metrics(barcode_length):
+                stats.update(metrics, self.batch_barcodes(batch, metrics, header_barcode))
+                if writer is not None:
+                    writer.write_rows(self.batch_metrics_rows(batch, metrics))
+        finally:
+            if writer is not None:
+                writer.close()
+        return stats
+
+    @staticmethod
+    def record_barcode_group(record):
+        """Extract the barcode group from the description (e.g., 'barcode=barcode01')."""
+        match = BARCODE_TAG.search(record.description)
+        return match.group(1) if match else None
+
+    @staticmethod
+    def batch_barcodes(batch, metrics, header_barcode=False):
+        """Return the barcode of every record in a batch, None if the header has no barcode tag."""
+        if header_barcode:
+            return [FastqStat.record_barcode_group(record) for record in batch.records]
+        return metrics.barcodes  # Assuming barcode is at the start
+
+    @staticmethod
+    def barcode_distribution(barcode_counter):
+        """Convert barcode counts into percentages."""
         total_barcodes = sum(barcode_counter.values())
         distribution = {barcode: (count / total_barcodes * 100) for barcode, count in barcode_counter.items()} if total_barcodes > 0 else {}
         return distribution
 
-    def calculate_metrics(self, barcode_length, header_barcode= False):
-        """Calculate and return all metrics in a structured format."""
-        sequence_ids = self.sequence()
-        lengths = self.calculate_sequence_lengths()
-        gc_contents = self.calculate_gc_content_per_sequence()
-        mean_quality_scores = self.calculate_mean_quality_scores()
-        barcode_distribution = self.calculate_barcode_distribution(barcode_length, header_barcode)
+    @staticmethod
+    def batch_metrics_rows(batch, metrics):
+        """Build the metrics rows of a batch from its vectorized metrics."""
+        rows = []
+        columns = zip(
+            batch.records,
+            metrics.lengths.tolist(),
+            metrics.gc_content.tolist(),
+            metrics.mean_quality.tolist(),
+            metrics.barcodes,
+        )
+        for record, length, gc_content, mean_quality, barcode in columns:
+            rows.append({
+                "sequence_id": record.id,
+                "length": length,
+                "gc_content​ (%)": round(gc_content, 2) if length else 0,
+                "mean_quality_score": round(mean_quality, 2) if length else 0,
+                "barcode": barcode,  # Assuming the barcode is at the start of the sequence
+                "barcode_group": FastqStat.record_barcode_group(record),
+            })
+        return rows
 
-        metrics = []
-        records = self.read_fastq()
+    @staticmethod
+    def batch_metrics_columns(batch, metrics):
+        """Build the metrics of a batch as typed columns (the values of batch_metrics_rows, without the dicts)."""
+        return {
+            "sequence_id": [record.id for record in batch.records],
+            "length": metrics.lengths,
+            # Rounded like the CSV rows (np.round differs from round on some halves)
+            "gc_content": np.array([round(value, 2) for value in metrics.gc_content.tolist()]),
+            "mean_quality_score": np.array([round(value, 2) for value in metrics.mean_quality.tolist()]),
+            "barcode": list(metrics.barcodes),
+            "barcode_group": [FastqStat.record_barcode_group(record) for record in batch.records],
+        }
 
-        for idx, record in enumerate(records):
-            # Extract the barcode from the description (e.g., 'barcode=barcode01')
-            match = re.search(r'barcode=(\S+)', record.description)
-            barcode_group = match.group(1) if match else None
-
-            # # Extract the barcode from the sequence
-            barcode = str(record.seq)[:barcode_length]  # Assuming the barcode is at the start of the sequence
-
-            metrics.append({
-                "sequence_id": sequence_ids[idx],
-                "length": lengths[idx],
-                "gc_content​ (%)": round(gc_contents[idx],2) if idx < len(gc_contents) else None,
-                "mean_quality_score": round(mean_quality_scores[idx],2) if idx < len(mean_quality_scores) else None,
-                "barcode": barcode,
-                "barcode_group": barcode_group,
-            })
-        return metrics
     # Using in filtering
     def get_mean_quality_scores(self):
         return sum(self.calculate_mean_quality_scores()) /len(self.records)
@@ -0,0 +1,19 @@
+import shutil
+import pytest
+from benchmarks.synthetic_fastq import generate_fastq
+
+
+@pytest.fixture(scope="session")
+def synthetic_source(tmp_path_factory):
+    # Short ONT-like reads with qualities around the default threshold, so some reads pass the filter
+    path = str(tmp_path_factory.mktemp("synthetic") / "reads.fastq")
+    generate_fastq(path, reads=3000, seed=1, mean_length=400, mean_quality=20)
+    return path
+
+
+@pytest.fixture
+def synthetic_fastq(synthetic_source, tmp_path):
+    """A fresh copy of the synthetic FASTQ file, so indexes and outputs do not leak between tests."""
+    path = str(tmp_path / "reads.fastq")
+    shutil.copyfile(synthetic_source, path)
+    return path
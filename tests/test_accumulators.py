@@ -0,0 +1,94 @@
+import json
+import numpy as np
+import pytest
+from src.parsing import fastq_reader
+from src.statistic.batch_metrics import iter_batch_metrics
+from src.statistic.accumulators import RunningStats, Histogram, StreamingStats, LENGTH_EDGES, QUANTILES
+
+
+def exact_n50(lengths):
+    lengths = np.sort(lengths)[::-1]
+    return lengths[np.searchsorted(np.cumsum(lengths), lengths.sum() / 2)]
+
+
+def split(values, parts, rng):
+    cuts = np.sort(rng.integers(0, len(values), parts - 1))
+    return np.split(values, cuts)
+
+
+def test_running_stats_merge_equals_one_pass():
+    rng = np.random.default_rng(1)
+    values = rng.normal(30, 10, 10000)
+    whole = RunningStats()
+    whole.update(values)
+    merged = RunningStats()
+    for part in split(values, 7, rng) + [values[:0]]:
+        stats = RunningStats()
+        stats.update(part)
+        merged.merge(stats)
+    assert merged.count == whole.count == len(values)
+    assert merged.total == pytest.approx(whole.total)
+    assert (merged.minimum, merged.maximum) == (whole.minimum, whole.maximum) == (values.min(), values.max())
+    assert merged.mean == pytest.approx(values.mean())
+
+
+def test_merging_empty_running_stats():
+    stats = RunningStats()
+    stats.merge(RunningStats())
+    assert (stats.count, stats.minimum, stats.maximum, stats.mean) == (0, None, None, 0)
+
+
+def test_histogram_merge_equals_one_pass():
+    rng = np.random.default_rng(2)
+    lengths = rng.lognormal(7, 1.2, 20000).astype(np.int64).astype(np.float64)
+    whole = Histogram(LENGTH_EDGES)
+    whole.update(lengths)
+    merged = Histogram(LENGTH_EDGES)
+    for part in split(lengths, 5, rng):
+        histogram = Histogram(LENGTH_EDGES)
+        histogram.update(part)
+        merged.merge(histogram)
+    assert merged.counts.tolist() == whole.counts.tolist()
+    assert merged.sums == pytest.approx(whole.sums)
+    assert merged.weighted_median() == pytest.approx(whole.weighted_median())
+    for q in QUANTILES:
+        assert merged.quantile(q) == pytest.approx(whole.quantile(q))
+
+
+def test_n50_and_quantiles_are_within_a_bin_of_the_exact_values():
+    rng = np.random.default_rng(3)
+    lengths = rng.lognormal(8, 1, 50000).astype(np.int64).astype(np.float64)
+    histogram = Histogram(LENGTH_EDGES)
+    histogram.update(lengths)
+    # The bins above 100 bases are 1% wide
+    assert histogram.weighted_median() == pytest.approx(exact_n50(lengths), rel=0.01)
+    for q in QUANTILES:
+        assert histogram.quantile(q) == pytest.approx(np.quantile(lengths, q), rel=0.01)
+
+
+def test_short_lengths_have_one_bin_per_length():
+    lengths = np.array([5, 5, 5, 10, 20, 20], dtype=np.float64)
+    histogram = Histogram(LENGTH_EDGES)
+    histogram.update(lengths)
+    assert histogram.weighted_median() == 20
+    assert 5 <= histogram.quantile(0.25) < 6
+
+
+def test_streaming_stats_split_and_merged_equal_one_pass(synthetic_fastq):
+    batches = list(iter_batch_metrics(fastq_reader.read_fastq(synthetic_fastq), batch_size=250))
+    whole = StreamingStats()
+    parts = [StreamingStats() for _ in range(3)]
+    for number, (batch, metrics) in enumerate(batches):
+        mask = metrics.mean_quality >= 20
+        whole.update(metrics, metrics.barcodes, mask)
+        parts[number % 3].update(metrics, metrics.barcodes, mask)
+    merged = StreamingStats()
+    for part in parts:
+        # Through JSON, as in the checkpoints of follow mode
+        merged.merge(StreamingStats.from_dict(json.loads(json.dumps(part.to_dict()))))
+    expected, summary = whole.summary(), merged.summary()
+    assert summary.keys() == expected.keys()
+    for name, value in expected.items():
+        assert summary[name] == pytest.approx(value), name
+    assert merged.barcodes == whole.barcodes
+    assert 0 < merged.count < sum(len(batch) for batch, _ in batches)
@@ -0,0 +1,69 @@
+import random
+import pytest
+from src.parsing.barcodes import BarcodeWhitelist, AMBIGUOUS, UNASSIGNED, assignment_counts
+
+
+def brute_force(barcodes, prefix, max_mismatches):
+    # Closest barcode by Hamming distance, the way the index is meant to answer
+    prefix = prefix.upper()
+    distances = {}
+    for barcode, name in barcodes.items():
+        if len(prefix) == len(barcode):
+            distance = sum(a != b for a, b in zip(barcode, prefix))
+            if distance <= max_mismatches:
+                distances.setdefault(distance, set()).add(name)
+    if not distances:
+        return UNASSIGNED
+    names = distances[min(distances)]
+    return names.pop() if len(names) == 1 else AMBIGUOUS
+
+
+@pytest.mark.parametrize("max_mismatches", [0, 1, 2])
+def test_index_matches_hamming_brute_force(max_mismatches):
+    rng = random.Random(max_mismatches)
+    barcodes = {''.join(rng.choice("ACGT") for _ in range(6)): f"barcode{number:02d}" for number in range(12)}
+    whitelist = BarcodeWhitelist(barcodes, max_mismatches)
+    prefixes = [''.join(rng.choice("ACGTNacgt") for _ in range(6)) for _ in range(3000)]
+    # Barcodes with a few substitutions, so most reads are close to one
+    for barcode in barcodes:
+        for _ in range(50):
+            variant = list(barcode)
+            for position in rng.sample(range(6), rng.randint(0, 3)):
+                variant[position] = rng.choice("ACGTN")
+            prefixes.append(''.join(variant))
+    prefixes += ["", "ACG"]
+    expected = [brute_force(barcodes, prefix, max_mismatches) for prefix in prefixes]
+    assert whitelist.assign_many(prefixes) == expected
+    assert [whitelist.assign(prefix) for prefix in prefixes] == expected
+
+
+def test_equally_close_barcodes_are_ambiguous():
+    whitelist = BarcodeWhitelist({"AAAA": "one", "AATT": "two"}, max_mismatches=1)
+    assert whitelist.assign("AAAT") == AMBIGUOUS
+    assert whitelist.assign("AAAA") == "one"
+    assert whitelist.assign("aatt") == "two"
+    assert whitelist.assign("CCCC") == UNASSIGNED
+    counts = {"one": 5, AMBIGUOUS: 2, UNASSIGNED: 3}
+    assert assignment_counts(counts) == {'assigned': 5, 'ambiguous': 2, 'unassigned': 3}
+
+
+def test_load_whitelist_file(tmp_path):
+    path = tmp_path / "whitelist.txt"
+    path.write_text("# name barcode\nbc01 acgtac\nbc02,TTGACA  # second\n\nGGCCAA\n")
+    whitelist = BarcodeWhitelist.load(str(path), max_mismatches=0)
+    assert whitelist.barcodes == {"ACGTAC": "bc01", "TTGACA": "bc02", "GGCCAA": "GGCCAA"}
+    assert whitelist.barcode_length == 6
+
+
+@pytest.mark.parametrize("barcodes, max_mismatches", [
+    ([], 1), (["ACGT", "ACGTA"], 1), (["ACNT"], 1), (["ACGT"], -1),
+])
+def test_invalid_whitelists_are_rejected(barcodes, max_mismatches):
+    with pytest.raises(ValueError):
+        BarcodeWhitelist(barcodes, max_mismatches)
+
+
+def test_fingerprint_follows_barcodes_and_mismatches():
+    whitelist = BarcodeWhitelist(["ACGT", "TTTT"], 1)
+    assert whitelist.fingerprint() == BarcodeWhitelist(["TTTT", "ACGT"], 1).fingerprint()
+    assert whitelist.fingerprint() != BarcodeWhitelist(["ACGT", "TTTT"], 0).fingerprint()
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+from Bio import SeqIO
+from src.parsing import fastq_reader
+from src.parsing.fastq_reader import FastqRecord, PHRED_OFFSET
+from src.statistic.batch_metrics import RecordBatch, BatchMetrics, iter_batch_metrics, SUM_BLOCK
+
+
+def random_records(seed, count, max_length, alphabet=b'ACGTNacgtn'):
+    rng = np.random.default_rng(seed)
+    records = []
+    for i in range(count):
+        length = int(rng.integers(0, max_length + 1))
+        seq = bytes(rng.choice(list(alphabet), length).tolist())
+        qual = bytes((rng.integers(0, 94, length) + PHRED_OFFSET).tolist())
+        records.append(FastqRecord(b'read%d' % i, seq, qual))
+    return records
+
+
+def plain_metrics(record, barcode_length=6):
+    # One record at a time, the way FastqStat and filter_fastq measured reads
+    seq = record.seq
+    qualities = [q - PHRED_OFFSET for q in record.qual]
+    length = len(seq)
+    return {
+        'lengths': length,
+        'gc_count': seq.count(b'G') + seq.count(b'C'),
+        'gc_count_any': sum(seq.upper().count(base) for base in (b'G', b'C')),
+        'n_count': seq.upper().count(b'N'),
+        'quality_sum': sum(qualities),
+        'mean_quality': sum(qualities) / length if length else 0.0,
+        'gc_content': (seq.count(b'G') + seq.count(b'C')) / length * 100 if length else 0.0,
+        'barcodes': seq[:barcode_length].decode(),
+    }
+
+
+def check(records, barcode_length=6):
+    metrics = BatchMetrics(RecordBatch(records), barcode_length)
+    expected = [plain_metrics(record, barcode_length) for record in records]
+    for name in ('lengths', 'gc_count', 'gc_count_any', 'n_count', 'quality_sum'):
+        assert getattr(metrics, name).tolist() == [row[name] for row in expected], name
+    for name in ('mean_quality', 'gc_content'):
+        assert getattr(metrics, name) == pytest.approx([row[name] for row in expected]), name
+    assert metrics.barcodes == [row['barcodes'] for row in expected]
+
+
+@pytest.mark.parametrize("max_length", [3, SUM_BLOCK - 1, SUM_BLOCK, 5 * SUM_BLOCK + 7, 2000])
+def test_metrics_match_a_plain_loop(max_length):
+    check(random_records(max_length, 400, max_length))
+
+
+def test_empty_reads_and_empty_batches():
+    records = [FastqRecord(b'empty', b'', b'')] * 3 + random_records(1, 5, 100) + [FastqRecord(b'last', b'', b'')]
+    check(records)
+    check([FastqRecord(b'empty', b'', b'')])
+    metrics = BatchMetrics(RecordBatch([]))
+    assert metrics.lengths.tolist() == [] and metrics.barcodes == []
+
+
+def test_lowercase_bases():
+    records = [FastqRecord(b'lower', b'gcgcnnat', b'IIIIIIII'), FastqRecord(b'upper', b'GCGCNNAT', b'IIIIIIII')]
+    metrics = BatchMetrics(RecordBatch(records))
+    # gc_content counts upper-case G/C only, gc_content_any and n_count both cases
+    assert metrics.gc_count.tolist() == [0, 4]
+    assert metrics.gc_count_any.tolist() == [4, 4]
+    assert metrics.n_count.tolist() == [2, 2]
+    check(records)
+
+
+def test_per_record_sum_at_block_boundaries():
+    # Records that start and end exactly on, just before and just after the block boundaries
+    lengths = [SUM_BLOCK, SUM_BLOCK - 1, 1, 0, SUM_BLOCK + 1, 2 * SUM_BLOCK, 0, 3]
+    rng = np.random.default_rng(2)
+    records = [FastqRecord(b'r', b'A' * n, bytes((rng.integers(0, 94, n) + PHRED_OFFSET).tolist())) for n in lengths]
+    batch = RecordBatch(records)
+    sums = batch.per_record_sum(batch.qualities)
+    assert sums.tolist() == [sum(q - PHRED_OFFSET for q in record.qual) for record in records]
+    # High qualities fill the uint16 block sums up to their largest value
+    batch = RecordBatch([FastqRecord(b'r', b'A' * 1000, bytes([PHRED_OFFSET + 93]) * 1000)])
+    assert batch.per_record_sum(batch.qualities).tolist() == [93000]
+
+
+def test_seqrecords_give_the_same_metrics(synthetic_fastq):
+    records = list(fastq_reader.read_fastq(synthetic_fastq))
+    seq_records = list(SeqIO.parse(synthetic_fastq, "fastq"))
+    native = BatchMetrics(RecordBatch(records))
+    biopython = BatchMetrics(RecordBatch(seq_records))
+    for name in ('lengths', 'gc_count', 'gc_count_any', 'n_count', 'quality_sum'):
+        assert getattr(native, name).tolist() == getattr(biopython, name).tolist(), name
+    assert native.barcodes == biopython.barcodes
+
+
+def test_batching_does_not_change_the_metrics(synthetic_fastq):
+    records = list(fastq_reader.read_fastq(synthetic_fastq))
+    whole = BatchMetrics(RecordBatch(records))
+    parts = list(iter_batch_metrics(iter(records), batch_size=97, max_bases=20000))
+    assert len(parts) > len(records) // 97
+    assert np.concatenate([metrics.quality_sum for _, metrics in parts]).tolist() == whole.quality_sum.tolist()
+    assert sum((metrics.barcodes for _, metrics in parts), []) == whole.barcodes
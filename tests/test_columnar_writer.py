@@ -0,0 +1,109 @@
+import csv
+import logging
+import os
+import numpy as np
+import pytest
+from src.pipeline.fused import FusedPipeline
+from src.statistic import columnar_writer
+from src.statistic.columnar_writer import (
+    NpyMetricsWriter, iter_npy_metrics, load_npy_metrics, resolve_format, metrics_path, open_metrics_writer,
+    METRICS_COLUMNS, PARQUET, NPY,
+)
+
+
+def run(input_file, output_dir, metrics_format=None, threads=1):
+    """Run the pipeline writing the metrics as CSV (metrics_format None) or as columns."""
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {name: metrics_path(output_dir, name, metrics_format or "csv")
+             for name in ("original_statistics", "filtered_statistics")}
+    columns = metrics_format is not None
+    FusedPipeline(
+        input_file, os.path.join(output_dir, "filtered.fastq"), threads=threads, chunk_size=64 * 1024,
+        original_csv=None if columns else paths["original_statistics"],
+        filtered_csv=None if columns else paths["filtered_statistics"],
+        original_columns=paths["original_statistics"] if columns else None,
+        filtered_columns=paths["filtered_statistics"] if columns else None,
+        columns_format=metrics_format,
+    ).run()
+    return paths
+
+
+def csv_rows(path):
+    # The CSV writes None as an empty field
+    with open(path, newline='') as handle:
+        rows = list(csv.reader(handle))[1:]
+    return [(sequence_id, int(length), float(gc), float(quality), barcode or None, group or None)
+            for sequence_id, length, gc, quality, barcode, group in rows]
+
+
+def npy_rows(path, chunk_size=columnar_writer.READ_CHUNK):
+    rows = []
+    for columns in iter_npy_metrics(path, chunk_size):
+        rows.extend(zip(*(columns[name].tolist() if isinstance(columns[name], np.ndarray) else columns[name]
+                          for name in METRICS_COLUMNS)))
+    return rows
+
+
+@pytest.fixture
+def csv_outputs(synthetic_fastq, tmp_path):
+    return {name: csv_rows(path) for name, path in run(synthetic_fastq, str(tmp_path / "csv")).items()}
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+def test_npy_columns_equal_the_csv(synthetic_fastq, tmp_path, csv_outputs, threads):
+    paths = run(synthetic_fastq, str(tmp_path / "npy"), NPY, threads)
+    for name, path in paths.items():
+        assert os.path.isdir(path)
+        assert npy_rows(path) == csv_outputs[name]
+        # Chunks that split the sequence IDs at other rows give the same rows
+        assert npy_rows(path, chunk_size=333) == csv_outputs[name]
+
+
+def test_npy_columns_are_memory_mapped_with_their_shape(synthetic_fastq, tmp_path, csv_outputs):
+    path = run(synthetic_fastq, str(tmp_path / "npy"), NPY)["original_statistics"]
+    columns, categories = load_npy_metrics(path)
+    rows = len(csv_outputs["original_statistics"])
+    assert isinstance(columns["length"], np.memmap)
+    assert columns["length"].shape == (rows,)
+    assert columns["sequence_id_offsets"].shape == (rows + 1,)
+    assert columns["sequence_id_offsets"][-1] == columns["sequence_id"].size
+    assert set(categories["barcode"]) == {row[4] for row in csv_outputs["original_statistics"]} - {None}
+
+
+def test_append_file_and_empty_columns(tmp_path):
+    columns = {
+        "sequence_id": ["read1", "réad2"], "length": np.array([10, 20]), "gc_content": np.array([50.0, 12.5]),
+        "mean_quality_score": np.array([30.0, 7.25]), "barcode": ["ACGTAC", None], "barcode_group": [None, "barcode01"],
+    }
+    empty = str(tmp_path / "empty")
+    NpyMetricsWriter(empty).close()
+    assert npy_rows(empty) == []
+    part = str(tmp_path / "part")
+    with NpyMetricsWriter(part) as writer:
+        writer.write_columns(columns)
+    merged = str(tmp_path / "merged")
+    with open_metrics_writer(merged, NPY) as writer:
+        for path in (part, empty, part):
+            writer.append_file(path)
+    expected = list(zip(*(columns[name].tolist() if isinstance(columns[name], np.ndarray) else columns[name]
+                          for name in METRICS_COLUMNS)))
+    assert npy_rows(merged) == expected * 2
+
+
+def test_parquet_falls_back_to_npy_without_pyarrow(synthetic_fastq, tmp_path, csv_outputs, monkeypatch, caplog):
+    monkeypatch.setattr(columnar_writer, "has_pyarrow", lambda: False)
+    with caplog.at_level(logging.WARNING):
+        metrics_format = resolve_format(PARQUET)
+    assert metrics_format == NPY
+    assert "pyarrow is not installed" in caplog.text
+    paths = run(synthetic_fastq, str(tmp_path / "fallback"), metrics_format)
+    assert paths["original_statistics"].endswith("original_statistics_columns")
+    assert npy_rows(paths["original_statistics"]) == csv_outputs["original_statistics"]
+
+
+def test_parquet_columns_equal_the_csv(synthetic_fastq, tmp_path, csv_outputs):
+    pq = pytest.importorskip("pyarrow.parquet")
+    paths = run(synthetic_fastq, str(tmp_path / "parquet"), resolve_format(PARQUET), threads=2)
+    for name, path in paths.items():
+        table = pq.read_table(path).to_pydict()
+        assert list(zip(*(table[column] for column in METRICS_COLUMNS))) == csv_outputs[name]
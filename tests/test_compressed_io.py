@@ -0,0 +1,99 @@
+import gzip
+import io
+import pytest
+from src.parsing import bgzf, compressed_io, fastq_reader
+from src.parsing.compressed_io import ParallelCompressWriter, ReadAheadReader, ParallelBgzfReader, GZIP, BGZF
+from src.parsing.fastq_index import build_index
+
+
+@pytest.fixture
+def data(synthetic_fastq):
+    with open(synthetic_fastq, 'rb') as handle:
+        return handle.read()
+
+
+def write_compressed(path, data, compression, task_size=compressed_io.COMPRESS_TASK_SIZE, threads=3):
+    with io.BufferedWriter(ParallelCompressWriter(path, compression, threads, task_size=task_size)) as handle:
+        # Writes of uneven sizes, as the pipeline makes them
+        position = 0
+        for size in (1, 100, 7000, 250000):
+            handle.write(data[position:position + size])
+            position += size
+        handle.write(data[position:])
+
+
+@pytest.mark.parametrize("compression", [GZIP, BGZF])
+@pytest.mark.parametrize("task_size", [10000, compressed_io.COMPRESS_TASK_SIZE])
+def test_parallel_compressed_output_inflates_to_the_input(tmp_path, data, compression, task_size):
+    path = str(tmp_path / "out.fastq.gz")
+    write_compressed(path, data, compression, task_size)
+    with gzip.open(path, 'rb') as handle:
+        assert handle.read() == data
+    assert bgzf.is_bgzf(path) == (compression == BGZF)
+
+
+def test_bgzf_output_is_made_of_full_blocks(tmp_path, data):
+    path = str(tmp_path / "out.fastq.gz")
+    write_compressed(path, data, BGZF, task_size=100000)
+    with open(path, 'rb') as handle:
+        assert handle.read()[-len(bgzf.EOF_BLOCK):] == bgzf.EOF_BLOCK
+        handle.seek(0)
+        blocks = [block for _, block in bgzf.iter_blocks(handle)]
+    assert b''.join(blocks) == data
+    assert max(len(block) for block in blocks) == bgzf.MAX_BLOCK_DATA
+
+
+def test_bgzf_virtual_offsets_are_record_starts(tmp_path, data, synthetic_fastq):
+    path = str(tmp_path / "out.fastq.gz")
+    write_compressed(path, data, BGZF)
+    records = list(fastq_reader.read_fastq(synthetic_fastq))
+    with build_index(path) as index, bgzf.BgzfReader(path) as reader:
+        assert len(index) == len(records)
+        # Records spanning two blocks are read across the boundary
+        for number, (offset, record) in enumerate(zip(index.offsets.tolist(), records)):
+            reader.seek(offset)
+            assert reader.tell() == offset
+            assert reader.readline() == b'@' + record.title + b'\n', number
+        start, end = index.record_range(0, len(index))
+        reader.seek(start)
+        assert reader.read_until(end) == data
+
+
+@pytest.mark.parametrize("compression", [GZIP, BGZF, "gzip_members"])
+def test_threaded_input_reads_the_same_bytes_as_gzip(tmp_path, data, compression):
+    path = str(tmp_path / "in.fastq.gz")
+    if compression == "gzip_members":
+        write_compressed(path, data, GZIP, task_size=10000)
+    elif compression == BGZF:
+        write_compressed(path, data, BGZF)
+    else:
+        with gzip.open(path, 'wb') as handle:
+            handle.write(data)
+    with gzip.open(path, 'rb') as handle:
+        expected = handle.read()
+    with compressed_io.open_input(path, threads=3) as handle:
+        assert isinstance(handle.raw, ParallelBgzfReader if compression == BGZF else ReadAheadReader)
+        assert handle.read() == expected == data
+    # Small reads and readline go through the same chunks
+    with compressed_io.open_input(path) as handle:
+        lines = list(iter(handle.readline, b''))
+    assert b''.join(lines) == data
+
+
+def test_read_ahead_reader_raises_the_error_of_its_thread(tmp_path, data):
+    path = str(tmp_path / "truncated.fastq.gz")
+    with open(path, 'wb') as handle:
+        handle.write(gzip.compress(data)[:-1000])
+    with compressed_io.open_input(path) as handle:
+        with pytest.raises(EOFError):
+            handle.read()
+
+
+def test_read_ahead_reader_closes_before_the_end(tmp_path, data):
+    path = str(tmp_path / "in.fastq.gz")
+    with gzip.open(path, 'wb', compresslevel=1) as handle:
+        handle.write(data * 4)
+    reader = ReadAheadReader(gzip.open(path, 'rb'), chunk_size=1024, depth=2)
+    assert reader.read(10) == data[:10]
+    reader.close()
+    assert not reader.thread.is_alive()
@@ -0,0 +1,67 @@
+import gzip
+from collections import defaultdict
+import pytest
+from src.parsing import fastq_reader
+from src.parsing.demux import BarcodeDemultiplexer, HandlePool, group_fastq_bytes, record_group, UNCLASSIFIED
+
+
+def expected_groups(path):
+    groups = defaultdict(list)
+    for record in fastq_reader.read_fastq(path):
+        groups[record_group(record)].append(record.to_bytes())
+    return groups
+
+
+def read_bytes(path, compress):
+    with (gzip.open(path, 'rb') if compress else open(path, 'rb')) as handle:
+        return handle.read()
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_every_group_gets_its_records_in_order(synthetic_fastq, tmp_path, compress):
+    expected = expected_groups(synthetic_fastq)
+    assert UNCLASSIFIED in expected and len(expected) > 3
+    # Tiny buffers and two open files force flushes and reopening evicted files
+    with BarcodeDemultiplexer(str(tmp_path / "demux"), compress, max_open_files=2,
+                              group_buffer_size=1024, max_buffered=4096) as demux:
+        for batch in fastq_reader.iter_record_chunks(synthetic_fastq, 16 * 1024):
+            demux.add_records(fastq_reader.parse_chunk(batch))
+    assert dict(demux.counts) == {group: len(records) for group, records in expected.items()}
+    for group, records in expected.items():
+        assert read_bytes(demux.group_path(group), compress) == b''.join(records)
+
+
+def test_count_only_mode_writes_nothing(synthetic_fastq, tmp_path):
+    demux = BarcodeDemultiplexer()
+    demux.add_records(fastq_reader.read_fastq(synthetic_fastq))
+    demux.close()
+    assert dict(demux.counts) == {group: len(records) for group, records in expected_groups(synthetic_fastq).items()}
+    assert list(tmp_path.iterdir()) == [tmp_path / "reads.fastq"]
+
+
+def test_worker_groups_are_written_like_records(synthetic_fastq, tmp_path):
+    records = list(fastq_reader.read_fastq(synthetic_fastq))
+    with BarcodeDemultiplexer(str(tmp_path / "direct")) as direct, \
+            BarcodeDemultiplexer(str(tmp_path / "grouped")) as grouped:
+        direct.add_records(records)
+        for group, (data, count) in group_fastq_bytes(records).items():
+            grouped.write(group, data, count)
+    assert direct.counts == grouped.counts
+    for group in direct.counts:
+        assert read_bytes(direct.group_path(group), False) == read_bytes(grouped.group_path(group), False)
+
+
+def test_unsafe_group_names_stay_in_the_output_directory(tmp_path):
+    demux = BarcodeDemultiplexer(str(tmp_path))
+    assert demux.group_path("../bar code/1") == str(tmp_path / ".._bar_code_1.fastq")
+
+
+def test_handle_pool_appends_after_eviction(tmp_path):
+    pool = HandlePool(max_open=1)
+    first, second = str(tmp_path / "first"), str(tmp_path / "second")
+    pool.get(first).write(b"a")
+    pool.get(second).write(b"b")
+    pool.get(first).write(b"c")
+    pool.close()
+    assert (tmp_path / "first").read_bytes() == b"ac"
+    assert (tmp_path / "second").read_bytes() == b"b"
@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+from src.parsing.fastq_reader import FastqRecord
+from src.statistic.batch_metrics import RecordBatch
+from src.filter.duplicates import (
+    DuplicateDetector, FingerprintSet, BloomFilter, sequence_fingerprints, EXACT, BLOOM, HASH_BLOCK,
+)
+
+
+def make_batch(sequences):
+    return RecordBatch([FastqRecord(b'read%d' % number, seq, b'I' * len(seq)) for number, seq in enumerate(sequences)])
+
+
+def random_sequences(count, seed, min_length=1, max_length=60):
+    rng = np.random.default_rng(seed)
+    return [bytes(rng.choice(list(b'ACGT'), rng.integers(min_length, max_length))) for _ in range(count)]
+
+
+def test_fingerprints_depend_only_on_the_sequence():
+    sequences = [b'ACGT', b'TGCA', b'ACGT', b'ACGTA', b'', b'ACG']
+    fingerprints = sequence_fingerprints(make_batch(sequences))
+    assert fingerprints[0] == fingerprints[2]
+    assert len(set(fingerprints.tolist())) == 5
+    assert (fingerprints != 0).all()
+    # The same read in another batch, at another position
+    assert sequence_fingerprints(make_batch([b'TTTT', b'ACGT']))[1] == fingerprints[0]
+
+
+def test_fingerprints_across_hash_blocks():
+    # Reads spanning the HASH_BLOCK boundaries hash the same as on their own
+    long_read = bytes(np.random.default_rng(0).choice(list(b'ACGT'), HASH_BLOCK + 1000))
+    batch = make_batch([b'A' * (HASH_BLOCK - 10), long_read, b'CCGG'])
+    fingerprints = sequence_fingerprints(batch)
+    assert fingerprints[1] == sequence_fingerprints(make_batch([long_read]))[0]
+    assert fingerprints[2] == sequence_fingerprints(make_batch([b'CCGG']))[0]
+
+
+def test_prefix_fingerprints_use_the_barcode():
+    batch = make_batch([b'ACGTAAAA', b'ACGTCCCC', b'ACGTGGGG'])
+    fingerprints = sequence_fingerprints(batch, prefix_length=4, barcodes=['bc1', 'bc1', 'bc2'])
+    assert fingerprints[0] == fingerprints[1] != fingerprints[2]
+
+
+def test_fingerprint_set_matches_python_set():
+    rng = np.random.default_rng(1)
+    keys = rng.integers(1, 5000, 20000, dtype=np.uint64)
+    fingerprints = FingerprintSet(capacity=16)
+    seen = set()
+    for start in range(0, len(keys), 1000):
+        chunk = np.unique(keys[start:start + 1000])
+        expected = [key in seen for key in chunk.tolist()]
+        assert fingerprints.add_many(chunk).tolist() == expected
+        seen.update(chunk.tolist())
+    assert len(fingerprints) == len(seen)
+
+
+def test_bloom_filter_has_no_false_negatives():
+    keys = np.arange(1, 20001, dtype=np.uint64) * np.uint64(2654435761)
+    bloom = BloomFilter.for_false_positive_rate(len(keys), 0.01)
+    bloom.add_many(keys[:10000])
+    assert bloom.add_many(keys[:10000]).all()
+    new = bloom.add_many(keys[10000:])
+    # A few new keys may be taken for duplicates, at about the planned rate
+    assert new.mean() < 0.05
+
+
+@pytest.mark.parametrize("method", [EXACT, BLOOM])
+def test_detector_keeps_the_first_copy(method):
+    sequences = random_sequences(3000, 2)
+    copies = [sequences[number] for number in np.random.default_rng(3).integers(0, 3000, 500).tolist()]
+    rng = np.random.default_rng(4)
+    all_sequences = sequences + copies
+    order = rng.permutation(len(all_sequences))
+    shuffled = [all_sequences[number] for number in order.tolist()]
+    detector = DuplicateDetector(method, expected_reads=len(shuffled), fp_rate=1e-6)
+    marked = []
+    for start in range(0, len(shuffled), 700):
+        batch = make_batch(shuffled[start:start + 700])
+        marked.extend(detector.mark(batch, [None] * len(batch), np.ones(len(batch), dtype=bool)).tolist())
+    seen = set()
+    expected = []
+    for sequence in shuffled:
+        expected.append(sequence in seen)
+        seen.add(sequence)
+    assert marked == expected
+    summary = detector.summary()
+    assert summary['reads_checked'] == len(shuffled)
+    assert summary['duplicates'] == sum(expected)
+
+
+def test_only_candidates_are_checked():
+    detector = DuplicateDetector()
+    batch = make_batch([b'ACGT', b'ACGT', b'ACGT', b'TTTT'])
+    candidates = np.array([False, True, True, True])
+    assert detector.mark(batch, ['bc1', 'bc1', 'bc2', None], candidates).tolist() == [False, False, True, False]
+    summary = detector.summary()
+    assert summary['per_barcode']['bc2']['duplicates'] == 1
+    assert summary['per_barcode']['unclassified']['reads'] == 1
+
+
+def test_hash_set_turns_into_bloom_filter_over_budget():
+    detector = DuplicateDetector(EXACT, memory_bytes=4096, expected_reads=2000)
+    batch = make_batch(random_sequences(2000, 5, min_length=20))
+    detector.mark(batch, [None] * len(batch), np.ones(len(batch), dtype=bool))
+    assert detector.method == BLOOM
+    assert detector.summary()['memory_bytes'] <= 4096
+    # Reads added before the switch are still known
+    again = detector.mark(batch, [None] * len(batch), np.ones(len(batch), dtype=bool))
+    assert again.all()
@@ -0,0 +1,76 @@
+import gzip
+import os
+import pytest
+from src.parsing import bgzf, fastq_reader
+from src.parsing.fastq_index import (
+    FastqIndex, build_index, iter_work_chunks, load_chunk, index_path_for, BGZF, PLAIN,
+)
+
+
+def write_bgzf(source, path):
+    with open(source, 'rb') as handle:
+        data = handle.read()
+    with open(path, 'wb') as handle:
+        # Small blocks, so records span block boundaries
+        handle.write(b''.join(bgzf.deflate_block(data[start:start + 4096]) for start in range(0, len(data), 4096)))
+        handle.write(bgzf.EOF_BLOCK)
+    return path
+
+
+def test_virtual_offset_round_trip():
+    virtual = bgzf.make_virtual_offset(123456789, 65000)
+    assert bgzf.split_virtual_offset(virtual) == (123456789, 65000)
+
+
+@pytest.mark.parametrize("compression", [PLAIN, BGZF])
+def test_index_gives_every_record(synthetic_fastq, compression):
+    path = synthetic_fastq if compression == PLAIN else write_bgzf(synthetic_fastq, synthetic_fastq + ".gz")
+    records = list(fastq_reader.read_fastq(synthetic_fastq))
+    with build_index(path) as index:
+        assert index.compression == compression
+        assert len(index) == len(records)
+        assert index.lengths.tolist() == [len(record.seq) for record in records]
+        for number in (0, 1, len(records) // 2, len(records) - 1, -1):
+            assert index.get_record(number).to_bytes() == records[number].to_bytes()
+
+
+@pytest.mark.parametrize("compression", [PLAIN, BGZF])
+def test_chunk_ranges_cover_the_file_in_order(synthetic_fastq, compression):
+    path = synthetic_fastq if compression == PLAIN else write_bgzf(synthetic_fastq, synthetic_fastq + ".gz")
+    with open(synthetic_fastq, 'rb') as handle:
+        data = handle.read()
+    with build_index(path) as index:
+        chunks = index.chunk_ranges(64 * 1024)
+        assert len(chunks) > 1
+        assert b''.join(load_chunk(chunk) for chunk in chunks) == data
+        assert sum(len(fastq_reader.parse_chunk(load_chunk(chunk))) for chunk in chunks) == len(index)
+
+
+def test_changed_file_makes_the_index_stale(synthetic_fastq):
+    build_index(synthetic_fastq).close()
+    assert FastqIndex.load_current(synthetic_fastq) is not None
+    with open(synthetic_fastq, 'ab') as handle:
+        handle.write(b"@extra\nACGT\n+\nIIII\n")
+    assert FastqIndex.load_current(synthetic_fastq) is None
+    with FastqIndex.load_or_build(synthetic_fastq) as index:
+        assert index.get_record(-1).id == "extra"
+
+
+def test_gzip_input_is_not_indexed(synthetic_fastq):
+    path = synthetic_fastq + ".gz"
+    with open(synthetic_fastq, 'rb') as source, gzip.open(path, 'wb') as handle:
+        data = source.read()
+        handle.write(data)
+    chunks = list(iter_work_chunks(path, 64 * 1024, use_index=True))
+    assert b''.join(chunks) == data
+    assert not os.path.exists(index_path_for(path))
+
+
+def test_index_summary(synthetic_fastq):
+    records = list(fastq_reader.read_fastq(synthetic_fastq))
+    lengths = [len(record.seq) for record in records]
+    with build_index(synthetic_fastq) as index:
+        summary = index.summary()
+    assert summary['reads'] == len(records)
+    assert summary['bases'] == sum(lengths)
+    assert (summary['min_length'], summary['max_length']) == (min(lengths), max(lengths))
@@ -0,0 +1,68 @@
+import gzip
+import pytest
+from src.parsing.fastq_reader import read_fastq, compare_with_seqio, parse_chunk, NATIVE, SEQIO
+
+FOUR_LINE = b"@read1 first\nACGTNacgt\n+\nIIIII#!!~\n@read2\nGGCC\n+read2\n@@II\n"
+# Sequence and quality wrapped over several lines; the quality lines start with '@' and '+'
+WRAPPED = b"@read1\nACGT\nACGT\nAC\n+\n@@@@\n+III\nII\n@read2 second\nGG\nCC\n+read2 second\n@I\nII\n"
+CRLF = FOUR_LINE.replace(b"\n", b"\r\n")
+BLANK_LINES = FOUR_LINE.replace(b"\n@read2", b"\n\n@read2") + b"\n\n"
+EMPTY_READ = b"@empty\n\n+\n\n@read2\nACGT\n+\nIIII\n"
+
+
+def write(path, data, compress=False):
+    if compress:
+        path = path.with_suffix('.fastq.gz')
+        with gzip.open(path, 'wb') as handle:
+            handle.write(data)
+    else:
+        path.write_bytes(data)
+    return str(path)
+
+
+@pytest.mark.parametrize("data, count", [
+    (FOUR_LINE, 2), (WRAPPED, 2), (CRLF, 2), (BLANK_LINES, 2), (EMPTY_READ, 2), (b"", 0),
+])
+@pytest.mark.parametrize("compress", [False, True])
+def test_native_reader_matches_seqio(tmp_path, data, count, compress):
+    assert compare_with_seqio(write(tmp_path / "reads.fastq", data, compress)) == count
+
+
+def test_wrapped_record_fields(tmp_path):
+    records = list(read_fastq(write(tmp_path / "reads.fastq", WRAPPED)))
+    assert [record.seq for record in records] == [b"ACGTACGTAC", b"GGCC"]
+    assert [record.qual for record in records] == [b"@@@@+IIIII", b"@III"]
+    assert records[1].description == "read2 second"
+
+
+@pytest.mark.parametrize("data", [
+    b"read1\nACGT\n+\nIIII\n",          # no '@'
+    b"\n@read1\nACGT\n+\nIIII\n",        # blank first line
+    b"@read1\nACGT\n+\nIII\n",          # short quality
+    b"@read1\nACGT\n+read2\nIIII\n",    # different second title
+    b"@read1\nACGT\n",                  # truncated
+])
+def test_invalid_input_fails_like_seqio(tmp_path, data):
+    path = write(tmp_path / "reads.fastq", data)
+    for reader in (NATIVE, SEQIO):
+        with pytest.raises(ValueError):
+            list(read_fastq(path, reader))
+
+
+def test_compare_with_seqio_reports_difference(tmp_path, monkeypatch):
+    path = write(tmp_path / "reads.fastq", FOUR_LINE)
+    real_read_fastq = read_fastq
+
+    def one_record_less(file_path, reader=NATIVE, *args):
+        records = list(real_read_fastq(file_path, reader, *args))
+        return iter(records[:-1] if reader == NATIVE else records)
+
+    monkeypatch.setattr("src.parsing.fastq_reader.read_fastq", one_record_less)
+    with pytest.raises(ValueError, match="record counts differ"):
+        compare_with_seqio(path)
+
+
+def test_parse_chunk_rejects_wrapped_records():
+    assert len(parse_chunk(FOUR_LINE)) == 2
+    with pytest.raises(ValueError):
+        parse_chunk(WRAPPED)
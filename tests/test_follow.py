@@ -0,0 +1,131 @@
+import logging
+import os
+import pytest
+from src.pipeline.fused import FusedPipeline
+from src.pipeline.follow import FollowRunner, CHECKPOINT_FILE
+
+
+def make_pipeline(input_file, output_dir, quality_threshold=20):
+    return FusedPipeline(
+        input_file, os.path.join(output_dir, "filtered.fastq"), quality_threshold=quality_threshold,
+        original_csv=os.path.join(output_dir, "original_statistics.csv"),
+        filtered_csv=os.path.join(output_dir, "filtered_statistics.csv"),
+    )
+
+
+def follow(input_file, output_dir, **kwargs):
+    """Run follow mode until the input does not grow; returns (total, passed)."""
+    pipeline = make_pipeline(input_file, output_dir, **kwargs)
+    runner = FollowRunner(pipeline, os.path.join(output_dir, CHECKPOINT_FILE), poll_interval=0, idle_timeout=0)
+    return runner.run()
+
+
+def outputs(output_dir):
+    return {name: open(os.path.join(output_dir, name), 'rb').read()
+            for name in ("filtered.fastq", "original_statistics.csv", "filtered_statistics.csv")}
+
+
+@pytest.fixture
+def baseline(synthetic_fastq, tmp_path):
+    output_dir = tmp_path / "baseline"
+    output_dir.mkdir()
+    result = make_pipeline(synthetic_fastq, str(output_dir)).run()
+    with open(synthetic_fastq, 'rb') as handle:
+        data = handle.read()
+    return data, result, outputs(str(output_dir))
+
+
+@pytest.fixture
+def growing(tmp_path):
+    output_dir = tmp_path / "follow"
+    output_dir.mkdir()
+    return str(tmp_path / "growing.fastq"), str(output_dir)
+
+
+def append(path, data):
+    with open(path, 'ab') as handle:
+        handle.write(data)
+
+
+def test_appends_in_steps_with_a_split_record(baseline, growing):
+    data, result, expected = baseline
+    path, output_dir = growing
+    pipeline = make_pipeline(path, output_dir)
+    append(path, b'')
+    runner = FollowRunner(pipeline, os.path.join(output_dir, CHECKPOINT_FILE))
+    pipeline.setup_filter()
+    runner.open_outputs(None)
+    # The cuts fall inside records, so every poll leaves a partial record for the next one
+    cuts = [0, 1001, len(data) // 3 + 7, len(data) // 2 + 3, len(data)]
+    for start, end in zip(cuts, cuts[1:]):
+        append(path, data[start:end])
+        runner.process_new_data()
+    runner.out_handle.close()
+    pipeline.original_writer.close()
+    pipeline.filtered_writer.close()
+    assert (pipeline.total, pipeline.passed) == result
+    assert outputs(output_dir) == expected
+
+
+def test_resumes_from_the_checkpoint(baseline, growing):
+    data, result, expected = baseline
+    path, output_dir = growing
+    half = len(data) // 2 + 5
+    append(path, data[:half])
+    first = follow(path, output_dir)
+    assert 0 < first[0] < result[0]
+    append(path, data[half:])
+    assert follow(path, output_dir) == result
+    assert outputs(output_dir) == expected
+
+
+def test_checkpoint_of_other_settings_is_rejected(baseline, growing):
+    data, _, _ = baseline
+    path, output_dir = growing
+    append(path, data[:len(data) // 2])
+    follow(path, output_dir)
+    with pytest.raises(ValueError, match="other settings"):
+        follow(path, output_dir, quality_threshold=10)
+
+
+def test_truncated_input_is_an_error(baseline, growing):
+    data, _, _ = baseline
+    path, output_dir = growing
+    append(path, data)
+    follow(path, output_dir)
+    with open(path, 'wb') as handle:
+        handle.write(data[:len(data) // 2])
+    pipeline = make_pipeline(path, output_dir)
+    runner = FollowRunner(pipeline, os.path.join(output_dir, "other_checkpoint.json"))
+    pipeline.setup_filter()
+    runner.open_outputs(None)
+    runner.offset = len(data)
+    with pytest.raises(ValueError, match="shorter than the followed offset"):
+        runner.process_new_data()
+    runner.out_handle.close()
+
+
+def test_last_record_without_newline(baseline, growing):
+    data, result, expected = baseline
+    path, output_dir = growing
+    append(path, data[:-1])
+    assert follow(path, output_dir) == result
+    assert outputs(output_dir) == expected
+    # The newline written later is skipped, and the next records are read as usual
+    extra = b"@extra\n" + b"G" * 100 + b"\n+\n" + b"I" * 100 + b"\n"
+    append(path, b"\n" + extra)
+    total, _ = follow(path, output_dir)
+    assert total == result[0] + 1
+
+
+def test_partial_last_record_is_reported(baseline, growing, caplog):
+    data, result, _ = baseline
+    path, output_dir = growing
+    # Cut inside the quality line of the last record
+    append(path, data[:-10])
+    with caplog.at_level(logging.WARNING):
+        total, _ = follow(path, output_dir)
+    assert total == result[0] - 1
+    assert "not a complete record" in caplog.text
+    append(path, data[-10:])
+    assert follow(path, output_dir) == result
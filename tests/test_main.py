@@ -0,0 +1,21 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_help_does_not_import_numpy():
+    code = (
+        "import sys\n"
+        "sys.argv = ['main.py', '--help']\n"
+        "import main\n"
+        "try:\n"
+        "    main.parse_arguments()\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        "print('numpy' in sys.modules)\n"
+    )
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+    assert "--output_dir" in result.stdout
+    assert result.stdout.splitlines()[-1] == "False"
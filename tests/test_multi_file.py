@@ -0,0 +1,86 @@
+import csv
+import os
+import pytest
+from src.pipeline.fused import FusedPipeline
+from src.pipeline.multi_file import MultiFileRunner, expand_inputs, is_multi_input, SUMMARY_COLUMNS
+
+OUTPUTS = ("filtered.fastq", "original_statistics.csv", "filtered_statistics.csv")
+
+
+def make_pipeline(input_file, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    return FusedPipeline(
+        input_file, os.path.join(output_dir, "filtered.fastq"),
+        original_csv=os.path.join(output_dir, "original_statistics.csv"),
+        filtered_csv=os.path.join(output_dir, "filtered_statistics.csv"),
+    )
+
+
+def outputs(output_dir):
+    return {name: open(os.path.join(output_dir, name), 'rb').read() for name in OUTPUTS}
+
+
+@pytest.fixture
+def run_dir(synthetic_fastq, tmp_path):
+    # Files of different sizes whose names do not sort by size, so the largest-first
+    # processing order differs from the input order
+    with open(synthetic_fastq, 'rb') as handle:
+        lines = handle.readlines()
+    records = [b''.join(lines[start:start + 4]) for start in range(0, len(lines), 4)]
+    directory = tmp_path / "run"
+    directory.mkdir()
+    (directory / "notes.txt").write_text("not a FASTQ file")
+    cuts = [0, 300, 1800, 2100, len(records)]
+    names = ["a.fastq", "b.fastq", "c.fq", "d.fastq"]
+    for name, start, end in zip(names, cuts, cuts[1:]):
+        (directory / name).write_bytes(b''.join(records[start:end]))
+    return str(directory), [str(directory / name) for name in names], [end - start for start, end in zip(cuts, cuts[1:])]
+
+
+def test_expand_inputs(run_dir):
+    directory, files, _ = run_dir
+    assert is_multi_input(directory)
+    assert expand_inputs(directory) == files
+    assert expand_inputs(os.path.join(directory, "*.fastq")) == [files[0], files[1], files[3]]
+    assert expand_inputs(files[0]) == [files[0]]
+    with pytest.raises(FileNotFoundError):
+        expand_inputs(os.path.join(directory, "*.bam"))
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_outputs_are_in_input_order_and_equal_one_pass(synthetic_fastq, run_dir, tmp_path, processes):
+    directory, files, _ = run_dir
+    single = make_pipeline(synthetic_fastq, str(tmp_path / "single"))
+    expected = single.run()
+
+    output_dir = str(tmp_path / f"multi{processes}")
+    template = make_pipeline(None, output_dir)
+    runner = MultiFileRunner(template, expand_inputs(directory), processes, os.path.join(output_dir, "parts"))
+    assert runner.run() == expected
+    assert outputs(output_dir) == outputs(str(tmp_path / "single"))
+    assert template.original_stats.summary() == pytest.approx(single.original_stats.summary())
+    assert template.filtered_stats.summary() == pytest.approx(single.filtered_stats.summary())
+    assert dict(template.report.rejections) == dict(single.report.rejections)
+    assert template.report.counters['files'] == len(files)
+    assert not os.path.exists(os.path.join(output_dir, "parts"))
+
+
+def test_per_file_summary(run_dir, tmp_path):
+    directory, files, counts = run_dir
+    output_dir = str(tmp_path / "multi")
+    summary_path = os.path.join(output_dir, "per_file_summary.csv")
+    MultiFileRunner(make_pipeline(None, output_dir), files, 2, summary_path=summary_path).run()
+    with open(summary_path, newline='') as handle:
+        rows = list(csv.DictReader(handle))
+    assert tuple(rows[0]) == SUMMARY_COLUMNS
+    assert [row['file'] for row in rows] == files
+    for row, path, count in zip(rows, files, counts):
+        pipeline = make_pipeline(path, str(tmp_path / os.path.basename(path)))
+        total, passed = pipeline.run()
+        summary = pipeline.original_stats.summary()
+        assert int(row['reads']) == total == count
+        assert (int(row['passed']), int(row['failed'])) == (passed, total - passed)
+        assert float(row['passed_percent']) == pytest.approx(passed / total * 100, abs=0.005)
+        assert int(row['bases']) == summary['bases']
+        assert float(row['mean_length']) == pytest.approx(summary['mean_length'], abs=0.005)
+        assert int(row['barcodes']) == summary['barcodes']
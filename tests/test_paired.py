@@ -0,0 +1,82 @@
+import pytest
+from src.parsing import fastq_reader
+from src.filter.paired import filter_paired_fastq, iter_pair_batches, pair_id, PairMismatchError, BOTH, EITHER
+from src.filter.predicates import FilterEngine, build_predicates
+from src.pipeline.instrumentation import RunReport
+from src.statistic.batch_metrics import RecordBatch, BatchMetrics
+
+
+def write_mates(tmp_path, records, suffix, rename=None):
+    path = tmp_path / f"reads_{suffix}.fastq"
+    with open(path, 'wb') as handle:
+        for record in records:
+            title = rename(record.title) if rename else record.title
+            handle.write(fastq_reader.FastqRecord(title, record.seq, record.qual).to_bytes())
+    return str(path)
+
+
+@pytest.fixture
+def mates(synthetic_fastq, tmp_path):
+    # R2 holds the same read IDs with the reads of the file shifted, so the mates pass independently
+    records = list(fastq_reader.read_fastq(synthetic_fastq))
+    shifted = records[1:] + records[:1]
+    r2 = [fastq_reader.FastqRecord(record.title, mate.seq, mate.qual) for record, mate in zip(records, shifted)]
+    r1_path = write_mates(tmp_path, records, "R1", lambda title: title.split(b' ', 1)[0] + b'/1')
+    r2_path = write_mates(tmp_path, r2, "R2", lambda title: title.split(b' ', 1)[0] + b'/2')
+    return r1_path, r2_path
+
+
+def passing(path):
+    batch = RecordBatch(list(fastq_reader.read_fastq(path)))
+    mask, _ = FilterEngine(build_predicates(20, 50, 30, 60)).apply(BatchMetrics(batch, 0), batch)
+    return mask
+
+
+@pytest.mark.parametrize("policy", [BOTH, EITHER])
+def test_pairs_stay_in_sync(mates, tmp_path, policy):
+    out_r1, out_r2 = str(tmp_path / "out_R1.fastq"), str(tmp_path / "out_R2.fastq")
+    report = RunReport()
+    total, passed = filter_paired_fastq(*mates, out_r1, out_r2, policy=policy, report=report)
+    mask1, mask2 = passing(mates[0]), passing(mates[1])
+    keep = mask1 & mask2 if policy == BOTH else mask1 | mask2
+    assert total == len(keep)
+    assert passed == keep.sum() > 0
+    kept1 = list(fastq_reader.read_fastq(out_r1))
+    kept2 = list(fastq_reader.read_fastq(out_r2))
+    assert [pair_id(record.id) for record in kept1] == [pair_id(record.id) for record in kept2]
+    expected = [record.to_bytes() for record, kept in zip(fastq_reader.read_fastq(mates[0]), keep) if kept]
+    assert [record.to_bytes() for record in kept1] == expected
+    counters = report.counters
+    assert counters['both_mates_passed'] == (mask1 & mask2).sum()
+    assert counters['only_r1_passed'] == (mask1 & ~mask2).sum()
+    assert counters['only_r2_passed'] == (~mask1 & mask2).sum()
+    assert sum(count for reason, count in report.rejections.items() if reason.startswith("R1_")) == (~mask1).sum()
+
+
+def test_mismatched_ids_fail_fast(mates, tmp_path):
+    records = list(fastq_reader.read_fastq(mates[1]))
+    records[5], records[6] = records[6], records[5]
+    swapped = write_mates(tmp_path, records, "swapped")
+    with pytest.raises(PairMismatchError, match="Read 6 "):
+        filter_paired_fastq(mates[0], swapped, str(tmp_path / "a.fastq"), str(tmp_path / "b.fastq"))
+
+
+@pytest.mark.parametrize("drop", [1, -1])
+def test_different_read_counts_fail(mates, tmp_path, drop):
+    records = list(fastq_reader.read_fastq(mates[1]))
+    shorter = write_mates(tmp_path, records[:-1], "short")
+    inputs = (mates[0], shorter) if drop == 1 else (shorter, mates[1])
+    with pytest.raises(PairMismatchError, match="has more"):
+        filter_paired_fastq(*inputs, str(tmp_path / "a.fastq"), str(tmp_path / "b.fastq"))
+
+
+def test_pair_id_ignores_mate_suffix():
+    assert pair_id("read1/1") == pair_id("read1/2") == "read1"
+    assert pair_id("read1") == "read1"
+    batches = list(iter_pair_batches(iter([]), iter([])))
+    assert batches == []
+
+
+def test_unknown_policy_is_rejected(mates, tmp_path):
+    with pytest.raises(ValueError):
+        filter_paired_fastq(*mates, str(tmp_path / "a.fastq"), str(tmp_path / "b.fastq"), policy="any")
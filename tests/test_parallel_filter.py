@@ -0,0 +1,40 @@
+import time
+import pytest
+from src.filter.filter import filter_fastq
+from src.pipeline.parallel import ordered_map
+
+
+def slow_square(value):
+    # Early items finish last, so the results come back out of order
+    time.sleep(0.01 * (5 - value % 5))
+    return value * value
+
+
+def test_ordered_map_keeps_input_order():
+    assert list(ordered_map(slow_square, range(20), 4)) == [value * value for value in range(20)]
+
+
+def test_ordered_map_bounds_submitted_items():
+    submitted = []
+
+    def items():
+        for value in range(10):
+            submitted.append(value)
+            yield value
+
+    results = ordered_map(slow_square, items(), 2, in_flight=3)
+    assert next(results) == 0
+    assert len(submitted) <= 4
+    assert list(results) == [value * value for value in range(1, 10)]
+
+
+@pytest.mark.parametrize("use_index", [False, True])
+def test_parallel_output_matches_serial(synthetic_fastq, tmp_path, use_index):
+    serial = tmp_path / "serial.fastq"
+    parallel = tmp_path / "parallel.fastq"
+    expected = filter_fastq(synthetic_fastq, str(serial))
+    # Small chunks, so the file is split over many work items
+    result = filter_fastq(synthetic_fastq, str(parallel), threads=3, chunk_size=32 * 1024, use_index=use_index)
+    assert result == expected
+    assert 0 < expected[1] < expected[0]
+    assert parallel.read_bytes() == serial.read_bytes()
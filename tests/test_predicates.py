@@ -0,0 +1,147 @@
+import numpy as np
+import pytest
+from src.parsing.fastq_reader import FastqRecord, PHRED_OFFSET
+from src.statistic.batch_metrics import RecordBatch, BatchMetrics
+from src.filter.predicates import (
+    FilterEngine, MaxNFraction, MaxExpectedErrors, MinWindowQuality, MinLength, MinMeanQuality,
+    build_predicates, ADAPT_AFTER,
+)
+
+
+def make_record(name, qualities, seq=None):
+    seq = seq or b'A' * len(qualities)
+    return FastqRecord(name, seq, bytes(q + PHRED_OFFSET for q in qualities))
+
+
+def measure(records):
+    batch = RecordBatch(records)
+    return batch, BatchMetrics(batch, 0)
+
+
+def failed(predicate, records):
+    batch, metrics = measure(records)
+    return predicate.failed(metrics, np.arange(len(records)), batch).tolist()
+
+
+def min_window_mean(qualities, size):
+    if len(qualities) < size:
+        return sum(qualities) / len(qualities)
+    return min(sum(qualities[i:i + size]) / size for i in range(len(qualities) - size + 1))
+
+
+def test_max_n_fraction():
+    records = [
+        make_record(b'none', [30] * 10, b'ACGTACGTAC'),
+        make_record(b'at_limit', [30] * 10, b'NNACGTACGT'),
+        make_record(b'above', [30] * 10, b'NNNCGTACGT'),
+        make_record(b'lowercase', [30] * 10, b'nnnCGTACGT'),
+    ]
+    # N is counted in either case
+    assert failed(MaxNFraction(0.2), records) == [False, False, True, True]
+
+
+def test_max_expected_errors():
+    # Q10 is 0.1 expected errors per base, Q20 is 0.01
+    records = [
+        make_record(b'q10', [10] * 10),
+        make_record(b'q20', [20] * 10),
+        make_record(b'mixed', [10] * 5 + [40] * 5),
+    ]
+    assert failed(MaxExpectedErrors(0.6), records) == [True, False, False]
+    assert failed(MaxExpectedErrors(0.05), records) == [True, True, True]
+
+
+def test_window_quality_matches_a_plain_loop():
+    rng = np.random.default_rng(3)
+    qualities = [rng.integers(0, 41, rng.integers(1, 40)).tolist() for _ in range(300)]
+    records = [make_record(b'read%d' % i, q) for i, q in enumerate(qualities)]
+    for size in (1, 5, 10, 25):
+        expected = [min_window_mean(q, size) < 20 for q in qualities]
+        assert failed(MinWindowQuality(20, size), records) == expected
+
+
+def test_window_does_not_cross_into_the_next_read():
+    # Every window inside a read is good; a window running over the boundary
+    # into the bad start of the next read would fail the first read
+    records = [
+        make_record(b'good', [30] * 10),
+        make_record(b'bad_start', [0] * 3 + [40] * 12),
+    ]
+    assert failed(MinWindowQuality(20, 5), records) == [False, True]
+    assert failed(MinWindowQuality(20, 5), records[:1]) == [False]
+
+
+def test_window_longer_than_the_read_uses_the_mean():
+    records = [
+        make_record(b'short_good', [25, 15, 25]),
+        make_record(b'short_bad', [25, 5, 25]),
+        make_record(b'long', [30] * 12),
+    ]
+    assert failed(MinWindowQuality(20, 10), records) == [False, True, False]
+
+
+def test_window_predicates_on_empty_reads():
+    records = [make_record(b'empty', []), make_record(b'read', [30] * 12), make_record(b'empty2', [])]
+    batch, metrics = measure(records)
+    # The engine drops empty reads before any per-base predicate sees them
+    engine = FilterEngine(build_predicates(0, 0, 0, 100, max_expected_errors=1, window_quality=20))
+    mask, rejections = engine.apply(metrics, batch)
+    assert mask.tolist() == [False, True, False]
+    assert rejections['no_qualities'] == 2
+    # The per-base predicates also work on a subset without the empty reads
+    assert MinWindowQuality(20).failed(metrics, np.array([1]), batch).tolist() == [False]
+    assert MaxExpectedErrors(1).failed(metrics, np.array([1]), batch).tolist() == [False]
+
+
+def test_every_read_counted_once_under_its_first_failing_reason():
+    rng = np.random.default_rng(5)
+    records = []
+    for i in range(500):
+        length = int(rng.integers(0, 120))
+        seq = bytes(rng.choice(list(b'ACGTN'), length).tolist())
+        records.append(make_record(b'read%d' % i, rng.integers(0, 41, length).tolist(), seq))
+    batch, metrics = measure(records)
+    engine = FilterEngine(build_predicates(
+        20, 30, 20, 80, max_length=100, max_n_fraction=0.2, max_expected_errors=3, window_quality=10,
+    ))
+    mask, rejections = engine.apply(metrics, batch)
+
+    expected = dict.fromkeys(engine.reasons, 0)
+    for i in range(len(records)):
+        for predicate in engine.predicates:
+            if predicate.failed(metrics, np.array([i]), batch)[0]:
+                expected[predicate.reason] += 1
+                assert not mask[i]
+                break
+        else:
+            assert mask[i]
+    assert rejections == expected
+    assert sum(rejections.values()) + int(mask.sum()) == len(records)
+
+
+def test_static_order_is_by_cost_then_given_order():
+    engine = FilterEngine(build_predicates(max_expected_errors=1, window_quality=20, max_length=500))
+    assert engine.reasons == (
+        "no_qualities", "too_short", "low_quality", "gc_too_low", "gc_too_high", "too_long",
+        "expected_errors", "low_window_quality",
+    )
+
+
+@pytest.mark.parametrize("adaptive", [False, True])
+def test_adaptive_reorder_after_adapt_after_reads(adaptive):
+    # Every read is long enough but of low quality
+    records = [make_record(b'read%d' % i, [5] * 60) for i in range(1000)]
+    batch, metrics = measure(records)
+    engine = FilterEngine([MinLength(50), MinMeanQuality(20)], adaptive)
+    for _ in range(ADAPT_AFTER // len(records) - 1):
+        engine.apply(metrics, batch)
+    # The static order is kept until ADAPT_AFTER reads were seen
+    assert engine.reasons == ("too_short", "low_quality")
+    mask, rejections = engine.apply(metrics, batch)
+    assert rejections == {"too_short": 0, "low_quality": len(records)}
+    expected = ("low_quality", "too_short") if adaptive else ("too_short", "low_quality")
+    assert engine.reasons == expected
+    # The counts do not depend on the order
+    mask_after, rejections_after = engine.apply(metrics, batch)
+    assert mask_after.tolist() == mask.tolist()
+    assert rejections_after == rejections
@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+from src.parsing.demux import UNCLASSIFIED
+from src.parsing.fastq_reader import FastqRecord, PHRED_OFFSET
+from src.statistic import quality_profile
+from src.statistic.batch_metrics import RecordBatch, BatchMetrics
+from src.statistic.quality_profile import (
+    QualityProfile, load_quality_profile, mean_phred, position_bins, POSITION_EDGES, LENGTH_BIN_EDGES, MAX_GROUPS, OTHER,
+)
+
+
+def make_record(name, qualities, seq=None):
+    seq = seq or b'ACGT' * (len(qualities) // 4) + b'A' * (len(qualities) % 4)
+    return FastqRecord(name, seq, bytes(q + PHRED_OFFSET for q in qualities))
+
+
+def profile_of(records, barcodes, mask):
+    batch = RecordBatch(records)
+    profile = QualityProfile()
+    profile.update(batch, BatchMetrics(batch, 0), barcodes, np.array(mask))
+    return profile
+
+
+def brute_force(records, barcodes, mask):
+    # Position x score counts of every (group, state), one base at a time
+    groups = list(dict.fromkeys(UNCLASSIFIED if barcode is None else barcode for barcode in barcodes))
+    shape = (len(groups), 2, len(POSITION_EDGES), quality_profile.PHRED_SCORES)
+    from_start, from_end = np.zeros(shape, dtype=np.int64), np.zeros(shape, dtype=np.int64)
+    bins = position_bins(np.arange(max(len(record.qual) for record in records))).tolist()
+    for record, barcode, passed in zip(records, barcodes, mask):
+        group = groups.index(UNCLASSIFIED if barcode is None else barcode)
+        length = len(record.qual)
+        for position, score in enumerate(record.qual):
+            score -= PHRED_OFFSET
+            from_start[group, int(passed), bins[position], score] += 1
+            from_end[group, int(passed), bins[length - 1 - position], score] += 1
+    return groups, from_start, from_end
+
+
+def test_known_qualities():
+    records = [
+        make_record(b'a', [10, 20, 30]),
+        make_record(b'b', [5, 5]),
+        make_record(b'c', [40] * 150),
+    ]
+    barcodes = ["ACGTAC", None, "ACGTAC"]
+    profile = profile_of(records, barcodes, [True, False, False])
+    assert list(profile.groups) == ["ACGTAC", UNCLASSIFIED]
+    # Read a passed: one base of each score at positions 0, 1 and 2 from the start
+    assert profile.from_start[0, 1, 0, 10] == profile.from_start[0, 1, 1, 20] == profile.from_start[0, 1, 2, 30] == 1
+    assert profile.from_end[0, 1, 0, 30] == profile.from_end[0, 1, 2, 10] == 1
+    assert profile.from_start[0, 1].sum() == 3
+    # Read c failed; its positions past 100 fall into wider bins
+    assert profile.from_start[0, 0, :, 40].sum() == 150
+    assert profile.from_start[0, 0, 99, 40] == 1
+    assert profile.from_start[0, 0, 100:, 40].sum() == 50
+    assert profile.from_start[1, 0, :2, 5].tolist() == [1, 1]
+
+    original, filtered = profile.by_state(profile.from_start)[0]
+    assert mean_phred(filtered[:3]).tolist() == [10, 20, 30]
+    assert mean_phred(original[:3]).tolist() == [25, 30, 35]
+    assert mean_phred(original[120]) == 0
+    # Length-binned mean qualities: read a is 20 on average, read c 40
+    assert profile.length_quality[0, 1, 0, 20] == 1
+    bin_c = np.searchsorted(LENGTH_BIN_EDGES, 150, side='right') - 1
+    assert profile.length_quality_sum[0, 0, bin_c] == 40
+
+
+def test_mean_phred():
+    counts = np.zeros((3, quality_profile.PHRED_SCORES), dtype=np.int64)
+    counts[0, 10] = counts[0, 30] = 1
+    counts[1, 93] = 5
+    assert mean_phred(counts).tolist() == [20, 93, 0]
+
+
+@pytest.mark.parametrize("block", [7, 64, quality_profile.PROFILE_BLOCK])
+def test_counts_match_a_base_by_base_loop(monkeypatch, block):
+    # Small blocks split reads between the blocks of the batch
+    monkeypatch.setattr(quality_profile, "PROFILE_BLOCK", block)
+    rng = np.random.default_rng(block)
+    records = [make_record(b'r%d' % i, rng.integers(0, 94, rng.integers(0, 300)).tolist()) for i in range(60)]
+    barcodes = [rng.choice(["AAA", "CCC", None]) for _ in records]
+    mask = (rng.random(len(records)) < 0.5).tolist()
+    profile = profile_of(records, barcodes, mask)
+    groups, from_start, from_end = brute_force(records, barcodes, mask)
+    assert list(profile.groups) == groups
+    assert profile.from_start[:len(groups)].tolist() == from_start.tolist()
+    assert profile.from_end[:len(groups)].tolist() == from_end.tolist()
+
+
+def test_merge_and_file_round_trip(tmp_path):
+    rng = np.random.default_rng(4)
+    records = [make_record(b'r%d' % i, rng.integers(0, 41, rng.integers(1, 200)).tolist()) for i in range(40)]
+    barcodes = [rng.choice(["AAA", "CCC", "GGG"]) for _ in records]
+    mask = (rng.random(len(records)) < 0.5).tolist()
+    whole = profile_of(records, barcodes, mask)
+    merged = QualityProfile()
+    for start in (0, 25):
+        merged.merge(profile_of(records[start:start + 25], barcodes[start:start + 25], mask[start:start + 25]))
+    assert merged.groups == whole.groups
+    for name in quality_profile.ARRAYS:
+        assert np.allclose(getattr(merged, name), getattr(whole, name)), name
+
+    path = str(tmp_path / "profile.npz")
+    whole.write(path)
+    loaded = load_quality_profile(path)
+    assert loaded['groups'] == list(whole.groups)
+    assert loaded['from_start'].tolist() == whole.by_state(whole.from_start).tolist()
+    assert loaded['from_start'][:, 0].sum() == sum(len(record.seq) for record in records)
+
+
+def test_groups_beyond_the_limit_are_counted_together():
+    records = [make_record(b'r%d' % i, [30] * 5) for i in range(MAX_GROUPS + 3)]
+    barcodes = [f"barcode{i:03d}" for i in range(len(records))]
+    profile = profile_of(records, barcodes, [True] * len(records))
+    assert len(profile.groups) == MAX_GROUPS + 1
+    assert OTHER in profile.groups
+    # Every read lands in exactly one row
+    assert profile.from_start[:, 1, 0, 30].sum() == len(records)
@@ -0,0 +1,115 @@
+import os
+import shutil
+import pytest
+from src.parsing.barcodes import BarcodeWhitelist
+from src.pipeline.fused import FusedPipeline
+from src.pipeline.instrumentation import RunReport
+from src.pipeline.result_cache import ResultCache, cache_key, INFO_FILE, ORIGINAL_CSV
+
+
+def run(input_file, output_dir, cache=None, **kwargs):
+    """Run the pipeline into output_dir; returns (outputs by name, RunReport)."""
+    os.makedirs(output_dir, exist_ok=True)
+    report = RunReport()
+    paths = {name: os.path.join(output_dir, name)
+             for name in ("filtered.fastq", "original_statistics.csv", "filtered_statistics.csv")}
+    FusedPipeline(
+        input_file, paths["filtered.fastq"], original_csv=paths["original_statistics.csv"],
+        filtered_csv=paths["filtered_statistics.csv"], cache=cache, report=report, **kwargs
+    ).run()
+    return {name: open(path, 'rb').read() for name, path in paths.items()}, report
+
+
+def entries(cache_dir):
+    return sorted(name for name in os.listdir(cache_dir) if os.path.isdir(os.path.join(cache_dir, name)))
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResultCache(str(tmp_path / "cache"))
+
+
+def test_miss_then_hit_gives_the_same_outputs(synthetic_fastq, tmp_path, cache):
+    expected, _ = run(synthetic_fastq, tmp_path / "plain")
+    missed, report = run(synthetic_fastq, tmp_path / "miss", cache)
+    assert 'cache_hit' not in report.counters
+    hit, report = run(synthetic_fastq, tmp_path / "hit", cache)
+    assert report.counters['cache_hit'] == 1
+    assert missed == expected
+    assert hit == expected
+
+
+def test_filter_settings_reuse_the_entry(synthetic_fastq, tmp_path, cache):
+    run(synthetic_fastq, tmp_path / "first", cache)
+    settings = dict(quality_threshold=15, min_length=100, gc_min=20, gc_max=70)
+    expected, _ = run(synthetic_fastq, tmp_path / "plain", **settings)
+    hit, report = run(synthetic_fastq, tmp_path / "hit", cache, **settings)
+    assert report.counters['cache_hit'] == 1
+    assert hit == expected
+    assert len(entries(cache.cache_dir)) == 1
+
+
+def test_key_depends_on_the_barcode_settings(synthetic_fastq):
+    key = cache_key(synthetic_fastq, 6, False)
+    assert cache_key(synthetic_fastq, 6, False) == key
+    assert cache_key(synthetic_fastq, 8, False) != key
+    assert cache_key(synthetic_fastq, 6, True) != key
+    whitelist = BarcodeWhitelist({"ACGTAC": "barcode01"}, 1)
+    with_whitelist = cache_key(synthetic_fastq, 6, False, whitelist)
+    assert with_whitelist != key
+    assert cache_key(synthetic_fastq, 6, False, BarcodeWhitelist({"ACGTAC": "barcode01"}, 0)) != with_whitelist
+    assert cache_key(synthetic_fastq, 6, False, BarcodeWhitelist({"ACGTAC": "barcode02"}, 1)) != with_whitelist
+
+
+def test_key_depends_on_the_input(synthetic_fastq):
+    key = cache_key(synthetic_fastq, 6, False)
+    with open(synthetic_fastq, 'ab') as handle:
+        handle.write(b"@extra\nACGT\n+\nIIII\n")
+    assert cache_key(synthetic_fastq, 6, False) != key
+
+
+def test_least_recently_used_entries_are_evicted(synthetic_fastq, tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    keys = []
+    for length in (4, 5, 6):
+        run(synthetic_fastq, tmp_path / f"out{length}", cache, barcode_length=length)
+        keys.append(cache_key(synthetic_fastq, length, False))
+    assert entries(cache.cache_dir) == sorted(keys)
+    # Use the first entry last, so the second one is the least recently used
+    for age, key in zip((10, 30, 20), keys):
+        info = os.path.join(cache.entry_path(key), INFO_FILE)
+        os.utime(info, ns=(os.stat(info).st_mtime_ns - age * 10 ** 9,) * 2)
+    cache.lookup(keys[0])
+    sizes = {key: sum(entry.stat().st_size for entry in os.scandir(cache.entry_path(key))) for key in keys}
+    cache.max_bytes = sum(sizes.values()) - 1
+    cache.evict()
+    assert entries(cache.cache_dir) == sorted([keys[0], keys[2]])
+    cache.max_bytes = sizes[keys[0]]
+    cache.evict()
+    assert entries(cache.cache_dir) == [keys[0]]
+
+
+@pytest.mark.parametrize("damage", ["truncated_column", "truncated_csv", "missing_info", "bad_info"])
+def test_damaged_entry_is_ignored(synthetic_fastq, tmp_path, cache, damage, caplog):
+    expected, _ = run(synthetic_fastq, tmp_path / "plain")
+    run(synthetic_fastq, tmp_path / "first", cache)
+    path = cache.entry_path(cache_key(synthetic_fastq, 6, False))
+    if damage == "truncated_column":
+        os.truncate(os.path.join(path, "quality_sum"), 100)
+    elif damage == "truncated_csv":
+        csv_path = os.path.join(path, ORIGINAL_CSV)
+        os.truncate(csv_path, os.path.getsize(csv_path) // 2)
+    elif damage == "missing_info":
+        # A partial entry, as left by copying the cache directory
+        os.remove(os.path.join(path, INFO_FILE))
+    else:
+        with open(os.path.join(path, INFO_FILE), 'w') as handle:
+            handle.write('{"records": ')
+    outputs, report = run(synthetic_fastq, tmp_path / "second", cache)
+    assert 'cache_hit' not in report.counters
+    assert "damaged cache entry" in caplog.text
+    assert outputs == expected
+    # The entry is stored again
+    hit, report = run(synthetic_fastq, tmp_path / "third", cache)
+    assert report.counters['cache_hit'] == 1
+    assert hit == expected
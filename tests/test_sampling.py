@@ -0,0 +1,112 @@
+import gzip
+import shutil
+import numpy as np
+import pytest
+from src.parsing import fastq_reader
+from src.parsing.fastq_index import build_index
+from src.pipeline.fused import FusedPipeline
+from src.pipeline.sampling import SamplePreview, SampleEstimates, wilson_interval, find_record_start, INDEX, SEEK, STREAM
+from src.statistic.batch_metrics import RecordBatch, BatchMetrics
+
+
+def preview(path, **kwargs):
+    return SamplePreview(FusedPipeline(path, None), seed=1, **kwargs).run()
+
+
+def exact_values(path):
+    pipeline = FusedPipeline(path, None)
+    pipeline.setup_filter()
+    batch = RecordBatch(list(fastq_reader.read_fastq(path)))
+    metrics = BatchMetrics(batch)
+    mask, _ = pipeline.engine.apply(metrics, batch)
+    return {
+        'reads': len(batch),
+        'mean_length': metrics.lengths.mean(),
+        'mean_gc_content': metrics.gc_content.mean(),
+        'mean_quality_score': metrics.mean_quality.mean(),
+        'pass_rate_percent': mask.mean() * 100,
+    }
+
+
+def test_wilson_interval():
+    p, low, high = wilson_interval(0.5, 100, 1.96)
+    assert p == 0.5
+    assert low == pytest.approx(0.4038, abs=1e-4)
+    assert high == pytest.approx(0.5962, abs=1e-4)
+    assert wilson_interval(0.0, 50, 1.96)[1] == 0.0
+    assert wilson_interval(1.0, 50, 1.96)[2] == 1.0
+    assert wilson_interval(0.3, 0, 1.96) == (0.0, 0.0, 1.0)
+
+
+def test_unweighted_estimates_are_the_sample_mean():
+    class Metrics:
+        lengths = np.array([10, 20, 30, 40])
+        gc_content = np.array([40.0, 50.0, 50.0, 60.0])
+        mean_quality = np.array([10.0, 20.0, 20.0, 30.0])
+
+    estimates = SampleEstimates(0.95)
+    mask = np.array([True, False, True, True])
+    estimates.update(Metrics, ["a", "a", "b", None], mask, {'length': ~mask})
+    mean, low, high = estimates.mean_interval("length")
+    assert mean == 25
+    # Sample standard deviation 12.91 over 4 reads
+    assert high - mean == pytest.approx(1.96 * 12.9099 / 2, abs=1e-3)
+    assert estimates.percent_interval(estimates.passed)[0] == 75
+    assert estimates.to_dict()['barcode_percent']['a']['estimate'] == 50
+
+
+def test_find_record_start_skips_quality_lines_starting_with_at():
+    data = b"IIII\n@@II\n@read2\nACGT\n+\nIIII\n@read3\n"
+    assert data[find_record_start(data):].startswith(b"@read2")
+    assert find_record_start(b"IIII\n@read2\nAC") == -1
+    assert find_record_start(b"IIII\n@read2\nACGT\n+\nIIII", at_end=True) == 5
+
+
+@pytest.mark.parametrize("compression", ["plain", "gzip"])
+def test_sample_of_every_read_is_exact(synthetic_fastq, compression):
+    path = synthetic_fastq
+    if compression == "gzip":
+        path += ".gz"
+        with open(synthetic_fastq, 'rb') as source, gzip.open(path, 'wb') as handle:
+            shutil.copyfileobj(source, handle)
+    exact = exact_values(synthetic_fastq)
+    # A fraction of 1 is a full pass for the streamed input; plain input is indexed first
+    if compression == "plain":
+        build_index(path).close()
+    results = preview(path, sample_fraction=1.0)
+    assert results['method'] == (INDEX if compression == "plain" else STREAM)
+    assert results['sampled_reads'] == exact['reads']
+    assert results['total_reads'] == exact['reads']
+    for name in ('mean_length', 'mean_gc_content', 'mean_quality_score', 'pass_rate_percent'):
+        assert results[name]['estimate'] == pytest.approx(exact[name])
+
+
+@pytest.mark.parametrize("indexed", [False, True])
+def test_sample_intervals_cover_the_exact_values(synthetic_fastq, indexed):
+    if indexed:
+        build_index(synthetic_fastq).close()
+    exact = exact_values(synthetic_fastq)
+    results = preview(synthetic_fastq, sample_size=1500, confidence=0.999)
+    assert results['method'] == (INDEX if indexed else SEEK)
+    assert results['sampled_reads'] == 1500
+    for name in ('mean_length', 'mean_gc_content', 'mean_quality_score', 'pass_rate_percent'):
+        assert results[name]['low'] <= exact[name] <= results[name]['high'], name
+    if not indexed:
+        total = results['total_reads']
+        assert total['low'] <= exact['reads'] <= total['high']
+
+
+def test_tolerance_stops_early(synthetic_fastq):
+    results = preview(synthetic_fastq, sample_size=100000, tolerance=50)
+    assert results['stopped_early']
+    assert results['sampled_reads'] < 100000
+
+
+def test_seek_sampling_with_a_first_read_over_the_seek_window(synthetic_fastq, tmp_path):
+    path = str(tmp_path / "long_first.fastq")
+    with open(path, 'wb') as handle, open(synthetic_fastq, 'rb') as source:
+        handle.write(b"@long\n" + b"ACGT" * 20000 + b"\n+\n" + b"I" * 80000 + b"\n")
+        shutil.copyfileobj(source, handle)
+    results = preview(path, sample_size=200)
+    assert results['method'] == SEEK
+    assert results['sampled_reads'] == 200
@@ -0,0 +1,144 @@
+import itertools
+import threading
+import time
+import pytest
+from src.filter.filter import filter_fastq
+from src.pipeline.fused import FusedPipeline
+from src.pipeline.staged import ReaderStage, WriterStage, QueuedWriter, StageError
+
+TIMEOUT = 30
+
+
+def finishes(function, *args):
+    """Call function on a thread; fail instead of hanging if it deadlocks. Returns its error, if any."""
+    outcome = {}
+
+    def target():
+        try:
+            outcome['result'] = function(*args)
+        except BaseException as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(TIMEOUT)
+    assert not thread.is_alive(), "deadlock"
+    return outcome.get('error')
+
+
+def failing_items(count, slow=False):
+    for item in range(count):
+        if slow:
+            time.sleep(0.01)
+        yield item
+    raise ValueError("bad record")
+
+
+class FailingHandle:
+    # A file that fails on its third write
+    def __init__(self, fail_at=3):
+        self.writes = []
+        self.fail_at = fail_at
+
+    def write(self, data):
+        if len(self.writes) + 1 == self.fail_at:
+            raise OSError("disk full")
+        self.writes.append(data)
+        return len(data)
+
+
+def corrupt_input(synthetic_fastq):
+    # Valid records, then a record without its '+' line after about two thirds of the file
+    with open(synthetic_fastq, 'rb') as handle:
+        data = handle.read()
+    cut = data.index(b'\n@', len(data) * 2 // 3) + 1
+    with open(synthetic_fastq, 'wb') as handle:
+        handle.write(data[:cut] + b"@broken\nACGT\nIIII\n" + data[cut:])
+    return synthetic_fastq
+
+
+@pytest.mark.parametrize("depth", [1, 4])
+def test_reader_error_reaches_the_consumer(depth):
+    seen = []
+
+    def consume():
+        for item in ReaderStage(failing_items(20), "reader", depth):
+            seen.append(item)
+            time.sleep(0.005)
+
+    error = finishes(consume)
+    assert isinstance(error, StageError)
+    assert error.stage == "reader"
+    assert isinstance(error.error, ValueError)
+    assert seen == list(range(20))
+
+
+def test_consumer_leaving_early_stops_the_reader():
+    stage = ReaderStage(itertools.count(), "reader", 2)
+
+    def consume():
+        for item in stage:
+            if item == 10:
+                break
+
+    assert finishes(consume) is None
+    stage.thread.join(TIMEOUT)
+    assert not stage.thread.is_alive()
+
+
+@pytest.mark.parametrize("depth", [1, 4])
+def test_writer_error_is_raised_by_put_or_close(depth):
+    handle = FailingHandle()
+    writer = QueuedWriter(handle, "writer", depth)
+
+    def write_all():
+        for number in range(100):
+            writer.write(b'%d\n' % number)
+        writer.close()
+
+    error = finishes(write_all)
+    assert isinstance(error, StageError)
+    assert error.stage == "writer"
+    assert isinstance(error.error, OSError)
+    # The items after the failing one are dropped
+    assert handle.writes == [b'0\n', b'1\n']
+    assert not writer.stage.thread.is_alive()
+
+
+def test_writer_close_raises_the_error_of_the_last_item():
+    stage = WriterStage(FailingHandle(fail_at=2).write, "writer")
+    stage.put(b'first')
+    stage.put(b'second')
+    error = finishes(stage.close)
+    assert isinstance(error, StageError) and isinstance(error.error, OSError)
+
+
+def test_fused_pipeline_raises_the_reader_error(synthetic_fastq, tmp_path):
+    path = corrupt_input(synthetic_fastq)
+    pipeline = FusedPipeline(path, str(tmp_path / "out.fastq"), pipelined=True)
+    error = finishes(pipeline.run)
+    assert isinstance(error, StageError)
+    assert error.stage == "reader"
+    assert isinstance(error.error, ValueError)
+
+
+def test_fused_pipeline_raises_the_writer_error(synthetic_fastq):
+    pipeline = FusedPipeline(synthetic_fastq, None, quality_threshold=0, min_length=0, gc_min=0, gc_max=100,
+                             pipelined=True)
+    pipeline.setup_filter()
+    handle = FailingHandle(fail_at=1)
+    error = finishes(pipeline.run_pipelined, handle)
+    assert isinstance(error, StageError)
+    assert error.stage == "writer"
+    assert isinstance(error.error, OSError)
+    assert handle.writes == []
+
+
+def test_filter_fastq_raises_the_reader_error(synthetic_fastq, tmp_path):
+    path = corrupt_input(synthetic_fastq)
+    # The single-threaded run raises the error itself, the pipelined one wraps it
+    error = finishes(filter_fastq, path, str(tmp_path / "out.fastq"))
+    assert type(error) is ValueError
+    error = finishes(lambda: filter_fastq(path, str(tmp_path / "out.fastq"), pipelined=True))
+    assert isinstance(error, StageError)
+    assert isinstance(error.error, ValueError)
@@ -0,0 +1,81 @@
+import numpy as np
+from src.parsing.fastq_reader import FastqRecord, PHRED_OFFSET
+from src.statistic.batch_metrics import RecordBatch
+from src.filter.trimming import Trimmer
+from src.filter.filter import filter_fastq
+from src.pipeline.instrumentation import RunReport
+
+
+def make_record(name, qualities, seq=None):
+    seq = seq or b'A' * len(qualities)
+    return FastqRecord(name, seq, bytes(q + PHRED_OFFSET for q in qualities))
+
+
+def bwa_trim(qualities, threshold):
+    # The 3' trimming of BWA -q (without its minimum read length)
+    total, best, keep = 0, 0, len(qualities)
+    for position in range(len(qualities) - 1, -1, -1):
+        total += threshold - qualities[position]
+        if total < 0:
+            break
+        if total > best:
+            best, keep = total, position
+    return keep
+
+
+def test_mott_low_quality_start_keeps_good_bases():
+    qualities = [2] * 100 + [21] * 1000 + [2] * 10
+    trimmed, counts = Trimmer(mott_quality=20).trim(RecordBatch([make_record(b'read', qualities)]))
+    assert trimmed.lengths.tolist() == [1100]
+    assert counts['quality_trimmed_bases'] == 10
+
+
+def test_mott_matches_bwa():
+    rng = np.random.default_rng(1)
+    records = [make_record(b'read%d' % i, rng.integers(0, 41, rng.integers(0, 80)).tolist()) for i in range(300)]
+    trimmed, _ = Trimmer(mott_quality=20).trim(RecordBatch(records))
+    expected = [bwa_trim([q - PHRED_OFFSET for q in record.qual], 20) for record in records]
+    assert trimmed.lengths.tolist() == expected
+
+
+def test_window_keeps_last_good_window():
+    qualities = [30] * 20 + [5] * 10
+    trimmed, _ = Trimmer(window_quality=20, window_size=5).trim(RecordBatch([make_record(b'read', qualities)]))
+    # The window of bases 17-21 has 3 bases of 30 and 2 of 5, a mean of 20
+    assert trimmed.lengths.tolist() == [22]
+
+
+def test_adapter_clipped_with_mismatch():
+    adapter = b'ACGTACGTAC'
+    records = [
+        make_record(b'exact', [30] * 30, adapter + b'G' * 20),
+        make_record(b'mismatch', [30] * 30, b'TCGTACGTAC' + b'G' * 20),
+        make_record(b'other', [30] * 30, b'G' * 30),
+    ]
+    trimmed, counts = Trimmer(adapter='acgtacgtac').trim(RecordBatch(records))
+    assert trimmed.lengths.tolist() == [20, 20, 30]
+    assert [record.seq for record in trimmed.records] == [b'G' * 20, b'G' * 20, b'G' * 30]
+    assert counts['adapter_clipped_reads'] == 2
+
+
+def test_untrimmed_batch_is_returned_as_is():
+    batch = RecordBatch([make_record(b'read', [30] * 30)])
+    trimmed, counts = Trimmer(mott_quality=20, window_quality=20).trim(batch)
+    assert trimmed is batch
+    assert counts['quality_trimmed_reads'] == 0
+
+
+def test_filter_checks_and_writes_trimmed_reads(tmp_path):
+    records = [
+        # 60 good bases and a bad tail: fails the mean quality untrimmed, passes trimmed
+        make_record(b'tail', [30] * 60 + [2] * 60, b'GC' * 60),
+        make_record(b'good', [30] * 60, b'GC' * 30),
+    ]
+    path = tmp_path / "reads.fastq"
+    path.write_bytes(b''.join(record.to_bytes() for record in records))
+    report = RunReport()
+    output = tmp_path / "filtered.fastq"
+    total, passed = filter_fastq(str(path), str(output), gc_max=100, trimmer=Trimmer(mott_quality=20), report=report)
+    assert (total, passed) == (2, 2)
+    assert output.read_bytes() == make_record(b'tail', [30] * 60, b'GC' * 30).to_bytes() + records[1].to_bytes()
+    assert report.counters['quality_trimmed_bases'] == 60